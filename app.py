@@ -1,18 +1,191 @@
 # app.py
-import json, traceback
-from flask import Flask, request, jsonify
+import json, traceback, struct, sys, threading, time, hashlib, heapq, itertools, bisect
+_T_START = time.perf_counter()   # за отчета при стартиране (STARTUP)
+from collections import OrderedDict
+from flask import Flask, request, jsonify, stream_with_context, g
 from flask_cors import CORS
 import os
 import swisseph as swe
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
-# --- Timezone auto-detect from coordinates (no JS needed) ---
 try:
-    from timezonefinder import TimezoneFinder
-    _TZF = TimezoneFinder(in_memory=True)
-except Exception:
-    _TZF = None
+    import numpy as np
+except Exception:   # NumPy е нужен само за векторните backend-и
+    np = None
+
+try:
+    import pytz
+except Exception:   # без pytz dt_to_jd минава на zoneinfo
+    pytz = None
+
+try:
+    import fcntl
+except Exception:   # без fcntl (Windows) всеки процес пуска свой JobRunner
+    fcntl = None
+
+# Отчет за стартирането (секунди по етапи) – в лога и в /health
+STARTUP = {}
+
+# --- Timezone auto-detect from coordinates (no JS needed) ---
+# TimezoneFinder се зарежда при първо ползване (get_tzf) или от warm_up() във фонов
+# режим – import-ът на app.py не чака полигоните. Заявка, дошла преди фоновото
+# зареждане да е приключило, го изчаква (или го прави сама) под същия lock.
+_TZF = None
+_TZF_LOCK = threading.Lock()
+_TZF_MISSING = False
+
+_MISSING = object()
+
+class _LRUCache:
+    """Малък thread-safe LRU кеш с броячи (hits / misses / evictions)."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(0, int(maxsize))
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=_MISSING):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits / total) if total else 0.0,
+            }
+
+class TzGridIndex:
+    """
+    Предварително изчислена решетка часови зони (строи се офлайн с build_tz_grid.py).
+    Клетка = индекс на зона, ако никоя граница на полигон не минава през нея;
+    иначе BORDER → точен полигонен тест. Файлът се чете през mmap.
+
+    Формат (little-endian):
+      MAGIC | u32 ncols | u32 nrows | f64 res | u32 len(data_version) | data_version
+      | u32 len(names) | names ('\\n'-разделени, utf-8) | [подравняване до 2] | u16 клетки (ред = ширина от -90)
+    """
+    MAGIC = b"NKTZGRD1"
+    BORDER = 0xFFFF
+
+    def __init__(self, path: str):
+        import mmap
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        if mm[:8] != self.MAGIC:
+            raise ValueError(f"невалиден tz grid файл: {path}")
+        off = 8
+        self.ncols, self.nrows, self.res = struct.unpack_from("<IId", mm, off)
+        off += 16
+        (n,) = struct.unpack_from("<I", mm, off)
+        off += 4
+        self.data_version = bytes(mm[off:off + n]).decode("utf-8")
+        off += n
+        (n,) = struct.unpack_from("<I", mm, off)
+        off += 4
+        self.names = bytes(mm[off:off + n]).decode("utf-8").split("\n")
+        off += n
+        off += off % 2
+        self._cells = memoryview(mm)[off:off + 2 * self.ncols * self.nrows].cast("H")
+        self.path = path
+
+    def cell_of(self, lat: float, lon: float):
+        col = int((lon + 180.0) / self.res)
+        row = int((lat + 90.0) / self.res)
+        return min(max(row, 0), self.nrows - 1), min(max(col, 0), self.ncols - 1)
+
+    def lookup(self, lat: float, lon: float):
+        """Името на зоната или None (гранична клетка → нужен точен тест)."""
+        row, col = self.cell_of(lat, lon)
+        v = self._cells[row * self.ncols + col]
+        if v == self.BORDER:
+            return None
+        return self.names[v]
+
+    @classmethod
+    def write(cls, path: str, cells: bytes, ncols: int, nrows: int, res: float,
+              names: list, data_version: str):
+        dv = data_version.encode("utf-8")
+        nm = "\n".join(names).encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(cls.MAGIC)
+            f.write(struct.pack("<IId", ncols, nrows, res))
+            f.write(struct.pack("<I", len(dv)) + dv)
+            f.write(struct.pack("<I", len(nm)) + nm)
+            if f.tell() % 2:
+                f.write(b"\0")
+            f.write(cells)
+
+def _load_tz_grid(tzf):
+    """Зарежда решетката, ако я има и е строена за същите данни на timezonefinder."""
+    path = os.getenv("NK_TZ_GRID") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "tz_grid.bin")
+    if tzf is None or sys.byteorder != "little" or not os.path.exists(path):
+        return None
+    try:
+        grid = TzGridIndex(path)
+    except Exception:
+        return None
+    if grid.data_version != str(getattr(tzf, "data_version", "")):
+        return None
+    return grid
+
+_TZ_GRID = None
+
+def get_tzf():
+    """TimezoneFinder (и решетката до него) – зарежда се веднъж; None, ако пакетът липсва."""
+    global _TZF, _TZ_GRID, _TZF_MISSING
+    if _TZF is not None or _TZF_MISSING:
+        return _TZF
+    with _TZF_LOCK:
+        if _TZF is None and not _TZF_MISSING:
+            t0 = time.perf_counter()
+            try:
+                from timezonefinder import TimezoneFinder
+                tzf = TimezoneFinder(in_memory=True)
+            except Exception:
+                _TZF_MISSING = True
+                return None
+            t1 = time.perf_counter()
+            _TZ_GRID = _load_tz_grid(tzf)     # преди _TZF – бързият път вижда и двете готови
+            STARTUP["tz_index_s"] = round(t1 - t0, 4)
+            STARTUP["tz_grid_s"] = round(time.perf_counter() - t1, 4)
+            _TZF = tzf
+    return _TZF
+
+# LRU по квантувани координати (6 знака ≈ 0.1 м → на практика същият резултат)
+TZ_CACHE_DECIMALS = int(os.getenv("NK_TZ_CACHE_DECIMALS", "6"))
+_TZ_CACHE = _LRUCache(int(os.getenv("NK_TZ_CACHE_SIZE", "8192")))
 
 def _safe_zoneinfo(tz_name: str):
     """Return ZoneInfo(tz_name) or UTC if tz_name is invalid."""
@@ -21,26 +194,42 @@ def _safe_zoneinfo(tz_name: str):
     except Exception:
         return timezone.utc
 
+def _tz_from_coords(lat: float, lon: float):
+    """Зона по координати: кеш → решетка → полигонен тест. None ако няма."""
+    key = (round(lat, TZ_CACHE_DECIMALS), round(lon, TZ_CACHE_DECIMALS))
+    tz = _TZ_CACHE.get(key)
+    if tz is not _MISSING:
+        return tz
+    tzf = get_tzf()
+    if tzf is None:
+        return None
+    tz = _TZ_GRID.lookup(lat, lon) if _TZ_GRID is not None else None
+    if tz is None:
+        try:
+            tz = tzf.timezone_at(lat=lat, lng=lon) or tzf.closest_timezone_at(lat=lat, lng=lon)
+        except Exception:
+            tz = None
+    _TZ_CACHE.put(key, tz)
+    return tz
+
 def resolve_timezone(lat: float, lon: float, tz_sent: str | None = None) -> str:
     """Prefer timezone from coordinates; fall back to tz_sent; then UTC."""
     tz_sent = (tz_sent or '').strip()
     # If tz_sent is not an IANA name (e.g. 'GMT+3'), we ignore it.
     if tz_sent and ('/' not in tz_sent):
         tz_sent = ''
-    if _TZF is not None:
-        try:
-            tz = _TZF.timezone_at(lat=lat, lng=lon) or _TZF.closest_timezone_at(lat=lat, lng=lon)
-            if tz:
-                return tz
-        except Exception:
-            pass
+    tz = _tz_from_coords(lat, lon)
+    if tz:
+        return tz
     return tz_sent or 'UTC'
 
 
 # ---- Swiss Ephemeris: път до ефемеридите ----
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 EPHE_PATH = os.path.join(BASE_DIR, "ephe")  # папка "ephe" до app.py
+_t = time.perf_counter()
 swe.set_ephe_path(EPHE_PATH)
+STARTUP["ephe_path_s"] = round(time.perf_counter() - _t, 4)
 
 # Печат за версията на бекенда (за да видиш дали деплой е сменил файла)
 BUILD_STAMP = str(int(os.path.getmtime(__file__)))
@@ -73,6 +262,19 @@ NK_AYAN_OFFSET_JH = float(os.getenv("NK_AYAN_OFFSET_JH", "-0.0247"))
 # базов сидерален режим (без offset-a; той се добавя ръчно)
 swe.set_sid_mode(AYAN_MAP.get(AYAN, swe.SIDM_LAHIRI))
 
+# ВАЖНО: Swiss Ephemeris пази състоянието си (ephe path, sid_mode, отворени файлове)
+# thread-local. Нишка, която не е инициализирана, тихо минава на Moshier и на
+# sid_mode по подразбиране → всяка нишка се инициализира при първо ползване.
+_SWE_TLS = threading.local()
+
+def _swe_ready():
+    if not getattr(_SWE_TLS, "ready", False):
+        swe.set_ephe_path(EPHE_PATH)
+        swe.set_sid_mode(AYAN_MAP.get(AYAN, swe.SIDM_LAHIRI))
+        _SWE_TLS.ready = True
+
+_SWE_TLS.ready = True   # главната нишка е инициализирана по-горе
+
 # === DevaGuru compatibility mode ===
 NK_DEVA_MODE = os.getenv("NK_DEVA_MODE", "0") == "1"
 NK_DEVA_UTC_OFFSET_SEC = float(os.getenv("NK_DEVA_UTC_OFFSET_SEC", "0"))
@@ -82,6 +284,10 @@ SIGNS = [
     "Овен","Телец","Близнаци","Рак","Лъв","Дева",
     "Везни","Скорпион","Стрелец","Козирог","Водолей","Риби"
 ]
+SIGN_INDEX = {name: i for i, name in enumerate(SIGNS)}
+# Владетели на знаците
+SIGN_LORDS = ["Марс","Венера","Меркурий","Луна","Слънце","Меркурий",
+              "Венера","Марс","Юпитер","Сатурн","Сатурн","Юпитер"]
 NAK = [
     "Ашвини","Бхарани","Криттика","Рохини","Мригашира","Ардра",
     "Пунаравасу","Пушя","Ашлеша","Магха","Пурва-Пхалгуни","Утара-Пхалгуни",
@@ -207,7 +413,10 @@ def current_karana_name(sun_lon: float, moon_lon: float) -> str:
     """
     diff = (moon_lon - sun_lon) % 360.0
     k_num = int(diff / 6.0) + 1       # 1..60
+    return karana_name_from_num(k_num)
 
+def karana_name_from_num(k_num: int) -> str:
+    """Име на карана по поредния ѝ номер 1..60 в лунния месец."""
     if k_num < 1:
         k_num = 1
     if k_num > 60:
@@ -232,6 +441,8 @@ def current_karana_name(sun_lon: float, moon_lon: float) -> str:
 
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
+from functools import lru_cache
+from array import array
 import swisseph as swe
 
 def dt_to_jd(date_str: str, time_str: str, tz_str: str, lon: float = 0.0, use_lmt: bool = False):
@@ -244,8 +455,7 @@ def dt_to_jd(date_str: str, time_str: str, tz_str: str, lon: float = 0.0, use_lm
         dt_local = dt_naive.replace(tzinfo=tz_lmt)
     else:
         try:
-            import pytz
-            tz_pytz = pytz.timezone(tz_str)
+            tz_pytz = pytz.timezone(tz_str)     # pytz is None → zoneinfo по-долу
             try:
                 dt_local = tz_pytz.localize(dt_naive, is_dst=None)
             except pytz.exceptions.AmbiguousTimeError:
@@ -271,23 +481,146 @@ def dt_to_jd(date_str: str, time_str: str, tz_str: str, lon: float = 0.0, use_lm
 FLAGS_TROP = swe.FLG_SWIEPH | swe.FLG_SPEED
 FLAGS_SID  = swe.FLG_SWIEPH | swe.FLG_SIDEREAL | swe.FLG_SPEED
 
-def _ayanamsha_deg_ut(jd: float, offset_deg: float = 0.0) -> float:
-    # True Chitrapaksha: Спика фиксирана на 180° (тропически)
-    # ВАЖНО: нулираме sid_mode за да получим тропическа позиция на Спика
+# ---- Айанамша (True Chitrapaksha: Спика фиксирана на 180° тропически) ----
+# fixstar_ut без FLG_SIDEREAL винаги дава тропическа позиция → не пипаме sid_mode.
+# NK_AYAN_TABLE=1 (по подразбиране): в AYAN_TABLE_FROM..AYAN_TABLE_TO стойността
+# се интерполира (кубично) от таблица със стъпка 0.5 дни; грешка < 0.0005" (~1e-7°),
+# т.е. под закръглянето на лонгитудите до 6 знака. Извън обхвата – точна стойност.
+AYAN_TABLE_ON = os.getenv("NK_AYAN_TABLE", "1") == "1"
+AYAN_TABLE_FROM = swe.julday(1800, 1, 1, 0.0)
+AYAN_TABLE_TO   = swe.julday(2200, 1, 1, 0.0)
+AYAN_TABLE_STEP = 0.5   # дни
+AYAN_TABLE_BLOCK = 730  # възли в един блок (~1 година), строят се при нужда
+
+def _spica_ayanamsha_raw(jd: float) -> float:
     try:
-        swe.set_sid_mode(0)  # нулираме към tropical
         result = swe.fixstar_ut("Spica", jd, swe.FLG_SWIEPH)
-        base = (result[0][0] - 180.0) % 360.0
+        return (result[0][0] - 180.0) % 360.0
     except Exception:
-        base = swe.get_ayanamsa_ut(jd)
-    finally:
-        swe.set_sid_mode(AYAN_MAP.get(AYAN, swe.SIDM_LAHIRI))
+        # без sefstars.txt → стандартната айанамша на избрания режим
+        return swe.get_ayanamsa_ut(jd)
+
+@lru_cache(maxsize=8192)
+def _spica_ayanamsha_exact(jd: float) -> float:
+    """Точна айанамша (без offset) – мемоизирана по JD."""
+    _swe_ready()
+    return _spica_ayanamsha_raw(jd)
+
+class SpicaAyanamsha:
+    """
+    Табулирана True Chitrapaksha айанамша (без offset).
+    Таблицата се пълни на блокове от AYAN_TABLE_BLOCK възела при първо ползване;
+    между възлите – 4-точкова (Лагранж) кубична интерполация.
+    """
+
+    def __init__(self, jd_from: float, jd_to: float, step: float = AYAN_TABLE_STEP,
+                 block: int = AYAN_TABLE_BLOCK):
+        self.jd_from = float(jd_from)
+        self.jd_to = float(jd_to)
+        self.step = float(step)
+        self.block = int(block)
+        self.n_nodes = int((self.jd_to - self.jd_from) / self.step) + 1
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def _build_block(self, b: int):
+        _swe_ready()
+        with self._lock:
+            blk = self._blocks.get(b)
+            if blk is None:
+                i0 = b * self.block
+                i1 = min(i0 + self.block, self.n_nodes)
+                blk = array('d', (_spica_ayanamsha_raw(self.jd_from + i * self.step)
+                                  for i in range(i0, i1)))
+                self._blocks[b] = blk
+        return blk
+
+    def _node(self, i: int) -> float:
+        b, k = divmod(i, self.block)
+        blk = self._blocks.get(b)
+        if blk is None:
+            blk = self._build_block(b)
+        return blk[k]
+
+    def covers(self, jd: float) -> bool:
+        # нужни са възли i-1 .. i+2
+        return self.jd_from + self.step <= jd < self.jd_to - 2 * self.step
+
+    def base(self, jd: float) -> float:
+        """Айанамша без offset за jd (интерполирана или точна извън обхвата)."""
+        if not self.covers(jd):
+            return _spica_ayanamsha_exact(jd)
+        x = (jd - self.jd_from) / self.step
+        i = int(x)
+        t = x - i
+        y0 = self._node(i - 1)
+        y1 = self._node(i)
+        y2 = self._node(i + 1)
+        y3 = self._node(i + 2)
+        return (-t * (t - 1.0) * (t - 2.0) / 6.0 * y0
+                + (t + 1.0) * (t - 1.0) * (t - 2.0) / 2.0 * y1
+                - (t + 1.0) * t * (t - 2.0) / 2.0 * y2
+                + (t + 1.0) * t * (t - 1.0) / 6.0 * y3)
+
+    def many(self, jds):
+        """Векторна версия на base() за NumPy масив от JD."""
+        jds = np.asarray(jds, dtype=np.float64)
+        out = np.empty(jds.shape, dtype=np.float64)
+        inside = (jds >= self.jd_from + self.step) & (jds < self.jd_to - 2 * self.step)
+        for k in np.nonzero(~inside)[0]:
+            out.flat[k] = _spica_ayanamsha_exact(float(jds.flat[k]))
+        if inside.any():
+            x = (jds[inside] - self.jd_from) / self.step
+            i = x.astype(np.int64)
+            t = x - i
+            ys = []
+            for j in (i - 1, i, i + 1, i + 2):
+                y = np.empty(j.shape, dtype=np.float64)
+                blocks = j // self.block
+                for b in np.unique(blocks):
+                    blk = self._blocks.get(int(b)) or self._build_block(int(b))
+                    m = blocks == b
+                    y[m] = np.frombuffer(blk, dtype=np.float64)[j[m] - b * self.block]
+                ys.append(y)
+            y0, y1, y2, y3 = ys
+            out[inside] = (-t * (t - 1.0) * (t - 2.0) / 6.0 * y0
+                           + (t + 1.0) * (t - 1.0) * (t - 2.0) / 2.0 * y1
+                           - (t + 1.0) * t * (t - 2.0) / 2.0 * y2
+                           + (t + 1.0) * t * (t - 1.0) / 6.0 * y3)
+        return out
+
+    def precompute(self, jd_from: float | None = None, jd_to: float | None = None):
+        """Строи блоковете за [jd_from, jd_to] (по подразбиране всички) наведнъж – напр. при warm-up."""
+        i0 = 0 if jd_from is None else max(0, int((jd_from - self.jd_from) / self.step) - 1)
+        i1 = self.n_nodes - 1 if jd_to is None else min(self.n_nodes - 1, int((jd_to - self.jd_from) / self.step) + 2)
+        for b in range(i0 // self.block, i1 // self.block + 1):
+            if b not in self._blocks:
+                self._build_block(b)
+
+AYANAMSHA_TABLE = SpicaAyanamsha(AYAN_TABLE_FROM, AYAN_TABLE_TO) if AYAN_TABLE_ON else None
+
+def _ayanamsha_deg_ut(jd: float, offset_deg: float = 0.0) -> float:
+    # True Chitrapaksha: Спика фиксирана на 180° (тропически) + offset за режима
+    if AYANAMSHA_TABLE is not None:
+        base = AYANAMSHA_TABLE.base(jd)
+    else:
+        base = _spica_ayanamsha_exact(jd)
     return base + float(offset_deg)
 
+def _ayanamsha_many(jds, offset_deg: float = 0.0):
+    """Айанамша (+offset) за NumPy масив от JD."""
+    if AYANAMSHA_TABLE is not None:
+        return AYANAMSHA_TABLE.many(jds) + float(offset_deg)
+    jds = np.asarray(jds, dtype=np.float64)
+    return np.array([_spica_ayanamsha_exact(float(j)) for j in jds.ravel()]).reshape(jds.shape) + float(offset_deg)
+
 def _sidereal_from_tropical(trop_lon: float, ayan: float) -> float:
     return (trop_lon - ayan) % 360.0
 
-def planet_longitudes(jd: float, use_sidereal: bool = True, ayan_override: float | None = None, topo: bool = False):
+def planet_longitudes(jd: float, use_sidereal: bool = True, ayan_override: float | None = None, topo: bool = False,
+                      node_type: str | None = None, bodies=None):
+    # bodies – по желание подмножество от имената ("Слънце", "Луна", …, "Раху", "Кету");
+    # телата, които не са поискани, не се смятат (напр. възелът без Раху/Кету)
     # ако е подаден ayan_override -> ползваме него (вече включва offset-а за режима)
     ayan = float(ayan_override) if (use_sidereal and ayan_override is not None) else (
         _ayanamsha_deg_ut(jd, NK_AYAN_OFFSET_JH) if use_sidereal else 0.0
@@ -308,6 +641,8 @@ def planet_longitudes(jd: float, use_sidereal: bool = True, ayan_override: float
 
     out = []
     for pid, name in plist:
+        if bodies is not None and name not in bodies:
+            continue
         pos, _ = swe.calc_ut(jd, pid, flags)
         trop = pos[0] % 360.0
         spd  = pos[3]
@@ -325,8 +660,11 @@ def planet_longitudes(jd: float, use_sidereal: bool = True, ayan_override: float
             "retrograde": retro
         })
 
+    if bodies is not None and "Раху" not in bodies and "Кету" not in bodies:
+        return out
+
     # Раху/Кету (същите флагове!)
-    node_id = swe.TRUE_NODE if NODE == "TRUE" else swe.MEAN_NODE
+    node_id = swe.TRUE_NODE if (node_type or NODE) == "TRUE" else swe.MEAN_NODE
     npos, _ = swe.calc_ut(jd, node_id, flags)
     trop_rahu = npos[0] % 360.0
 
@@ -336,22 +674,24 @@ def planet_longitudes(jd: float, use_sidereal: bool = True, ayan_override: float
     r_n, r_p = nak_pada(rahu)
     k_n, k_p = nak_pada(ketu)
 
-    out.append({
-        "planet": "Раху",
-        "longitude": round(rahu, 6),
-        "sign": sign_of(rahu),
-        "nakshatra": r_n,
-        "pada": r_p,
-        "retrograde": False
-    })
-    out.append({
-        "planet": "Кету",
-        "longitude": round(ketu, 6),
-        "sign": sign_of(ketu),
-        "nakshatra": k_n,
-        "pada": k_p,
-        "retrograde": False
-    })
+    if bodies is None or "Раху" in bodies:
+        out.append({
+            "planet": "Раху",
+            "longitude": round(rahu, 6),
+            "sign": sign_of(rahu),
+            "nakshatra": r_n,
+            "pada": r_p,
+            "retrograde": False
+        })
+    if bodies is None or "Кету" in bodies:
+        out.append({
+            "planet": "Кету",
+            "longitude": round(ketu, 6),
+            "sign": sign_of(ketu),
+            "nakshatra": k_n,
+            "pada": k_p,
+            "retrograde": False
+        })
 
     return out
 
@@ -360,16 +700,12 @@ def compute_arudha_lagna(asc_sign_index, planets):
     """
     Арудха Лагна (според традицията на Шри Ачютананда / Академия Джатака)
     """
-    # Владетели на знаците
-    rulers = ["Марс","Венера","Меркурий","Луна","Слънце","Меркурий",
-              "Венера","Марс","Юпитер","Сатурн","Сатурн","Юпитер"]
-
-    asc_lord = rulers[asc_sign_index]
+    asc_lord = SIGN_LORDS[asc_sign_index]
     lord = next((p for p in planets if p["planet"] == asc_lord), None)
     if not lord:
         return None
 
-    lord_sign_index = SIGNS.index(lord["sign"])
+    lord_sign_index = SIGN_INDEX[lord["sign"]]
 
     # Разстояние от Лагна до знака на лорда (1-based, но ние работим с 0-based)
     diff = (lord_sign_index - asc_sign_index) % 12
@@ -388,6 +724,17 @@ def compute_arudha_lagna(asc_sign_index, planets):
 
     return SIGNS[al_index]
 
+CHARA_KARAKA_LABELS = [
+    ("АК",  "Атмакаракa"),
+    ("АмК", "Аматякаракa"),
+    ("БК",  "Бхратрукаракa"),
+    ("МК",  "Матрукаракa"),
+    ("ПиК", "Питрукаракa"),
+    ("ПК",  "Путракаракa"),
+    ("ГК",  "Гнатикаракa"),
+    ("ДК",  "Даракаракa"),
+]
+
 def compute_chara_karakas(planets):
     """
     8 Chara Karaka (традиция Шри Ачютананда):
@@ -418,27 +765,93 @@ def compute_chara_karakas(planets):
 
     cand.sort(key=lambda x: x[1], reverse=True)
 
-    labels = [
-        ("АК",  "Атмакаракa"),
-        ("АмК", "Аматякаракa"),
-        ("БК",  "Бхратрукаракa"),
-        ("МК",  "Матрукаракa"),
-        ("ПиК", "Питрукаракa"),
-        ("ПК",  "Путракаракa"),
-        ("ГК",  "Гнатикаракa"),
-        ("ДК",  "Даракаракa"),
-    ]
-
     karakas = {}
-    for (name, _rel), (code, _full) in zip(cand, labels):
+    for (name, _rel), (code, _full) in zip(cand, CHARA_KARAKA_LABELS):
         karakas[name] = code
 
     return karakas
 
-def compute_panchanga(jd: float, dt_local, sun_lon: float, moon_lon: float):
+# ---------- PANCHANGA TRANSITIONS ----------
+# Начало/край на титхи, накшатра, йога, карана: Нютон по сидералните дължини на
+# Слънцето и Луната, със скоростите от swe.calc_ut → 2–3 итерации на граница.
+JD_UNIX_EPOCH = 2440587.5
+
+def jd_to_datetime(jd: float, tz=timezone.utc):
+    """JD (UT) → aware datetime, закръглен до секунда."""
+    sec = round((jd - JD_UNIX_EPOCH) * 86400.0)
+    return datetime.fromtimestamp(sec, tz=timezone.utc).astimezone(tz)
+
+def _limb_from(kind: str, s, m, ay: float):
+    """(стойност в °, скорост в °/ден) на частта от тропическите позиции s, m."""
+    if kind in ("tithi", "karana"):
+        return (m[0] - s[0]) % 360.0, m[3] - s[3]
+    if kind == "nakshatra":
+        return (m[0] - ay) % 360.0, m[3]
+    return (s[0] + m[0] - 2.0 * ay) % 360.0, s[3] + m[3]   # yoga
+
+def _limb_state(kind: str, jd: float, ayan_off: float):
+    """(стойност в °, скорост в °/ден) на частта 'kind' в момента jd."""
+    m, _ = swe.calc_ut(jd, swe.MOON, FLAGS_TROP)
+    s = swe.calc_ut(jd, swe.SUN, FLAGS_TROP)[0] if kind != "nakshatra" else None
+    ay = _ayanamsha_deg_ut(jd, ayan_off) if kind not in ("tithi", "karana") else 0.0
+    return _limb_from(kind, s, m, ay)
+
+def find_limb_time(kind: str, target: float, jd: float, ayan_off: float,
+                   start: tuple | None = None, tol_days: float = 1e-4, max_iter: int = 10) -> float:
+    """
+    Моментът около jd, в който частта 'kind' достига target (°).
+    start – (стойност, скорост) в jd, ако вече са известни (спестява едно изчисление).
+    Нютон се сближава квадратично: стъпка < 1e-4 д. оставя грешка ~1e-9 д.
+    """
+    val, rate = start if start is not None else _limb_state(kind, jd, ayan_off)
+    for _ in range(max_iter):
+        step = (((target - val) + 180.0) % 360.0 - 180.0) / rate
+        jd += step
+        if abs(step) < tol_days:
+            break
+        val, rate = _limb_state(kind, jd, ayan_off)
+    return jd
+
+def panchanga_transitions(jd: float, sun_lon: float, moon_lon: float, ayan_off: float) -> dict:
+    """{част: (начало_jd, край_jd)} за тити, накшатра, йога, карана в момента jd."""
+    _swe_ready()
+    nak_span = 360.0 / 27.0
+    diff = (moon_lon - sun_lon) % 360.0
+    t_idx = min(29, int(diff / 12.0))
+    k_idx = min(59, int(diff / 6.0))
+    n_idx = int((moon_lon % 360.0) // nak_span)
+    y_idx = min(26, int(((sun_lon + moon_lon) % 360.0) / nak_span))
+
+    # едно изчисление в самия момент засява всички търсения
+    s, _ = swe.calc_ut(jd, swe.SUN, FLAGS_TROP)
+    m, _ = swe.calc_ut(jd, swe.MOON, FLAGS_TROP)
+    ay = _ayanamsha_deg_ut(jd, ayan_off)
+    st = {kind: _limb_from(kind, s, m, ay) for kind in ("tithi", "nakshatra", "yoga")}
+
+    def find(kind, target):
+        return find_limb_time(kind, target, jd, ayan_off, start=st["tithi" if kind == "karana" else kind])
+
+    t0 = find("tithi", t_idx * 12.0)
+    t1 = find("tithi", (t_idx + 1) * 12.0)
+    # караната е половин тити → едната ѝ граница съвпада с границата на титхито
+    mid = find("karana", t_idx * 12.0 + 6.0)
+    k = (t0, mid) if k_idx % 2 == 0 else (mid, t1)
+
+    return {
+        "tithi": (t0, t1),
+        "karana": k,
+        "nakshatra": (find("nakshatra", n_idx * nak_span), find("nakshatra", (n_idx + 1) * nak_span)),
+        "yoga": (find("yoga", y_idx * nak_span), find("yoga", (y_idx + 1) * nak_span)),
+    }
+
+def compute_panchanga(jd: float, dt_local, sun_lon: float, moon_lon: float, ayan_off: float | None = None,
+                      lat: float | None = None, lon: float | None = None):
     """
     Панчанга:
     Титхи, Вара, Накшатра, Йога, Карана – име + управител + % остатък (където има смисъл).
+    Ако е подаден ayan_off – и начало/край (локално време) на титхи, накшатра, йога, карана.
+    Ако са подадени lat/lon – варата е от изгрев до изгрев (NK_VARA_SUNRISE) и
+    "sun": изгрев, залез, дължина на деня и нощта.
     """
 
     # ---------- TITHI ----------
@@ -456,7 +869,11 @@ def compute_panchanga(jd: float, dt_local, sun_lon: float, moon_lon: float):
     tithi_left_pct = tithi_left * 100.0
 
     # ---------- VARA ----------
-    wd = dt_local.weekday()  # 0=Mon..6=Sun
+    day = None
+    if lat is not None and lon is not None:
+        with stage("sunrise"):
+            day = vedic_day(jd, dt_local, lat, lon)
+    wd = day["weekday"] if (day is not None and VARA_FROM_SUNRISE) else dt_local.weekday()  # 0=Mon..6=Sun
     vara_name = VARA_NAMES[wd]
     vara_lord = VARA_LORDS[wd]
     # тук НЕ даваме процент (няма смисъл) → няма left_percent
@@ -501,7 +918,7 @@ def compute_panchanga(jd: float, dt_local, sun_lon: float, moon_lon: float):
     kar_left   = max(0.0, 1.0 - kar_frac)
     kar_left_pct = kar_left * 100.0
 
-    return {
+    out = {
         "tithi": {
             "name": tithi_name,
             "lord": tithi_lord,
@@ -529,6 +946,245 @@ def compute_panchanga(jd: float, dt_local, sun_lon: float, moon_lon: float):
         }
     }
 
+    tz = dt_local.tzinfo or timezone.utc
+    if day is not None:
+        out["sun"] = sun_day_info(day, tz)
+
+    if ayan_off is None:
+        return out
+
+    for kind, (j0, j1) in panchanga_transitions(jd, sun_lon, moon_lon, ayan_off).items():
+        out[kind]["start"] = jd_to_datetime(j0, tz).isoformat()
+        out[kind]["end"] = jd_to_datetime(j1, tz).isoformat()
+    return out
+
+# ---------- PANCHANGA CALENDAR ----------
+# Дневен календар: един проход напред във времето. Всяка граница на част се намира
+# веднъж (край на една = начало на следващата) и се споделя между дните;
+# титхите се вземат от границите на караните (всяка втора) – една и съща елонгация
+# Луна−Слънце, затова изчисленията ѝ не се повтарят. Накшатра и йога са отделни корени.
+SUNRISE_RSMI = swe.CALC_RISE
+
+def sunrise_jd(jd_start: float, lat: float, lon: float, rsmi: int = SUNRISE_RSMI):
+    """Първият изгрев след jd_start (JD UT) или None (полярен ден/нощ)."""
+    try:
+        res, tret = swe.rise_trans(jd_start, swe.SUN, rsmi, (lon, lat, 0.0))
+    except swe.Error:
+        return None
+    return tret[0] if res == 0 else None
+
+class _LimbWalker:
+    """Последователните интервали на една част (карана/накшатра/йога) напред във времето."""
+
+    def __init__(self, kind: str, span: float, n: int, jd: float, ayan_off: float):
+        self.kind = kind
+        self.span = span
+        self.n = n
+        self.ayan_off = ayan_off
+        val, rate = _limb_state(kind, jd, ayan_off)
+        self.idx = min(n - 1, int(val / span))
+        self.start = find_limb_time(kind, self.idx * span, jd, ayan_off, start=(val, rate))
+        self.end = find_limb_time(kind, (self.idx + 1) * span, jd, ayan_off, start=(val, rate))
+        self._days = self.end - self.start   # за засяване на следващото търсене
+        self._prev_start = None
+        self._next_end = None
+
+    def prev_start(self) -> float:
+        """Началото на предишния интервал (за титхи от карани)."""
+        if self._prev_start is None:
+            self._prev_start = find_limb_time(self.kind, ((self.idx - 1) % self.n) * self.span,
+                                              self.start - self._days, self.ayan_off)
+        return self._prev_start
+
+    def next_end(self) -> float:
+        """Краят на следващия интервал (намира се веднъж, advance() го преизползва)."""
+        if self._next_end is None:
+            self._next_end = find_limb_time(self.kind, ((self.idx + 1) % self.n + 1) * self.span,
+                                            self.end + self._days, self.ayan_off)
+        return self._next_end
+
+    def advance(self):
+        self.idx = (self.idx + 1) % self.n
+        self._prev_start, self.start = self.start, self.end
+        self.end = self.next_end() if self._next_end is not None else find_limb_time(
+            self.kind, (self.idx + 1) * self.span, self.start + self._days, self.ayan_off)
+        self._next_end = None
+        self._days = self.end - self.start
+
+def _limb_info(kind: str, idx: int) -> dict:
+    if kind == "tithi":
+        return {"name": TITHI_NAMES[idx], "lord": TITHI_LORD_SEQ[idx % len(TITHI_LORD_SEQ)]}
+    if kind == "karana":
+        name = karana_name_from_num(idx + 1)
+        return {"name": name, "lord": KARANA_LORDS.get(name, "")}
+    if kind == "nakshatra":
+        return {"name": NAK[idx], "lord": NAK_LORD_SEQ[idx % len(NAK_LORD_SEQ)]}
+    return {"name": YOGA_NAMES[idx], "lord": YOGA_LORDS[idx]}
+
+def panchanga_calendar(lat: float, lon: float, tz_name: str, date_from, date_to,
+                       ayan_off: float = NK_AYAN_OFFSET_JH):
+    """
+    Генератор: по един ред на ден (date_from..date_to включително) с вара,
+    изгрев, частите в момента на изгрева и всички преходи до следващия изгрев.
+    При липса на изгрев (полярни ширини) денят започва в местна полунощ.
+    """
+    _swe_ready()
+    tz = _safe_zoneinfo(tz_name)
+
+    def day_start(d):
+        midnight = datetime(d.year, d.month, d.day, tzinfo=tz)
+        jd0 = JD_UNIX_EPOCH + midnight.timestamp() / 86400.0
+        rise = sunrise_jd(jd0, lat, lon)
+        # изгревът трябва да е в същия граждански ден
+        if rise is not None and rise - jd0 >= 1.0:
+            rise = None
+        return (rise if rise is not None else jd0), rise is not None
+
+    d = date_from
+    start, has_rise = day_start(d)
+    walkers = {
+        "nakshatra": _LimbWalker("nakshatra", 360.0 / 27.0, 27, start, ayan_off),
+        "yoga": _LimbWalker("yoga", 360.0 / 27.0, 27, start, ayan_off),
+        "karana": _LimbWalker("karana", 6.0, 60, start, ayan_off),
+    }
+    karana = walkers["karana"]
+
+    while d <= date_to:
+        nd = d + timedelta(days=1)
+        nstart, n_has_rise = day_start(nd)
+
+        row = {"tithi": None}
+        transitions = []
+        for kind, w in walkers.items():
+            while w.end <= start:
+                w.advance()
+            row[kind] = dict(_limb_info(kind, w.idx),
+                             start=jd_to_datetime(w.start, tz).isoformat(),
+                             end=jd_to_datetime(w.end, tz).isoformat())
+            if kind == "karana":
+                # титхи = две карани: четна карана я започва, нечетна я завършва
+                t_start, t_end = ((w.start, w.next_end()) if w.idx % 2 == 0 else (w.prev_start(), w.end))
+                row["tithi"] = dict(_limb_info("tithi", w.idx // 2),
+                                    start=jd_to_datetime(t_start, tz).isoformat(),
+                                    end=jd_to_datetime(t_end, tz).isoformat())
+            # преходите до следващия изгрев; walker-ът остава на интервала, който го съдържа
+            while w.end < nstart:
+                at = w.end
+                w.advance()
+                if w is karana and w.idx % 2 == 0:
+                    transitions.append((at, "tithi", w.idx // 2))
+                transitions.append((at, kind, w.idx))
+
+        transitions.sort(key=lambda x: x[0])
+        wd = d.weekday()
+        yield {
+            "date": d.isoformat(),
+            "vara": {"name": VARA_NAMES[wd], "lord": VARA_LORDS[wd]},
+            "sunrise": (jd_to_datetime(start, tz).isoformat() if has_rise else None),
+            **row,
+            "transitions": [
+                dict(_limb_info(kind, idx), limb=kind, at=jd_to_datetime(at, tz).isoformat())
+                for at, kind, idx in transitions
+            ],
+        }
+
+        d, start, has_rise = nd, nstart, n_has_rise
+
+# ---------- SUNRISE / VEDIC DAY ----------
+# Ведическият ден (вара) започва с изгрева: раждане преди изгрева е в
+# предишния ден. Изгревът/залезът се смятат на двата ръба (по ширина) на клетка
+# NK_SUN_CELL_DEG × NK_SUN_CELL_DEG в средата ѝ по дължина и се пазят в SUN_CACHE
+# по (клетка, зона, дата); за точката – линейно по ширината и 4 мин./° по
+# дължината (грешка ~0.1 s до 60°, секунди до ~64°, повече край полярния кръг,
+# където изгревът е много чувствителен към ширината).
+# precompute_sun_year() пълни кеша за цяла година наведнъж
+# (NK_SUN_PRECOMPUTE="lat,lon;…" – при warm-up, за текущата година).
+VARA_FROM_SUNRISE = os.getenv("NK_VARA_SUNRISE", "1") == "1"
+SUN_CELL_DEG = float(os.getenv("NK_SUN_CELL_DEG", "0.05"))
+SUN_CACHE = _LRUCache(int(os.getenv("NK_SUN_CACHE_SIZE", "65536")))
+SUN_PRECOMPUTE = [tuple(float(x) for x in loc.split(",")[:2])
+                  for loc in os.getenv("NK_SUN_PRECOMPUTE", "").split(";") if loc.strip()]
+
+def sunset_jd(jd_start: float, lat: float, lon: float):
+    """Първият залез след jd_start (JD UT) или None (полярен ден/нощ)."""
+    return sunrise_jd(jd_start, lat, lon, rsmi=swe.CALC_SET)
+
+def _sun_cell(lat: float, lon: float) -> tuple:
+    """(индекси на клетката, ширините на южния и северния ѝ ръб, дължината на центъра)."""
+    ci = int(lat // SUN_CELL_DEG)
+    cj = int(lon // SUN_CELL_DEG)
+    lat_lo = max(-89.99, min(89.99, ci * SUN_CELL_DEG))
+    lat_hi = max(-89.99, min(89.99, (ci + 1) * SUN_CELL_DEG))
+    return (ci, cj), lat_lo, lat_hi, (cj + 0.5) * SUN_CELL_DEG
+
+def _sun_edge(jd0: float, lat: float, lon: float) -> tuple:
+    rise = sunrise_jd(jd0, lat, lon)
+    if rise is not None and rise - jd0 >= 1.0:         # изгревът трябва да е в същия ден
+        rise = None
+    return rise, (sunset_jd(rise, lat, lon) if rise is not None else None)
+
+def sun_times(lat: float, lon: float, tz, d) -> tuple:
+    """(изгрев, залез) в JD UT за гражданската дата d в зона tz; None при полярен ден/нощ."""
+    cell, lat_lo, lat_hi, clon = _sun_cell(lat, lon)
+    key = (cell, str(tz), d.toordinal())
+    hit = SUN_CACHE.get(key, None)
+    if hit is None:
+        _swe_ready()
+        jd0 = JD_UNIX_EPOCH + datetime(d.year, d.month, d.day, tzinfo=tz).timestamp() / 86400.0
+        hit = _sun_edge(jd0, lat_lo, clon) + _sun_edge(jd0, lat_hi, clon)
+        SUN_CACHE.put(key, hit)
+    # по ширината – линейно между ръбовете на клетката; по дължината – 4 мин./° (на изток → по-рано)
+    f = (lat - lat_lo) / (lat_hi - lat_lo) if lat_hi > lat_lo else 0.0
+    shift = -(lon - clon) / 360.0
+    out = []
+    for lo, hi in ((hit[0], hit[2]), (hit[1], hit[3])):
+        if lo is None or hi is None:
+            t = lo if hi is None else hi if lo is None else None
+            out.append(None if t is None else t + shift)
+        else:
+            out.append(lo + f * (hi - lo) + shift)
+    return tuple(out)
+
+def vedic_day(jd: float, dt_local, lat: float, lon: float) -> dict:
+    """
+    Ведическият ден на момента jd: {"date", "weekday" (0=пон.), "sunrise",
+    "sunset", "next_sunrise"} (JD UT или None). Преди изгрева – предишният ден;
+    без изгрев (полярни ширини) – гражданският ден.
+    """
+    tz = dt_local.tzinfo or timezone.utc
+    d = dt_local.date()
+    rise, sset = sun_times(lat, lon, tz, d)
+    if rise is not None and jd < rise:
+        next_rise = rise
+        d = d - timedelta(days=1)
+        rise, sset = sun_times(lat, lon, tz, d)
+    else:
+        next_rise = sun_times(lat, lon, tz, d + timedelta(days=1))[0]
+    return {"date": d, "weekday": d.weekday(), "sunrise": rise, "sunset": sset, "next_sunrise": next_rise}
+
+def sun_day_info(day: dict, tz) -> dict:
+    """Изгрев/залез (ISO) и продължителност на деня и нощта (мин.) за Panchanga."""
+    def minutes(a, b):
+        return round((b - a) * 1440.0, 2) if a is not None and b is not None else None
+    return {
+        "sunrise": jd_to_datetime(day["sunrise"], tz).isoformat() if day["sunrise"] is not None else None,
+        "sunset": jd_to_datetime(day["sunset"], tz).isoformat() if day["sunset"] is not None else None,
+        "day_minutes": minutes(day["sunrise"], day["sunset"]),
+        "night_minutes": minutes(day["sunset"], day["next_sunrise"]),
+    }
+
+def precompute_sun_year(lat: float, lon: float, tz_name: str, year: int) -> int:
+    """Пълни SUN_CACHE за клетката на (lat, lon) за цялата година (+1 ден за нощта на 31.12)."""
+    tz = _safe_zoneinfo(tz_name)
+    d = datetime(year, 1, 1).date()
+    end = datetime(year + 1, 1, 1).date()
+    n = 0
+    while d <= end:
+        sun_times(lat, lon, tz, d)
+        d += timedelta(days=1)
+        n += 1
+    return n
+
 # ---------- VIMSHOTTARI DASHA ----------
 
 # редът на лордовете (съвпада с господарите на накшатри)
@@ -550,7 +1206,6 @@ def years_to_days(y: float) -> float:
     # return y * 365.2425
 
 def add_days(dt, days: float):
-    from datetime import timedelta
     return dt + timedelta(days=days)
 
 def dasha_order_from(start_lord: str):
@@ -558,88 +1213,229 @@ def dasha_order_from(start_lord: str):
     i = DASHA_SEQ.index(start_lord)
     return DASHA_SEQ[i:] + DASHA_SEQ[:i]
 
-def vimsottari_generate(birth_dt_utc: datetime, moon_lon_sid: float, horizon_years: float = 120.0):
+_US = timedelta(microseconds=1)
+_UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _years_us(y: float) -> int:
+    """Години → цели микросекунди (закръгляне като timedelta)."""
+    return timedelta(days=years_to_days(y)) // _US
+
+def _us_to_dt(us: int) -> datetime:
+    return _UNIX_EPOCH + timedelta(microseconds=us)
+
+def _dt_to_us(dt: datetime) -> int:
+    return (dt - _UNIX_EPOCH) // _US
+
+def dasha_children(lord: str, start_us: int, years: float):
     """
-    Генерира Вимшоттари до 'horizon_years' от раждането.
-    Връща списък от махадаши с антар-даши вътре (2-ро ниво).
+    Под-периодите на период (lord, start_us, years): (лорд, начало, край, години).
+    Границите се смятат от началото на родителя (без натрупване на грешка).
     """
-    # начален лорд според лунната накшатра
+    cum = 0.0
+    for s_lord in dasha_order_from(lord):
+        sub_y = years * (DASHA_YEARS[s_lord] / 120.0)   # дял от 120-годишния цикъл
+        yield s_lord, start_us + _years_us(cum), start_us + _years_us(cum + sub_y), sub_y
+        cum += sub_y
+
+def _dasha_balance(moon_lon_sid: float):
+    """(начален лорд, преминал дял 0..1) според лунната накшатра."""
     nk_idx = nak_index_from_lon(moon_lon_sid)
     start_lord = DASHA_SEQ[nk_idx % 9]
-
-    # степен в текущата накшатра → остатък от първата махадаша
     start_of_nk = nk_idx * SID_NAK_SPAN
     passed_in_nk = ((moon_lon_sid % 360.0) - start_of_nk) % SID_NAK_SPAN
-    frac = passed_in_nk / SID_NAK_SPAN            # 0..1 преминал дял
-    remain_frac = 1.0 - frac
+    return start_lord, passed_in_nk / SID_NAK_SPAN
 
+def vimsottari_generate(birth_dt_utc: datetime, moon_lon_sid: float, horizon_years: float = 120.0):
+    """
+    Генерира Вимшоттари до 'horizon_years' от раждането.
+    Връща списък от махадаши с антар-даши вътре (2-ро ниво).
+    Форматът е този на /calculate (първата махадаша с пълни ISO моменти, останалите –
+    с дати; антар-дашите тръгват от началото на махадашата, а при следващите – от
+    датата ѝ, и за първата ползват пълната ѝ дължина). За по-дълбоки нива и
+    прозорци във времето – VimshottariDasha.
+    """
+    start_lord, frac = _dasha_balance(moon_lon_sid)
     order = dasha_order_from(start_lord)
 
-    out = []
-    t0 = birth_dt_utc
-    age0 = 0.0
-
-    # първа махадаша – остатък
-    first_y = DASHA_YEARS[start_lord] * remain_frac
-    t1 = add_days(t0, years_to_days(first_y))
-    out.append({
-        "lord": start_lord,
-        "start": t0.isoformat(timespec="seconds"),
-        "end":   t1.isoformat(timespec="seconds"),
-        # предишно
-        # "start": t0.date().isoformat(),
-        # "end":   t1.date().isoformat(),
-        "age_start": age0,
-        "age_end":   age0 + first_y,
-        "antar": []  # попълваме по-долу
-    })
-    # следващи махадаши
-    cur_t = t1
-    cur_age = age0 + first_y
-    # въртим цикъл докато стигнем хоризонта
+    # махадаши като (лорд, начало µs, край µs, възраст в началото, години)
+    t0 = _dt_to_us(birth_dt_utc)
+    first_y = DASHA_YEARS[start_lord] * (1.0 - frac)
+    mahas = [(start_lord, t0, t0 + _years_us(first_y), 0.0, first_y)]
+    cur_t = mahas[0][2]
+    cur_age = first_y
     k = 1
     while cur_age < horizon_years + 1e-6:
         lord = order[k % 9]
         dur_y = float(DASHA_YEARS[lord])
-        start = cur_t
-        end   = add_days(start, years_to_days(dur_y))
-        out.append({
-            "lord": lord,
-            "start": start.date().isoformat(),
-            "end":   end.date().isoformat(),
-            "age_start": cur_age,
-            "age_end":   cur_age + dur_y,
-            "antar": []
-        })
+        end = cur_t + _years_us(dur_y)
+        mahas.append((lord, cur_t, end, cur_age, dur_y))
         cur_t = end
         cur_age += dur_y
         k += 1
 
-    # антар-даши за всяка махадаша
-    for row in out:
-        m_lord = row["lord"]
-        m_years = DASHA_YEARS[m_lord]
-        # редът на под-лордове започва от лорда на махадашата
-        sub_order = dasha_order_from(m_lord)
-        sub_start = datetime.fromisoformat(row["start"])
-        sub_d = 0.0
-        antar_rows = []
-        for s_lord in sub_order:
-            share = DASHA_YEARS[s_lord] / 120.0      # дял от 120-годишния цикъл
-            sub_y = m_years * share                  # години на антрадaша
-            s0 = add_days(sub_start, years_to_days(sub_d))
-            s1 = add_days(sub_start, years_to_days(sub_d + sub_y))
-            antar_rows.append({
-                "lord": s_lord,
-                "start": s0.date().isoformat(),
-                "end":   s1.date().isoformat(),
-                "years": sub_y
-            })
-            sub_d += sub_y
-        row["antar"] = antar_rows
-
+    tz = birth_dt_utc.tzinfo
+    out = []
+    for i, (lord, start, end, age, dur_y) in enumerate(mahas):
+        if i == 0:
+            s_dt = _us_to_dt(start).astimezone(tz)
+            row_start = s_dt.isoformat(timespec="seconds")
+            row_end = _us_to_dt(end).astimezone(tz).isoformat(timespec="seconds")
+            base = start - start % 1_000_000    # началото, както е записано (до секунда)
+        else:
+            s_date = _us_to_dt(start).astimezone(tz).date()
+            row_start = s_date.isoformat()
+            row_end = _us_to_dt(end).astimezone(tz).date().isoformat()
+            base = _dt_to_us(datetime(s_date.year, s_date.month, s_date.day, tzinfo=timezone.utc))
+        out.append({
+            "lord": lord,
+            "start": row_start,
+            "end": row_end,
+            "age_start": age,
+            "age_end": age + dur_y,
+            "antar": [
+                {
+                    "lord": s_lord,
+                    "start": _us_to_dt(s0).date().isoformat(),
+                    "end": _us_to_dt(s1).date().isoformat(),
+                    "years": sub_y,
+                }
+                for s_lord, s0, s1, sub_y in dasha_children(lord, base, DASHA_YEARS[lord])
+            ],
+        })
     return out
 
+class VimshottariDasha:
+    """
+    Лениво Вимшоттари до 5 нива (маха → прана). Периодите се пазят като цели
+    микросекунди от Unix епохата; под-нивата се разгръщат само за периодите,
+    които попадат в заявения прозорец.
+
+        vd = VimshottariDasha(dt_utc, moon_lon)
+        for level, lords, start_us, end_us, years in vd.periods(t0_us, t1_us, depth=3): ...
+
+    Първата махадаша е с пълната си дължина (започва преди раждането – с
+    изминалия дял), затова и под-периодите ѝ са на истинските си места.
+    """
+
+    LEVELS = ("maha", "antar", "pratyantar", "sookshma", "prana")
+
+    def __init__(self, birth_dt_utc: datetime, moon_lon_sid: float, horizon_years: float = 120.0):
+        start_lord, frac = _dasha_balance(moon_lon_sid)
+        self.birth_us = _dt_to_us(birth_dt_utc)
+        self.start_lord = start_lord
+        self.balance_years = DASHA_YEARS[start_lord] * (1.0 - frac)
+        self.end_us = self.birth_us + _years_us(horizon_years)
+        # махадаши като (лорд, начало, край, години) – до хоризонта
+        t = self.birth_us - _years_us(DASHA_YEARS[start_lord] * frac)
+        self.mahas = []
+        for i, lord in enumerate(itertools.cycle(dasha_order_from(start_lord))):
+            if t >= self.end_us and i:
+                break
+            years = float(DASHA_YEARS[lord])
+            end = t + _years_us(years)
+            self.mahas.append((lord, t, end, years))
+            t = end
+
+    def periods(self, from_us: int | None = None, to_us: int | None = None, depth: int = 1):
+        """
+        Генератор (ниво, лордове от махата надолу, начало, край, години) в ред
+        "родител преди децата" за периодите, които застъпват [from_us, to_us).
+        """
+        lo = self.birth_us if from_us is None else from_us
+        hi = self.end_us if to_us is None else to_us
+        depth = max(1, min(len(self.LEVELS), int(depth)))
+
+        def walk(level, path, rows):
+            for lord, start, end, years in rows:
+                if end <= lo or start >= hi:
+                    continue
+                lords = path + (lord,)
+                yield level, lords, start, end, years
+                if level + 1 < depth:
+                    yield from walk(level + 1, lords, dasha_children(lord, start, years))
+
+        return walk(0, (), self.mahas)
+
+    def tree(self, from_us: int | None = None, to_us: int | None = None, depth: int = 1,
+             max_periods: int | None = None) -> list:
+        """Вложените периоди (ключ "sub") от periods(), готови за JSON."""
+        root = []
+        stack = []   # stack[level] = списъкът, в който се добавят деца на това ниво
+        for n, (level, lords, start, end, years) in enumerate(self.periods(from_us, to_us, depth), 1):
+            if max_periods is not None and n > max_periods:
+                raise ValueError(f"твърде много периоди (> {max_periods}) – стеснете прозореца или дълбочината")
+            row = {
+                "level": self.LEVELS[level],
+                "lord": lords[-1],
+                "start": _us_to_dt(start).isoformat(timespec="seconds"),
+                "end": _us_to_dt(end).isoformat(timespec="seconds"),
+                "years": years,
+            }
+            del stack[level:]
+            (stack[-1] if stack else root).append(row)
+            if level + 1 < depth:
+                row["sub"] = []
+                stack.append(row["sub"])
+        return root
+
+# ---- текущ период: двоично търсене по кумулативните граници на цикъла ----
+# Цикълът от 120 г. в каноничния ред DASHA_SEQ: DASHA_CUM[i] = години до лорд i.
+# Под-периодите на лорд i следват същия ред, започвайки от i, с дялове
+# DASHA_YEARS/120 – затова всяко ниво е същото търсене в мащабирани координати.
+DASHA_LEN = [float(DASHA_YEARS[l]) for l in DASHA_SEQ]
+DASHA_CUM = [0.0]
+for _y in DASHA_LEN:
+    DASHA_CUM.append(DASHA_CUM[-1] + _y)
+DASHA_CYCLE = DASHA_CUM[-1]          # 120
+YEAR_US = years_to_days(1.0) * 86400e6
+
+def dasha_current(birth_us, moon_lon_sid, at_us, depth: int = 3):
+    """
+    Активните периоди (маха … до 'depth' ниво) за n раждания × m момента.
+
+    birth_us, moon_lon_sid – масиви (n,); at_us – масив (m,) (µs от Unix епохата).
+    Връща (lord_idx, start_us, end_us) с форма (n, m, depth); lord_idx е индекс
+    в DASHA_SEQ. Без генериране на таблицата – по едно searchsorted на ниво.
+    """
+    if np is None:
+        raise RuntimeError("dasha_current изисква numpy")
+    cum = np.asarray(DASHA_CUM)
+    length = np.asarray(DASHA_LEN)
+    birth = np.asarray(birth_us, dtype=np.float64)[:, None]
+    moon = np.asarray(moon_lon_sid, dtype=np.float64)[:, None] % 360.0
+    at = np.asarray(at_us, dtype=np.float64)[None, :]
+
+    nk = np.floor(moon / SID_NAK_SPAN)
+    lord0 = (nk % 9).astype(np.int64)
+    # позиция в цикъла (години) в момента на раждането и в търсените моменти
+    x_birth = cum[lord0] + length[lord0] * ((moon - nk * SID_NAK_SPAN) / SID_NAK_SPAN)
+    x = x_birth + (at - birth) / YEAR_US
+    turn = np.floor(x / DASHA_CYCLE)
+    pos = x - turn * DASHA_CYCLE
+
+    shape = np.broadcast(birth, at).shape + (depth,)
+    lords = np.empty(shape, dtype=np.int64)
+    starts = np.empty(shape)
+    ends = np.empty(shape)
+
+    i = np.clip(np.searchsorted(cum, pos, side="right") - 1, 0, 8)
+    p_start = birth + (turn * DASHA_CYCLE + cum[i] - x_birth) * YEAR_US
+    p_years = length[i]
+    for level in range(depth):
+        if level:
+            # позиция в родителя, мащабирана до 120 г. и завъртяна към лорда му
+            q = (pos - cum[i]) / length[i] * DASHA_CYCLE
+            pos = (cum[i] + q) % DASHA_CYCLE
+            j = np.clip(np.searchsorted(cum, pos, side="right") - 1, 0, 8)
+            off = (cum[j] - cum[i]) % DASHA_CYCLE
+            p_start = p_start + off / DASHA_CYCLE * p_years * YEAR_US
+            p_years = p_years * length[j] / DASHA_CYCLE
+            i = j
+        lords[..., level] = i
+        starts[..., level] = p_start
+        ends[..., level] = p_start + p_years * YEAR_US
+    return lords, np.rint(starts).astype(np.int64), np.rint(ends).astype(np.int64)
+
 def houses_safe(jd, lat, lon, flags=None, hsys=b'P'):
     """
     Унифициран достъп до houses_ex / houses за различни версии на pyswisseph.
@@ -655,34 +1451,1535 @@ def houses_safe(jd, lat, lon, flags=None, hsys=b'P'):
         except Exception:
             cusps, ascmc = swe.houses(jd, lat, lon, hsys)
             return (cusps, ascmc)
+# ---------- VARGAS (D1–D60) ----------
+# Всяка варга е таблица знак × сегмент → знак (по Парашара), построена веднъж.
+# Сегментите са равни части от 30°; за D30 (тримшамша) – по 1°, защото
+# границите ѝ са неравни (5/10/18/25° и огледално за четните знаци).
+VARGA_DIVISIONS = (1, 2, 3, 4, 7, 9, 10, 12, 16, 20, 24, 27, 30, 40, 45, 60)
+
+def _varga_sign(division: int, s: int, k: int) -> int:
+    """Знакът в D<division> за сегмент k (0-based) на знак s (0 = Овен)."""
+    odd = s % 2 == 0                 # Овен, Близнаци … са нечетни знаци
+    quality = s % 3                  # 0 подвижен, 1 неподвижен, 2 двойствен
+    if division == 1:
+        return s
+    if division == 2:                # хора: Лъв / Рак
+        return (4 if k == 0 else 3) if odd else (3 if k == 0 else 4)
+    if division == 3:
+        return (s + 4 * k) % 12
+    if division == 4:
+        return (s + 3 * k) % 12
+    if division == 7:
+        return (s + (0 if odd else 6) + k) % 12
+    if division == 9:                # от същия / 9-тия / 5-тия знак
+        return (s + (0, 8, 4)[quality] + k) % 12
+    if division == 10:
+        return (s + (0 if odd else 8) + k) % 12
+    if division == 12:
+        return (s + k) % 12
+    if division == 16:               # от Овен / Лъв / Стрелец
+        return ((0, 4, 8)[quality] + k) % 12
+    if division == 20:               # от Овен / Стрелец / Лъв
+        return ((0, 8, 4)[quality] + k) % 12
+    if division == 24:               # от Лъв / Рак
+        return ((4 if odd else 3) + k) % 12
+    if division == 27:               # от Овен / Рак / Везни / Козирог по стихия
+        return ((s % 4) * 3 + k) % 12
+    if division == 30:               # k = градус 0..29
+        if odd:
+            return 0 if k < 5 else 10 if k < 10 else 8 if k < 18 else 2 if k < 25 else 6
+        return 1 if k < 5 else 5 if k < 12 else 11 if k < 20 else 9 if k < 25 else 7
+    if division == 40:               # от Овен / Везни
+        return ((0 if odd else 6) + k) % 12
+    if division == 45:               # от Овен / Лъв / Стрелец
+        return ((0, 4, 8)[quality] + k) % 12
+    if division == 60:
+        return (s + k) % 12
+    raise ValueError(f"непозната варга D{division}")
+
+# D<n> → (брой сегменти, таблица[знак][сегмент])
+VARGA_TABLES = {
+    n: (p, tuple(tuple(_varga_sign(n, s, k) for k in range(p)) for s in range(12)))
+    for n in VARGA_DIVISIONS
+    for p in ((30 if n == 30 else n),)
+}
+VARGA_NP = {n: np.array(t, dtype=np.int64) for n, (_p, t) in VARGA_TABLES.items()} if np is not None else {}
+
 def deg_in_sign(lon: float) -> float:
     return lon % 30.0
 
-def navamsa_sign_index(sign_idx: int, deg_in: float) -> int:
+def varga_sign_index(lon: float, division: int) -> int:
+    """Индекс (0..11) на знака в D<division> за сидерален лонгитуд."""
+    parts, table = VARGA_TABLES[division]
+    seg = min(parts - 1, int(deg_in_sign(lon) / (30.0 / parts)))
+    return table[int((lon % 360.0) // 30)][seg]
+
+def varga_sign_indices(lons, division: int):
     """
-    D9 (Навамша) – правило на Парашара:
-    - Подвижни (Овен, Рак, Везни, Козирог): старт от същия знак
-    - Неподвижни (Телец, Лъв, Скорпион, Водолей): старт от 9-тия от себе си (+8)
-    - Двойствени (Близнаци, Дева, Стрелец, Риби): старт от 5-тия от себе си (+4)
-    После броим пада (0..8) и въртим от стартовия знак.
+    Векторна varga_sign_index: лонгитуди с произволна форма (напр. карти × тела)
+    → масив от индекси на знаци със същата форма.
     """
-    pada = int(deg_in / (30.0 / 9.0))  # 0..8
-
-    if sign_idx in (0, 3, 6, 9):         # подвижни
-        start = sign_idx
-    elif sign_idx in (1, 4, 7, 10):      # неподвижни
-        start = (sign_idx + 8) % 12
-    else:                                # двойствени
-        start = (sign_idx + 4) % 12
+    parts, _table = VARGA_TABLES[division]
+    lons = np.asarray(lons, dtype=np.float64)
+    sign = np.floor_divide(np.remainder(lons, 360.0), 30.0).astype(np.int64)
+    seg = np.minimum(parts - 1, (np.remainder(lons, 30.0) / (30.0 / parts)).astype(np.int64))
+    return VARGA_NP[division][sign, seg]
 
-    return (start + pada) % 12
+def navamsa_sign_index(sign_idx: int, deg_in: float) -> int:
+    """D9 (Навамша) по Парашара – вж. _varga_sign."""
+    return VARGA_TABLES[9][1][sign_idx][min(8, int(deg_in / (30.0 / 9.0)))]
 
 def d9_sign_name_from_lon(lon: float) -> str:
     """Връща името на знака (от SIGNS) за даден сидерален лонгитуд в D9."""
-    sidx = int((lon % 360.0) // 30)
-    d_in = deg_in_sign(lon)
-    d9_idx = navamsa_sign_index(sidx, d_in)
-    return SIGNS[d9_idx]
+    return SIGNS[varga_sign_index(lon, 9)]
+
+def parse_vargas(value) -> tuple:
+    """
+    Параметърът vargas: "all", "D2,D10", ["D2", 10] … → подредени номера.
+    Празно/липсващо → () (секцията "Vargas" не се смята).
+    """
+    if not value:
+        return ()
+    if isinstance(value, str):
+        if value.strip().lower() == "all":
+            return VARGA_DIVISIONS
+        value = value.split(",")
+    out = set()
+    for v in value:
+        v = str(v).strip().upper().lstrip("D")
+        if not v.isdigit() or int(v) not in VARGA_TABLES:
+            raise ValueError(f"непозната варга: {v}")
+        out.add(int(v))
+    return tuple(sorted(out))
+
+def compute_vargas(planets: list, asc: float, divisions) -> dict:
+    """
+    {"D<n>": {"Ascendant": {"sign"}, "Planets": [{"planet", "sign", "retrograde"}]}} –
+    всички тела и лагната наведнъж (едно таблично търсене на варга).
+    """
+    lons = [float(p["longitude"]) for p in planets] + [float(asc)]
+    out = {}
+    for n in divisions:
+        if np is not None:
+            idx = varga_sign_indices(lons, n).tolist()
+        else:
+            idx = [varga_sign_index(lon, n) for lon in lons]
+        out[f"D{n}"] = {
+            "Ascendant": {"sign": SIGNS[idx[-1]]},
+            "Planets": [
+                {"planet": p["planet"], "sign": SIGNS[i], "retrograde": bool(p.get("retrograde"))}
+                for p, i in zip(planets, idx)
+            ],
+        }
+    return out
+
+# ---------- ASHTAKOOTA ----------
+# Съвместимост по 36 гуни от Луните на двамата. Всичките 8 куты зависят само от
+# накшатрата и знака на Луната, а знакът следва от падата (по 9 пади в знак), затова
+# цялата таблица е 108 × 108 пади (мъж × жена) и се смята веднъж (koota_matrix).
+# Вашя дели Стрелец и Козирог на половини по 15°; там по една пада минава през
+# границата и решава средата ѝ (точно 15° → втората половина). Без отмените на
+# доши (нади/бхакут) – чистият сбор от 8-те куты.
+KOOTA_MAX = {"varna": 1, "vashya": 2, "tara": 3, "yoni": 4, "graha_maitri": 5, "gana": 6, "bhakoot": 7, "nadi": 8}
+PADA_SPAN = 360.0 / 108.0
+
+# варна на знака: 3 брамин, 2 кшатрия, 1 вайшя, 0 шудра
+SIGN_VARNA = [2, 1, 0, 3, 2, 1, 0, 3, 2, 1, 0, 3]
+
+# вашя: 0 четириного, 1 човек, 2 воден, 3 див, 4 насекомо; (мъж, жена) → точки
+VASHYA_POINTS = [
+    [2, 1, 1, 0.5, 1],
+    [1, 2, 0.5, 0, 1],
+    [1, 0.5, 2, 1, 1],
+    [0.5, 0, 1, 2, 0],
+    [1, 1, 1, 0, 2],
+]
+# групата на знака; (първа, втора) – различна за двете половини на знака
+SIGN_VASHYA = [0, 0, 1, 2, 3, 1, 1, 4, (1, 0), (0, 2), 1, 2]
+
+# йони (животно) на накшатрата: 0 кон, 1 слон, 2 овца, 3 змия, 4 куче, 5 котка, 6 плъх,
+# 7 крава, 8 бивол, 9 тигър, 10 елен, 11 маймуна, 12 мангуста, 13 лъв
+NAK_YONI = [0, 1, 2, 3, 3, 4, 5, 2, 5, 6, 6, 7, 8, 9, 8, 9, 10, 10, 4, 11, 12, 11, 13, 0, 13, 7, 1]
+YONI_POINTS = [
+    [4, 2, 2, 3, 2, 2, 2, 1, 0, 1, 3, 3, 2, 1],
+    [2, 4, 3, 3, 2, 2, 2, 2, 3, 1, 2, 3, 2, 0],
+    [2, 3, 4, 2, 1, 2, 1, 3, 3, 1, 2, 0, 3, 1],
+    [3, 3, 2, 4, 2, 1, 1, 1, 1, 2, 2, 2, 0, 2],
+    [2, 2, 1, 2, 4, 2, 1, 2, 2, 1, 0, 2, 1, 1],
+    [2, 2, 2, 1, 2, 4, 0, 2, 2, 1, 3, 3, 2, 1],
+    [2, 2, 1, 1, 1, 0, 4, 2, 2, 2, 2, 2, 1, 2],
+    [1, 2, 3, 1, 2, 2, 2, 4, 3, 0, 3, 2, 2, 1],
+    [0, 3, 3, 1, 2, 2, 2, 3, 4, 1, 2, 2, 2, 1],
+    [1, 1, 1, 2, 1, 1, 2, 0, 1, 4, 1, 1, 2, 1],
+    [3, 2, 2, 2, 0, 3, 2, 3, 2, 1, 4, 2, 2, 1],
+    [3, 3, 0, 2, 2, 3, 2, 2, 2, 1, 2, 4, 3, 2],
+    [2, 2, 3, 0, 1, 2, 1, 2, 2, 2, 2, 3, 4, 2],
+    [1, 0, 1, 2, 1, 1, 2, 1, 1, 1, 1, 2, 2, 4],
+]
+
+# естествено приятелство: граха → (приятели, врагове); останалите са неутрални
+NATURAL_FRIENDSHIP = {
+    "Слънце":   ({"Луна", "Марс", "Юпитер"}, {"Венера", "Сатурн"}),
+    "Луна":     ({"Слънце", "Меркурий"}, set()),
+    "Марс":     ({"Слънце", "Луна", "Юпитер"}, {"Меркурий"}),
+    "Меркурий": ({"Слънце", "Венера"}, {"Луна"}),
+    "Юпитер":   ({"Слънце", "Луна", "Марс"}, {"Меркурий", "Венера"}),
+    "Венера":   ({"Меркурий", "Сатурн"}, {"Слънце", "Луна"}),
+    "Сатурн":   ({"Меркурий", "Венера"}, {"Слънце", "Луна", "Марс"}),
+}
+# (отношение на единия, на другия): 2 приятел, 1 неутрален, 0 враг
+MAITRI_POINTS = {(2, 2): 5, (2, 1): 4, (1, 1): 3, (2, 0): 1, (1, 0): 0.5, (0, 0): 0}
+
+# гана: 0 дева, 1 манушя, 2 ракшаса; (мъж, жена) → точки
+NAK_GANA = [0, 1, 2, 1, 0, 1, 0, 0, 2, 2, 1, 1, 0, 2, 0, 2, 0, 2, 2, 1, 1, 0, 2, 2, 1, 1, 0]
+GANA_POINTS = [[6, 6, 0], [5, 6, 0], [1, 0, 6]]
+
+# нади: ади / мадхя / антя – зигзаг през накшатрите
+NAK_NADI = [(0, 1, 2, 2, 1, 0)[i % 6] for i in range(27)]
+
+def pada_index(lon: float) -> int:
+    """Сидерална дължина → пада 0..107 (накшатра = // 4, знак = // 9)."""
+    nak, pada = nak_pada(lon)
+    return NAK.index(nak) * 4 + pada - 1
+
+def _vashya_group(p: int) -> int:
+    group = SIGN_VASHYA[p // 9]
+    if isinstance(group, tuple):
+        mid = ((p % 9) + 0.5) * PADA_SPAN       # средата на падата в знака
+        group = group[0] if mid < 15.0 else group[1]
+    return group
+
+def _maitri_relation(a: str, b: str) -> int:
+    friends, enemies = NATURAL_FRIENDSHIP[a]
+    return 2 if b in friends else 0 if b in enemies else 1
+
+def koota_breakdown(boy: int, girl: int) -> dict:
+    """Точките по кути за Луна на мъжа в пада boy и на жената в пада girl (0..107)."""
+    bn, gn = boy // 4, girl // 4
+    bs, gs = boy // 9, girl // 9
+
+    tara = sum(1.5 for d in ((bn - gn) % 27, (gn - bn) % 27) if d % 9 not in (2, 4, 6))
+
+    bl, gl = SIGN_LORDS[bs], SIGN_LORDS[gs]
+    if bl == gl:
+        maitri = 5
+    else:
+        rel = sorted((_maitri_relation(bl, gl), _maitri_relation(gl, bl)), reverse=True)
+        maitri = MAITRI_POINTS[tuple(rel)]
+
+    out = {
+        "varna": 1 if SIGN_VARNA[bs] >= SIGN_VARNA[gs] else 0,
+        "vashya": VASHYA_POINTS[_vashya_group(boy)][_vashya_group(girl)],
+        "tara": tara,
+        "yoni": YONI_POINTS[NAK_YONI[bn]][NAK_YONI[gn]],
+        "graha_maitri": maitri,
+        "gana": GANA_POINTS[NAK_GANA[bn]][NAK_GANA[gn]],
+        "bhakoot": 0 if (gs - bs) % 12 in (1, 11, 4, 8, 5, 7) else 7,
+        "nadi": 0 if NAK_NADI[bn] == NAK_NADI[gn] else 8,
+    }
+    out["total"] = sum(out.values())
+    return out
+
+@lru_cache(maxsize=1)
+def koota_matrix():
+    """108 × 108 (мъж × жена) сбор в половинки точки (0..72) – uint8; без NumPy – списъци."""
+    rows = [[int(koota_breakdown(b, g)["total"] * 2) for g in range(108)] for b in range(108)]
+    if np is None:
+        return rows
+    return np.ascontiguousarray(np.array(rows, dtype=np.uint8))
+
+@lru_cache(maxsize=1)
+def koota_matrix_t():
+    """Транспонираната матрица (жена × мъж) – ред за профил-жена."""
+    m = koota_matrix()
+    if np is None:
+        return [list(col) for col in zip(*m)]
+    return np.ascontiguousarray(m.T)
+
+def koota_top(scores, k: int, min_score: int = 0):
+    """
+    Индексите на k-те най-добри (в половинки точки ≥ min_score), по точки низходящо,
+    при равни – по реда на добавяне. Точките са само 73 стойности → bincount вместо сортиране.
+    """
+    if np is None:
+        best = heapq.nlargest(k, ((s, -i) for i, s in enumerate(scores) if s >= min_score))
+        return [-i for _s, i in best]
+    counts = np.bincount(scores, minlength=73)
+    counts[:min_score] = 0
+    ge = np.cumsum(counts[::-1])[::-1]          # ge[c] = брой с точки ≥ c (и ≥ min_score)
+    cut = int(np.flatnonzero(ge >= k)[-1]) if ge[0] > k else min_score
+    hi = np.flatnonzero(scores > cut)
+    tie = np.flatnonzero(scores == cut)[:max(0, k - len(hi))]
+    idx = np.concatenate([hi, tie])
+    return idx[np.argsort(-scores[idx].astype(np.int16), kind="stable")][:k]
+
+GENDERS = {"m": 0, "male": 0, "м": 0, "мъж": 0, "f": 1, "female": 1, "ж": 1, "жена": 1}
+
+def parse_gender(value) -> int:
+    g = GENDERS.get(str(value or "").strip().lower())
+    if g is None:
+        raise ValueError("gender: очаква се 'm' или 'f'")
+    return g
+
+class MatchPool:
+    """
+    Кандидатите на един пул: id → (пол, пада). За търсене – по един масив пади
+    (uint8) и списък id-та на пол, построени наново само след промяна.
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._sides = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, cid: str, gender: int, pada: int):
+        with self._lock:
+            self._items[cid] = (gender, pada)
+            self._sides = None
+
+    def remove(self, cid: str) -> bool:
+        with self._lock:
+            found = self._items.pop(cid, None) is not None
+            self._sides = None
+            return found
+
+    def counts(self) -> dict:
+        sides = self._get_sides()
+        return {"m": len(sides[0][0]), "f": len(sides[1][0])}
+
+    def _get_sides(self):
+        with self._lock:
+            if self._sides is None:
+                sides = ([], []), ([], [])
+                for cid, (gender, pada) in self._items.items():
+                    sides[gender][0].append(cid)
+                    sides[gender][1].append(pada)
+                self._sides = tuple(
+                    (ids, np.array(padas, dtype=np.uint8) if np is not None else padas) for ids, padas in sides)
+            return self._sides
+
+    def top(self, gender: int, pada: int, k: int, min_score: float = 0.0) -> tuple:
+        """Най-добрите k от другия пол за профил (gender, pada) → ([(id, пада, точки)], брой оценени)."""
+        ids, padas = self._get_sides()[1 - gender]
+        row = (koota_matrix() if gender == 0 else koota_matrix_t())[pada]
+        if np is not None:
+            scores = row[padas]
+        else:
+            scores = [row[p] for p in padas]
+        best = koota_top(scores, k, int(-(-min_score * 2 // 1)))
+        return [(ids[i], int(padas[i]), int(scores[i]) / 2) for i in best], len(ids)
+
+class MatchStore:
+    """Пуловете с кандидати; по желание копие в SQLite (NK_MATCH_DB), заредено при старт."""
+
+    def __init__(self, db_path: str | None = None):
+        self.pools = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            import sqlite3
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS match_candidates ("
+                " pool TEXT NOT NULL, id TEXT NOT NULL, gender INTEGER NOT NULL, pada INTEGER NOT NULL,"
+                " PRIMARY KEY (pool, id))"
+            )
+            for pool, cid, gender, pada in self._db.execute("SELECT pool, id, gender, pada FROM match_candidates"):
+                self.pool(pool).put(cid, gender, pada)
+
+    def pool(self, name: str) -> MatchPool:
+        with self._lock:
+            p = self.pools.get(name)
+            if p is None:
+                p = self.pools[name] = MatchPool()
+            return p
+
+    def put_many(self, name: str, rows: list):
+        """rows: [(id, пол, пада)]."""
+        p = self.pool(name)
+        for cid, gender, pada in rows:
+            p.put(cid, gender, pada)
+        if self._db is not None and rows:
+            with self._lock:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT OR REPLACE INTO match_candidates (pool, id, gender, pada) VALUES (?, ?, ?, ?)",
+                                     [(name, cid, gender, pada) for cid, gender, pada in rows])
+                self._db.execute("COMMIT")
+
+    def remove_many(self, name: str, ids: list) -> int:
+        p = self.pool(name)
+        n = sum(p.remove(cid) for cid in ids)
+        if self._db is not None and ids:
+            with self._lock:
+                self._db.executemany("DELETE FROM match_candidates WHERE pool = ? AND id = ?", [(name, c) for c in ids])
+        return n
+
+_MATCH = None
+_MATCH_LOCK = threading.Lock()
+
+def get_match() -> MatchStore:
+    """Лениво – зареждането от NK_MATCH_DB не забавя старта."""
+    global _MATCH
+    if _MATCH is None:
+        with _MATCH_LOCK:
+            if _MATCH is None:
+                _MATCH = MatchStore(os.getenv("NK_MATCH_DB") or None)
+    return _MATCH
+
+# ---------- STRENGTH (ASHTAKAVARGA / SHADBALA) ----------
+# Опционални секции "Ashtakavarga" и "Shadbala". Всяка карта дава ред входни
+# величини (strength_row); strength_sections() ги смята наведнъж за цял batch
+# с NumPy (карти × граха × …), без цикли по карти.
+#   Аштакаварга – таблици на биндутата (граха × 8 дарители × 12 дома от дарителя)
+#   Шадбала (вирупи) – стхана (уччха, саптаваргаджа, оджа-югма, кендради,
+#   дреккана), диг, кала (натоннатха, пакша, трибхага, вара, хора, аяна),
+#   чеща, найсаргика. Без дрик, юддха и абда/маса бала.
+STRENGTH_GRAHAS = ["Слънце", "Луна", "Марс", "Меркурий", "Юпитер", "Венера", "Сатурн"]
+_GRAHA_INDEX = {name: i for i, name in enumerate(STRENGTH_GRAHAS)}
+
+# биндута: граха → по дарител (седемте граха + лагна) домовете (1..12), броени от дарителя
+ASHTAKAVARGA_BINDUS = {
+    "Слънце":   ((1, 2, 4, 7, 8, 9, 10, 11), (3, 6, 10, 11), (1, 2, 4, 7, 8, 9, 10, 11),
+                 (3, 5, 6, 9, 10, 11, 12), (5, 6, 9, 11), (6, 7, 12), (1, 2, 4, 7, 8, 9, 10, 11),
+                 (3, 4, 6, 10, 11, 12)),
+    "Луна":     ((3, 6, 7, 8, 10, 11), (1, 3, 6, 7, 10, 11), (2, 3, 5, 6, 9, 10, 11),
+                 (1, 3, 4, 5, 7, 8, 10, 11), (1, 4, 7, 8, 10, 11, 12), (3, 4, 5, 7, 9, 10, 11),
+                 (3, 5, 6, 11), (3, 6, 10, 11)),
+    "Марс":     ((3, 5, 6, 10, 11), (3, 6, 11), (1, 2, 4, 7, 8, 10, 11), (3, 5, 6, 11),
+                 (6, 10, 11, 12), (6, 8, 11, 12), (1, 4, 7, 8, 9, 10, 11), (1, 3, 6, 10, 11)),
+    "Меркурий": ((5, 6, 9, 11, 12), (2, 4, 6, 8, 10, 11), (1, 2, 4, 7, 8, 9, 10, 11),
+                 (1, 3, 5, 6, 9, 10, 11, 12), (6, 8, 11, 12), (1, 2, 3, 4, 5, 8, 9, 11),
+                 (1, 2, 4, 7, 8, 9, 10, 11), (1, 2, 4, 6, 8, 10, 11)),
+    "Юпитер":   ((1, 2, 3, 4, 7, 8, 9, 10, 11), (2, 5, 7, 9, 11), (1, 2, 4, 7, 8, 10, 11),
+                 (1, 2, 4, 5, 6, 9, 10, 11), (1, 2, 3, 4, 7, 8, 10, 11), (2, 5, 6, 9, 10, 11),
+                 (3, 5, 6, 12), (1, 2, 4, 5, 6, 7, 9, 10, 11)),
+    "Венера":   ((8, 11, 12), (1, 2, 3, 4, 5, 8, 9, 11, 12), (3, 5, 6, 9, 11, 12), (3, 5, 6, 9, 11),
+                 (5, 8, 9, 10, 11), (1, 2, 3, 4, 5, 8, 9, 10, 11), (3, 4, 5, 8, 9, 10, 11),
+                 (1, 2, 3, 4, 5, 8, 9, 11)),
+    "Сатурн":   ((1, 2, 4, 7, 8, 10, 11), (3, 6, 11), (3, 5, 6, 10, 11, 12), (6, 8, 9, 10, 11, 12),
+                 (5, 6, 11, 12), (6, 11, 12), (3, 5, 6, 11), (1, 3, 4, 6, 10, 11)),
+}
+
+# точка на екзалтация (сидерален лонгитуд); дебилитацията е на 180°
+EXALTATION_LON = [10.0, 33.0, 298.0, 165.0, 95.0, 357.0, 200.0]
+# мулатрикона: (знак, от °, до °)
+MOOLATRIKONA = [(4, 0.0, 20.0), (1, 3.0, 30.0), (0, 0.0, 12.0), (5, 15.0, 20.0),
+                (8, 0.0, 10.0), (6, 0.0, 15.0), (10, 0.0, 20.0)]
+SAPTAVARGA = (1, 2, 3, 7, 9, 12, 30)
+# съставно отношение (естествено + временно, -2..2) → вирупи; своя знак 30, мулатрикона 45
+SAPTAVARGA_POINTS = {-2: 2.0, -1: 4.0, 0: 10.0, 1: 15.0, 2: 20.0}
+# дреккана, в която грахата получава 15: мъжки – 1-ва, неутрални – 2-ра, женски – 3-та
+DREKKANA_STRONG = [0, 2, 0, 1, 0, 2, 1]
+# диг бала: най-силна точка – 0 лагна, 1 MC, 2 десцендент, 3 IC
+DIG_STRONG = [1, 3, 1, 0, 0, 3, 2]
+NAISARGIKA = [60.0, 51.43, 17.14, 25.71, 34.29, 42.86, 8.57]
+# халдейски ред на хорите (от Сатурн надолу)
+HORA_ORDER = ["Сатурн", "Юпитер", "Марс", "Слънце", "Венера", "Меркурий", "Луна"]
+
+if np is not None:
+    # AV_TABLE[граха, дарител, дом-1] ∈ {0, 1}
+    AV_TABLE = np.zeros((7, 8, 12), dtype=np.int64)
+    for _g, _rows in ASHTAKAVARGA_BINDUS.items():
+        for _c, _houses in enumerate(_rows):
+            AV_TABLE[_GRAHA_INDEX[_g], _c, [h - 1 for h in _houses]] = 1
+    # естествено отношение на i към j: 1 приятел, 0 неутрален, -1 враг
+    NATURAL_REL = np.array([[1 if b in NATURAL_FRIENDSHIP[a][0] else -1 if b in NATURAL_FRIENDSHIP[a][1] else 0
+                             for b in STRENGTH_GRAHAS] for a in STRENGTH_GRAHAS], dtype=np.int64)
+    SIGN_LORD_INDEX = np.array([_GRAHA_INDEX[lord] for lord in SIGN_LORDS], dtype=np.int64)
+    VARA_LORD_INDEX = np.array([_GRAHA_INDEX[lord] for lord in VARA_LORDS], dtype=np.int64)
+    HORA_LORD_INDEX = np.array([_GRAHA_INDEX[g] for g in HORA_ORDER], dtype=np.int64)
+    VARA_HORA_START = np.array([HORA_ORDER.index(lord) for lord in VARA_LORDS], dtype=np.int64)
+    # временно отношение по разстоянието (0..11 знака): 2, 3, 4, 10, 11, 12-ти дом → приятел
+    TEMPORAL_REL = np.array([1 if d + 1 in (2, 3, 4, 10, 11, 12) else -1 for d in range(12)], dtype=np.int64)
+    SAPTAVARGA_LUT = np.array([SAPTAVARGA_POINTS[k] for k in range(-2, 3)])   # съставно + 2 → вирупи
+    _EXALT_NP = np.array(EXALTATION_LON)
+    _MT_SIGN, _MT_FROM, _MT_TO = (np.array(x) for x in zip(*MOOLATRIKONA))
+    _DREKKANA_NP = np.array(DREKKANA_STRONG)
+    _NAISARGIKA_NP = np.array(NAISARGIKA)
+    _FEMALE = np.isin(np.arange(7), (1, 5))               # Луна и Венера
+    _BENEFIC = np.array([False, True, False, True, True, True, False])
+    _AYANA_NORTH = np.array([1.0, -1.0, 1.0, 0.0, 1.0, 1.0, -1.0])   # 0 – Меркурий (|кранти|)
+
+def _fold(x):
+    """Ъгловото разстояние 0..180° (масиви)."""
+    return np.abs((np.asarray(x) + 180.0) % 360.0 - 180.0)
+
+def ashtakavarga(signs):
+    """
+    signs – [N, 8] знаци (0..11) на седемте граха (ред STRENGTH_GRAHAS) и лагната.
+    → (бхинна [N, 7, 12], сарва [N, 12]) по знаци Овен..Риби.
+    """
+    signs = np.asarray(signs, dtype=np.int64)
+    # дом на знака s от дарителя c: (s - signs[c]) % 12
+    house = (np.arange(12)[None, None, :] - signs[:, :, None]) % 12           # [N, 8, 12]
+    bav = AV_TABLE[:, np.arange(8)[None, :, None], house].sum(axis=2)         # [7, N, 12]
+    bav = bav.transpose(1, 0, 2)
+    return bav, bav.sum(axis=1)
+
+def strength_row(jd: float, lat: float, lon: float, dt_local, planets: list,
+                 asc: float, ascmc, ayan: float) -> dict:
+    """Входните величини на една карта за strength_sections (сидерално, JD UT)."""
+    _swe_ready()
+    lons = {p["planet"]: p["longitude"] for p in planets}
+    helio = [(swe.calc_ut(jd, body, FLAGS_TROP | swe.FLG_HELCTR)[0][0] - ayan) % 360.0
+             for body in (swe.MERCURY, swe.VENUS)]
+    day = vedic_day(jd, dt_local, lat, lon)
+    rise, sset, nxt = day["sunrise"], day["sunset"], day["next_sunrise"]
+    if rise is None or sset is None or nxt is None:
+        is_day, frac = -1, float("nan")           # полярни ширини – по часовия ъгъл на Слънцето
+    elif jd < sset:
+        is_day, frac = 1, (jd - rise) / (sset - rise)
+    else:
+        is_day, frac = 0, (jd - sset) / (nxt - sset)
+    return {
+        "lon": [lons[g] for g in STRENGTH_GRAHAS],
+        "helio": helio,
+        "asc": asc,
+        "mc": (ascmc[1] - ayan) % 360.0,
+        "armc": ascmc[2],
+        "ayan": ayan,
+        "eps": swe.calc_ut(jd, swe.ECL_NUT)[0][0],
+        "is_day": is_day,
+        "frac": frac,
+        "weekday": day["weekday"],
+    }
+
+def shadbala(rows: dict) -> dict:
+    """
+    Векторна шадбала за N карти. rows – полетата на strength_row като масиви
+    (lon [N, 7], helio [N, 2], останалите [N]). → {компонент: [N, 7]} във вирупи.
+    """
+    lon = np.asarray(rows["lon"], dtype=np.float64)
+    n = len(lon)
+    g = np.arange(7)
+    sign = (lon // 30.0).astype(np.int64)
+    deg = lon % 30.0
+    asc = np.asarray(rows["asc"], dtype=np.float64)
+    asc_sign = (asc // 30.0).astype(np.int64)
+
+    # --- стхана ---
+    uchcha = _fold(lon - (_EXALT_NP + 180.0)) / 3.0
+    # саптаваргаджа: отношението към владетеля на знака във всяка от седемте варги
+    vsign = np.stack([varga_sign_indices(lon, d) for d in SAPTAVARGA], axis=2)  # [N, 7, V]
+    lord = SIGN_LORD_INDEX[vsign]
+    lord_d1 = np.take_along_axis(sign, lord.reshape(n, -1), axis=1).reshape(lord.shape)  # знакът на владетеля в D1
+    compound = NATURAL_REL[g[None, :, None], lord] + TEMPORAL_REL[(lord_d1 - sign[:, :, None]) % 12]
+    points = np.where(lord == g[None, :, None], 30.0, SAPTAVARGA_LUT[compound + 2])
+    mt = (sign == _MT_SIGN) & (deg >= _MT_FROM) & (deg < _MT_TO)
+    points[:, :, 0] = np.where(mt, 45.0, points[:, :, 0])
+    saptavargaja = points.sum(axis=2)
+    d9 = vsign[:, :, SAPTAVARGA.index(9)]                         # Луна и Венера – в четни знаци
+    oja = 15.0 * ((sign % 2 == 1) == _FEMALE) + 15.0 * ((d9 % 2 == 1) == _FEMALE)
+    house = (sign - asc_sign[:, None]) % 12
+    kendradi = np.where(house % 3 == 0, 60.0, np.where(house % 3 == 1, 30.0, 15.0))
+    drekkana = np.where((deg // 10.0).astype(np.int64) == _DREKKANA_NP, 15.0, 0.0)
+    sthana = uchcha + saptavargaja + oja + kendradi + drekkana
+
+    # --- диг ---
+    mc = np.asarray(rows["mc"], dtype=np.float64)
+    points4 = np.stack([asc, mc, asc + 180.0, mc + 180.0], axis=1)               # [N, 4]
+    strong = points4[:, DIG_STRONG]
+    dig = (180.0 - _fold(lon - strong)) / 3.0
+
+    # --- кала ---
+    ayan = np.asarray(rows["ayan"], dtype=np.float64)
+    eps = np.deg2rad(np.asarray(rows["eps"], dtype=np.float64))
+    trop_sun = np.deg2rad(lon[:, 0] + ayan)
+    ra_sun = np.rad2deg(np.arctan2(np.sin(trop_sun) * np.cos(eps), np.cos(trop_sun)))
+    hour_angle = (np.asarray(rows["armc"], dtype=np.float64) - ra_sun + 180.0) % 360.0 - 180.0  # 0 = пладне
+    noon = 1.0 - np.abs(hour_angle) / 180.0
+    natonnata = np.stack([60.0 * noon, 60.0 * (1 - noon), 60.0 * (1 - noon), np.full(n, 60.0),
+                          60.0 * noon, 60.0 * noon, 60.0 * (1 - noon)], axis=1)
+    elong = _fold(lon[:, 1] - lon[:, 0]) / 3.0
+    paksha = np.where(_BENEFIC, elong[:, None], 60.0 - elong[:, None])
+    paksha[:, 1] *= 2.0
+    is_day = np.asarray(rows["is_day"], dtype=np.int64)
+    frac = np.asarray(rows["frac"], dtype=np.float64)
+    polar = is_day < 0
+    is_day = np.where(polar, np.abs(hour_angle) < 90.0, is_day == 1)
+    frac = np.where(polar, np.where(is_day, (hour_angle + 90.0) / 180.0, ((hour_angle - 90.0) % 360.0) / 180.0), frac)
+    frac = np.clip(frac, 0.0, 1.0 - 1e-9)
+    third = (frac * 3).astype(np.int64)
+    tri_lord = np.where(is_day, np.array([3, 0, 6])[third], np.array([1, 5, 2])[third])
+    tribhaga = 60.0 * ((g[None, :] == tri_lord[:, None]) | (g[None, :] == 4))
+    weekday = np.asarray(rows["weekday"], dtype=np.int64)
+    vara_lord = VARA_LORD_INDEX[weekday]
+    hora = (frac * 12).astype(np.int64) + np.where(is_day, 0, 12)
+    hora_lord = HORA_LORD_INDEX[(VARA_HORA_START[weekday] + hora) % 7]
+    vara = 45.0 * (g[None, :] == vara_lord[:, None])
+    hora_bala = 60.0 * (g[None, :] == hora_lord[:, None])
+    trop = np.deg2rad(lon + ayan[:, None])
+    kranti = np.rad2deg(np.arcsin(np.sin(eps)[:, None] * np.sin(trop)))
+    ayana = (24.0 + np.where(_AYANA_NORTH == 0.0, np.abs(kranti), _AYANA_NORTH * kranti)) / 48.0 * 60.0
+    ayana_sun = ayana[:, 0].copy()
+    ayana[:, 0] *= 2.0
+    kala = natonnata + paksha + tribhaga + vara + hora_bala + ayana
+
+    # --- чеща: Слънце – аяна, Луна – пакша; външните – елонгация от Слънцето;
+    # Меркурий/Венера – хелиоцентричният (шигхроччха) спрямо средата Слънце/геоцентричен
+    sun = lon[:, 0]
+    chesta = _fold(sun[:, None] - lon) / 3.0
+    helio = np.asarray(rows["helio"], dtype=np.float64)
+    inner = lon[:, [3, 5]]
+    mid = sun[:, None] + ((inner - sun[:, None] + 180.0) % 360.0 - 180.0) / 2.0
+    chesta[:, [3, 5]] = _fold(helio - mid) / 3.0
+    chesta[:, 0] = ayana_sun
+    chesta[:, 1] = elong
+
+    naisargika = np.broadcast_to(_NAISARGIKA_NP, (n, 7))
+    total = sthana + dig + kala + chesta + naisargika
+    return {"sthana": sthana, "dig": dig, "kala": kala, "chesta": chesta,
+            "naisargika": naisargika, "total": total}
+
+def strength_sections(rows: list, sections) -> list:
+    """Секциите "Ashtakavarga"/"Shadbala" за списък от strength_row – с един векторен проход."""
+    if np is None:
+        raise RuntimeError("аштакаварга/шадбала изискват numpy")
+    out = [{} for _ in rows]
+    if not rows:
+        return out
+    cols = {k: np.array([r[k] for r in rows]) for k in rows[0]}
+    if "Ashtakavarga" in sections:
+        signs = np.concatenate([(cols["lon"] // 30.0).astype(np.int64),
+                                (cols["asc"] // 30.0).astype(np.int64)[:, None]], axis=1)
+        bav, sav = ashtakavarga(signs)
+        for res, bhinna, sarva in zip(out, bav.tolist(), sav.tolist()):
+            res["Ashtakavarga"] = {"bhinna": dict(zip(STRENGTH_GRAHAS, bhinna)), "sarva": sarva}
+    if "Shadbala" in sections:
+        sb = shadbala(cols)
+        sb["rupas"] = sb["total"] / 60.0
+        parts = list(sb)
+        table = np.round(np.stack([sb[part] for part in parts], axis=2), 2).tolist()   # [N, 7, части]
+        for res, per_chart in zip(out, table):
+            res["Shadbala"] = {g: dict(zip(parts, vals)) for g, vals in zip(STRENGTH_GRAHAS, per_chart)}
+    return out
+
+# ---------- CHEBYSHEV EPHEMERIS (NumPy) ----------
+# Опционален backend за векторни позиции (транзити, календари, търсене по време).
+# За всяко тяло: равномерни сегменти (CHEB_BODIES) с Чебишев полином по тропическата
+# дължина (развита без скокове 360→0). Всеки сегмент се проверява срещу swe.calc_ut
+# в междинни точки; ако грешката > CHEB_TOL_ARCSEC, сегментът се дели на 2, 4 … 16
+# парчета. Около съвпад със Слънцето отклонението на светлината дава тесен пик, който
+# проверката може да пропусне → там сегментите на планетите се делят на 8 от самото начало,
+# а под CHEB_SUN_CLOSE_DEG (планетата зад/пред диска) – на 32 … 256 с гъста проверка.
+#
+# Измерена точност спрямо swe.calc_ut, 1900–2100, 600 000 случайни момента на тяло
+# (python bench.py cheb проверява 100 000 и връща 1 над праговете):
+#   лонгитуд  Меркурий..Сатурн < 0.05" (най-много Юпитер ~0.04"), Луна/Слънце ~0.001",
+#             среден възел ~0.0005", истински възел < 0.3" (серията на SE има пречупвания)
+#   скорост   планети < 2e-3 °/ден (най-много около съвпад), Луна/Слънце < 1e-4 °/ден,
+#             истински възел < 0.1 °/ден
+# Кешът е на диска (CHEB_DIR, .npy) и се чете с mmap → споделя се между процеси.
+# Първото строене за 1900–2100 е ~2.5 мин за всички тела; предварително:
+#   python -c "import app; app.ChebyshevEphemeris().prepare()"
+CHEB_ON = os.getenv("NK_CHEB", "0") == "1"
+CHEB_DIR = os.getenv("NK_CHEB_DIR", os.path.join(BASE_DIR, "cheb_cache"))
+CHEB_FROM = swe.julday(int(os.getenv("NK_CHEB_FROM_YEAR", "1900")), 1, 1, 0.0)
+CHEB_TO   = swe.julday(int(os.getenv("NK_CHEB_TO_YEAR", "2100")), 1, 1, 0.0)
+CHEB_TOL_ARCSEC = 0.05
+CHEB_MAX_SPLIT = 16
+CHEB_SUN_SPLIT_DEG = 5.0   # елонгация, под която планетите се делят на 8 парчета
+CHEB_SUN_CLOSE_DEG = 1.5   # … и под която – на 32+ парчета с гъста проверка
+CHEB_SUN_MAX_SPLIT = 256
+
+# swe id → (дължина на сегмента в дни, степен)
+CHEB_BODIES = {
+    swe.SUN:       (8.0, 10),
+    swe.MOON:      (4.0, 12),
+    swe.MERCURY:   (8.0, 12),
+    swe.VENUS:     (8.0, 12),
+    swe.MARS:      (8.0, 12),
+    swe.JUPITER:   (8.0, 12),
+    swe.SATURN:    (8.0, 12),
+    swe.MEAN_NODE: (16.0, 10),
+    swe.TRUE_NODE: (4.0, 12),
+}
+
+class ChebyshevEphemeris:
+    """
+    Векторни тропически лонгитуди и скорости от Чебишев сегменти.
+
+        eph = ChebyshevEphemeris()
+        lon, spd = eph.lon_speed(swe.MOON, np.array([...jd...]))
+
+    Моменти извън [jd_from, jd_to) се смятат директно със swe.calc_ut.
+    """
+
+    VERSION = 2
+
+    def __init__(self, jd_from: float = CHEB_FROM, jd_to: float = CHEB_TO, cache_dir: str | None = CHEB_DIR):
+        if np is None:
+            raise RuntimeError("ChebyshevEphemeris изисква numpy")
+        self.jd_from = float(jd_from)
+        self.jd_to = float(jd_to)
+        self.cache_dir = cache_dir
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    # ---- строене / кеш ----
+    def _cache_path(self, body: int):
+        if not self.cache_dir:
+            return None
+        seg, deg = CHEB_BODIES[body]
+        name = f"cheb_v{self.VERSION}_{body}_{self.jd_from:.1f}_{self.jd_to:.1f}_{seg:g}_{deg}_{CHEB_TOL_ARCSEC:g}"
+        return os.path.join(self.cache_dir, name)
+
+    @staticmethod
+    def _sample(body: int, jds):
+        return np.array([swe.calc_ut(float(j), body, FLAGS_TROP)[0][0] for j in jds])
+
+    def _fit_piece(self, body: int, a: float, length: float, deg: int, check: int = 9):
+        n = deg + 1
+        xk = np.cos(np.pi * (np.arange(n) + 0.5) / n)
+        y = np.rad2deg(np.unwrap(np.deg2rad(self._sample(body, a + (xk + 1.0) * length / 2.0))))
+        coef = np.polynomial.chebyshev.chebfit(xk, y, deg)
+        # проверка между възлите
+        xc = np.linspace(-0.95, 0.95, check)
+        got = np.polynomial.chebyshev.chebval(xc, coef)
+        ref = self._sample(body, a + (xc + 1.0) * length / 2.0)
+        err = np.abs((got - ref + 180.0) % 360.0 - 180.0).max() * 3600.0
+        return coef, err
+
+    def _fit(self, body: int):
+        _swe_ready()
+        seg, deg = CHEB_BODIES[body]
+        nseg = int(np.ceil((self.jd_to - self.jd_from) / seg))
+        first = np.empty(nseg, dtype=np.int64)
+        npieces = np.empty(nseg, dtype=np.int64)
+        pieces = []
+        near_sun = body in (swe.MERCURY, swe.VENUS, swe.MARS, swe.JUPITER, swe.SATURN)
+        for s in range(nseg):
+            a = self.jd_from + s * seg
+            k, max_split, check = 1, CHEB_MAX_SPLIT, 9
+            if near_sun:
+                jj = a + np.linspace(0.0, seg, 17)
+                elong = np.abs((self._sample(body, jj) - self._sample(swe.SUN, jj) + 180.0) % 360.0 - 180.0)
+                if elong.min() < CHEB_SUN_SPLIT_DEG:
+                    k = 8
+                if elong.min() < CHEB_SUN_CLOSE_DEG:    # зад/пред диска: гъста проверка и още деления
+                    k, max_split, check = 32, CHEB_SUN_MAX_SPLIT, 33
+            while True:
+                fits = [self._fit_piece(body, a + i * seg / k, seg / k, deg, check) for i in range(k)]
+                if k >= max_split or max(e for _, e in fits) <= CHEB_TOL_ARCSEC:
+                    break
+                k *= 2
+            first[s] = len(pieces)
+            npieces[s] = k
+            pieces.extend(c for c, _ in fits)
+        return {"seg": seg, "first": first, "npieces": npieces, "coef": np.array(pieces)}
+
+    def _table(self, body: int):
+        tab = self._tables.get(body)
+        if tab is not None:
+            return tab
+        with self._lock:
+            tab = self._tables.get(body)
+            if tab is not None:
+                return tab
+            path = self._cache_path(body)
+            if path and os.path.exists(path + ".coef.npy"):
+                tab = {
+                    "seg": CHEB_BODIES[body][0],
+                    "first": np.load(path + ".first.npy"),
+                    "npieces": np.load(path + ".npieces.npy"),
+                    "coef": np.load(path + ".coef.npy", mmap_mode="r"),
+                }
+            else:
+                tab = self._fit(body)
+                if path:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    for key in ("first", "npieces", "coef"):
+                        tmp = f"{path}.{key}.tmp.npy"
+                        np.save(tmp, tab[key])
+                        os.replace(tmp, f"{path}.{key}.npy")
+            self._tables[body] = tab
+            return tab
+
+    def prepare(self, bodies=None):
+        """Строи/зарежда таблиците предварително (иначе – при първо ползване)."""
+        for body in (bodies or CHEB_BODIES):
+            self._table(body)
+
+    # ---- изчисление ----
+    def lon_speed(self, body: int, jds):
+        """Тропически лонгитуд (0..360) и скорост (°/ден) за масив от JD."""
+        jds = np.asarray(jds, dtype=np.float64)
+        flat = jds.ravel()
+        lon = np.empty(flat.shape, dtype=np.float64)
+        spd = np.empty(flat.shape, dtype=np.float64)
+
+        inside = (flat >= self.jd_from) & (flat < self.jd_to)
+        if (~inside).any():
+            _swe_ready()
+            for k in np.nonzero(~inside)[0]:
+                pos, _ = swe.calc_ut(float(flat[k]), body, FLAGS_TROP)
+                lon[k] = pos[0] % 360.0
+                spd[k] = pos[3]
+
+        if inside.any():
+            tab = self._table(body)
+            seg = tab["seg"]
+            t = (flat[inside] - self.jd_from) / seg
+            s = np.minimum(t.astype(np.int64), len(tab["first"]) - 1)
+            n = tab["npieces"][s]
+            u = (t - s) * n
+            p = np.minimum(u.astype(np.int64), n - 1)
+            x = 2.0 * (u - p) - 1.0
+            coef = tab["coef"][tab["first"][s] + p]
+
+            # Clenshaw за стойността и производната едновременно
+            b1 = np.zeros_like(x)
+            b2 = np.zeros_like(x)
+            d1 = np.zeros_like(x)
+            d2 = np.zeros_like(x)
+            for i in range(coef.shape[1] - 1, 0, -1):
+                d1, d2 = 2.0 * b1 + 2.0 * x * d1 - d2, d1
+                b1, b2 = 2.0 * x * b1 - b2 + coef[:, i], b1
+            val = x * b1 - b2 + coef[:, 0]
+            der = b1 + x * d1 - d2
+            lon[inside] = val % 360.0
+            spd[inside] = der * (2.0 * n / seg)
+
+        return lon.reshape(jds.shape), spd.reshape(jds.shape)
+
+    def sidereal_lon_speed(self, body: int, jds, offset_deg: float = NK_AYAN_OFFSET_JH):
+        """Сидерален лонгитуд (със същата айанамша+offset като calculate()) и скорост."""
+        lon, spd = self.lon_speed(body, jds)
+        return (lon - _ayanamsha_many(jds, offset_deg)) % 360.0, spd
+
+    def check_accuracy(self, body: int, n: int = 5000, seed: int = 0):
+        """Макс. грешка спрямо swe.calc_ut: (лонгитуд в дъгови секунди, скорост в °/ден)."""
+        _swe_ready()
+        rng = np.random.default_rng(seed)
+        jds = rng.uniform(self.jd_from, self.jd_to, n)
+        lon, spd = self.lon_speed(body, jds)
+        ref = np.array([swe.calc_ut(float(j), body, FLAGS_TROP)[0] for j in jds])
+        err_lon = np.abs((lon - ref[:, 0] + 180.0) % 360.0 - 180.0).max() * 3600.0
+        err_spd = np.abs(spd - ref[:, 3]).max()
+        return float(err_lon), float(err_spd)
+
+_CHEB = None
+_CHEB_LOCK = threading.Lock()
+
+def get_cheb():
+    """Споделеният ChebyshevEphemeris или None, ако backend-ът е изключен (NK_CHEB=0)."""
+    global _CHEB
+    if not CHEB_ON or np is None:
+        return None
+    if _CHEB is None:
+        with _CHEB_LOCK:
+            if _CHEB is None:
+                _CHEB = ChebyshevEphemeris()
+    return _CHEB
+
+# ---------- EVENT SEARCH ----------
+# Влизане в знак, смяна на накшатра/пада и стационарни точки (ретро/директно).
+# Груба стъпка по тялото → скоби; стационарните точки се уточняват първи и делят
+# стъпката на монотонни парчета, в които всяка граница се пресича точно веднъж
+# (уточнява се с Нютон в скобата). Всичко е векторно по NumPy масиви;
+# с NK_CHEB=1 позициите идват от ChebyshevEphemeris, иначе – от swe.calc_ut.
+EVENT_KINDS = ("sign", "nakshatra", "pada", "station")
+EVENT_PADA_SPAN = 360.0 / 108.0        # знак = 9 пади, накшатра = 4 пади
+EVENT_TOL_DAYS = 1e-5                  # ~0.9 s
+EVENT_CHUNK_DAYS = 366.0
+
+# име → (swe id или None за възела, груба стъпка в дни); стъпката е по-къса
+# от най-краткия ретро/директен период на тялото. Истинският възел понякога
+# спира и тръгва отново в рамките на минути – такива двойки (по-близки от
+# стъпката) се пропускат; средният възел няма стационарни точки.
+EVENT_BODIES = {
+    "Слънце":   (swe.SUN,     8.0),
+    "Луна":     (swe.MOON,    1.0),
+    "Меркурий": (swe.MERCURY, 2.0),
+    "Венера":   (swe.VENUS,   4.0),
+    "Марс":     (swe.MARS,    4.0),
+    "Юпитер":   (swe.JUPITER, 8.0),
+    "Сатурн":   (swe.SATURN,  8.0),
+    "Раху":     (None,        0.5),
+    "Кету":     (None,        0.5),
+}
+
+def _event_positions(body: int, shift: float, ayan_off: float, cheb):
+    """Векторна функция jds → (сидерален лонгитуд, тропическа скорост)."""
+    def ev(jds):
+        jds = np.asarray(jds, dtype=np.float64)
+        if cheb is not None:
+            lon, spd = cheb.lon_speed(body, jds)
+        else:
+            lon = np.empty(jds.shape)
+            spd = np.empty(jds.shape)
+            for k, j in enumerate(jds.ravel()):
+                pos, _ = swe.calc_ut(float(j), body, FLAGS_TROP)
+                lon.flat[k] = pos[0]
+                spd.flat[k] = pos[3]
+        return (lon + shift - _ayanamsha_many(jds, ayan_off)) % 360.0, spd
+    return ev
+
+def _refine_stations(ev, lo, hi, slo, shi, tol: float = EVENT_TOL_DAYS, max_iter: int = 60):
+    """Нулите на скоростта в скобите [lo, hi] (Illinois – регула фалси без застой)."""
+    lo, hi, slo, shi = lo.copy(), hi.copy(), slo.copy(), shi.copy()
+    side = np.zeros(lo.shape, dtype=np.int8)
+    t = lo.copy()
+    todo = np.ones(lo.shape, dtype=bool)
+    for _ in range(max_iter):
+        if not todo.any():
+            break
+        i = np.nonzero(todo)[0]
+        t_new = lo[i] - slo[i] * (hi[i] - lo[i]) / (shi[i] - slo[i])
+        s = ev(t_new)[1]
+        left = np.sign(s) == np.sign(slo[i])
+        # лявата граница се мести → дясната стойност се полови при повторение (и обратно)
+        lo[i[left]], slo[i[left]] = t_new[left], s[left]
+        shi[i[left & (side[i] == 1)]] *= 0.5
+        hi[i[~left]], shi[i[~left]] = t_new[~left], s[~left]
+        slo[i[~left & (side[i] == -1)]] *= 0.5
+        side[i] = np.where(left, 1, -1)
+        t[i] = t_new
+        todo[i] = (hi[i] - lo[i]) > tol
+    return t
+
+def _hermite_guess(t0, t1, y0, y1, m0, m1, target, n_iter: int = 4):
+    """
+    Начално приближение: кубичният Ермитов сплайн по стойностите и скоростите
+    в краищата на скобата, решен за target (Нютон по полинома, без ефемерида).
+    """
+    h = t1 - t0
+    dy = y1 - y0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s = np.clip(np.where(dy != 0.0, (target - y0) / dy, 0.5), 0.0, 1.0)
+        for _ in range(n_iter):
+            s2 = s * s
+            s3 = s2 * s
+            val = ((2 * s3 - 3 * s2 + 1) * y0 + (s3 - 2 * s2 + s) * h * m0
+                   + (-2 * s3 + 3 * s2) * y1 + (s3 - s2) * h * m1)
+            der = ((6 * s2 - 6 * s) * y0 + (3 * s2 - 4 * s + 1) * h * m0
+                   + (-6 * s2 + 6 * s) * y1 + (3 * s2 - 2 * s) * h * m1)
+            s_new = s - (val - target) / der
+            s = np.where(np.isfinite(s_new), np.clip(s_new, 0.0, 1.0), s)
+    return t0 + s * h
+
+def _refine_crossings(ev, lo, hi, target, direction, guess=None,
+                      tol: float = EVENT_TOL_DAYS, max_iter: int = 40):
+    """
+    Моментите, в които лонгитудът минава през target в скобите [lo, hi].
+    Движението в скобата е монотонно (direction = ±1); Нютон от guess (или от
+    средата), а при стъпка извън скобата – бисекция.
+    """
+    lo, hi = lo.copy(), hi.copy()
+    t = 0.5 * (lo + hi) if guess is None else np.clip(guess, lo, hi)
+    todo = np.ones(lo.shape, dtype=bool)
+    for _ in range(max_iter):
+        if not todo.any():
+            break
+        i = np.nonzero(todo)[0]
+        lon, spd = ev(t[i])
+        f = (((lon - target[i]) + 180.0) % 360.0 - 180.0) * direction[i]
+        rate = spd * direction[i]
+        before = f < 0.0
+        lo[i[before]] = t[i[before]]
+        hi[i[~before]] = t[i[~before]]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_new = t[i] - f / rate
+        bad = ~((t_new > lo[i]) & (t_new < hi[i]))
+        t_new[bad] = 0.5 * (lo[i][bad] + hi[i][bad])
+        step = np.abs(t_new - t[i])
+        t[i] = t_new
+        todo[i] = (step > tol) & ((hi[i] - lo[i]) > tol)
+    return t
+
+def _body_events(name: str, jd_from: float, jd_to: float, kinds, node_type: str,
+                 ayan_off: float, cheb):
+    """Генератор на (jd, събитие) за едно тяло, подредени по време."""
+    body, step = EVENT_BODIES[name]
+    shift = 0.0
+    if body is None:
+        body = swe.TRUE_NODE if node_type == "TRUE" else swe.MEAN_NODE
+        shift = 180.0 if name == "Кету" else 0.0
+        if body == swe.MEAN_NODE:
+            step = 8.0
+    ev = _event_positions(body, shift, ayan_off, cheb)
+    # коя пада-граница k носи събития (k·span): всяка пада / всяка 4-та / всяка 9-та
+    need_pada = "pada" in kinds
+    need_nak = "nakshatra" in kinds
+    need_sign = "sign" in kinds
+
+    a = jd_from
+    while a < jd_to:
+        b = min(a + EVENT_CHUNK_DAYS, jd_to)
+        n = max(1, int(np.ceil((b - a) / step)))
+        ts = np.linspace(a, b, n + 1)
+        lon, spd = ev(ts)
+        events = []
+
+        # стационарни точки
+        sgn = np.sign(spd)
+        st = np.nonzero(sgn[:-1] * sgn[1:] < 0)[0]
+        st_t = _refine_stations(ev, ts[st], ts[st + 1], spd[st], spd[st + 1]) if len(st) else np.empty(0)
+        st_lon = ev(st_t)[0] if len(st) else np.empty(0)
+        if "station" in kinds:
+            for j, t, l in zip(st, st_t, st_lon):
+                retro = spd[j] > 0
+                events.append((float(t), {
+                    "planet": name, "event": "station",
+                    "station": "retrograde" if retro else "direct",
+                    "longitude": round(float(l), 6), "sign": sign_of(float(l)),
+                }))
+
+        # възли = пробите + стационарните точки → монотонни интервали
+        kt = np.concatenate([ts, st_t])
+        kl = np.concatenate([lon, st_lon])
+        ks = np.concatenate([spd, np.zeros(len(st_t))])
+        order = np.argsort(kt, kind="stable")
+        kt, kl, ks = kt[order], kl[order], ks[order]
+        kl = np.rad2deg(np.unwrap(np.deg2rad(kl)))
+        k0 = np.floor(kl[:-1] / EVENT_PADA_SPAN).astype(np.int64)
+        k1 = np.floor(kl[1:] / EVENT_PADA_SPAN).astype(np.int64)
+        cnt = np.abs(k1 - k0)
+        if (need_pada or need_nak or need_sign) and cnt.any():
+            seg = np.repeat(np.arange(len(cnt)), cnt)
+            first = np.repeat(np.cumsum(cnt) - cnt, cnt)
+            off = np.arange(cnt.sum()) - first
+            direction = np.where(k1 > k0, 1.0, -1.0)[seg]
+            # пресечената граница: k0+1, k0+2 … (директно) или k0, k0-1 … (ретро)
+            k = np.where(direction > 0, k0[seg] + 1 + off, k0[seg] - off)
+            keep = np.ones(k.shape, dtype=bool) if need_pada else (
+                ((k % 4 == 0) if need_nak else False) | ((k % 9 == 0) if need_sign else False))
+            seg, k, direction = seg[keep], k[keep], direction[keep]
+            if len(k):
+                bound = k * EVENT_PADA_SPAN
+                guess = _hermite_guess(kt[seg], kt[seg + 1], kl[seg], kl[seg + 1],
+                                       ks[seg], ks[seg + 1], bound)
+                t = _refine_crossings(ev, kt[seg], kt[seg + 1], bound % 360.0, direction, guess)
+                for t_i, k_i, d_i in zip(t, k, direction):
+                    k_i = int(k_i)
+                    new = k_i % 108 if d_i > 0 else (k_i - 1) % 108
+                    old = (k_i - 1) % 108 if d_i > 0 else k_i % 108
+                    retro = bool(d_i < 0)
+                    if need_sign and k_i % 9 == 0:
+                        events.append((float(t_i), {
+                            "planet": name, "event": "sign", "retrograde": retro,
+                            "from": SIGNS[old // 9], "to": SIGNS[new // 9],
+                        }))
+                    if need_nak and k_i % 4 == 0:
+                        events.append((float(t_i), {
+                            "planet": name, "event": "nakshatra", "retrograde": retro,
+                            "from": NAK[old // 4], "to": NAK[new // 4],
+                        }))
+                    if need_pada:
+                        events.append((float(t_i), {
+                            "planet": name, "event": "pada", "retrograde": retro,
+                            "from": {"nakshatra": NAK[old // 4], "pada": old % 4 + 1},
+                            "to": {"nakshatra": NAK[new // 4], "pada": new % 4 + 1},
+                        }))
+
+        events.sort(key=lambda e: e[0])
+        yield from events
+        a = b
+
+def search_events(jd_from: float, jd_to: float, planets=None, kinds=EVENT_KINDS,
+                  node_type: str = NODE, ayan_off: float = NK_AYAN_OFFSET_JH):
+    """
+    Генератор на (jd, събитие) за всички тела, слети по време (heapq.merge –
+    телата се смятат на парчета от EVENT_CHUNK_DAYS, без да се чака целият период).
+    """
+    if np is None:
+        raise RuntimeError("търсенето на събития изисква numpy")
+    _swe_ready()
+    cheb = get_cheb()
+    kinds = set(kinds)
+    gens = [_body_events(name, jd_from, jd_to, kinds, node_type, ayan_off, cheb)
+            for name in (planets or EVENT_BODIES)]
+    return heapq.merge(*gens, key=lambda e: e[0])
+
+# ---------- MUHURTA ----------
+# Търсене на прозорци по критерии (лагна, части на панчангата, ретроградност).
+# Всяка част се представя като поредица от интервали с постоянна стойност
+# [(начало_jd, край_jd, индекс)], намерени по границите им (без проби през минута):
+#   лагна   – векторна формула по ARMC/наклона на еклиптиката, груба стъпка и
+#             Нютон в скобите (_refine_crossings)
+#   тити … карана – _LimbWalker (Нютон по Слънцето/Луната)
+#   ретроградност – стационарните точки от search_events
+# Интервалите на всички части се сливат в едно разбиване на прозореца и се
+# пазят парчетата, в които всички условия са изпълнени.
+LAGNA_STEP_DAYS = 5.0 / 1440.0          # груба стъпка; пресичанията в нея се броят
+LAGNA_NODE_DAYS = 0.25                  # ARMC и наклонът – линейно между възлите
+# над полярния кръг лагната скача с 180° и не е монотонна → фина стъпка и бисекция по знака
+LAGNA_POLAR_LAT = 66.0
+LAGNA_POLAR_STEP_DAYS = 1.0 / 1440.0
+MUHURTA_LIMBS = {
+    "tithi":     (12.0, 30),
+    "nakshatra": (360.0 / 27.0, 27),
+    "yoga":      (360.0 / 27.0, 27),
+    "karana":    (6.0, 60),
+}
+MUHURTA_RETRO_BODIES = ("Меркурий", "Венера", "Марс", "Юпитер", "Сатурн")
+
+def _lagna_positions(jd_from: float, jd_to: float, lat: float, lon: float, ayan_off: float):
+    """
+    Векторна функция jds → (сидерална лагна, скорост в °/ден) за [jd_from, jd_to].
+    Същата лагна като swe.houses (asc = atan2(cos R, -(sin R cos ε + tg φ sin ε)));
+    звездното време и ε се смятат само във възлите през LAGNA_NODE_DAYS.
+    """
+    n = max(2, int(np.ceil((jd_to - jd_from) / LAGNA_NODE_DAYS)) + 3)
+    nodes = jd_from - LAGNA_NODE_DAYS + np.arange(n) * LAGNA_NODE_DAYS
+    armc = np.array([swe.sidtime(float(j)) * 15.0 for j in nodes]) + lon
+    armc = np.rad2deg(np.unwrap(np.deg2rad(armc)))
+    eps = np.array([swe.calc_ut(float(j), swe.ECL_NUT)[0][0] for j in nodes])
+    rate = np.diff(armc) / LAGNA_NODE_DAYS
+    tan_phi = float(np.tan(np.deg2rad(max(-89.999, min(89.999, lat)))))
+
+    def ev(jds):
+        jds = np.asarray(jds, dtype=np.float64)
+        r = np.deg2rad(np.interp(jds, nodes, armc))
+        e = np.deg2rad(np.interp(jds, nodes, eps))
+        y = np.cos(r)
+        x = -(np.sin(r) * np.cos(e) + tan_phi * np.sin(e))
+        asc = np.rad2deg(np.arctan2(y, x))
+        # както swe.houses в полярния кръг: лагна западно от MC се обръща с 180°
+        polar = abs(lat) >= 90.0 - np.rad2deg(e)
+        if polar.any():
+            mc = np.rad2deg(np.arctan2(np.sin(r), np.cos(r) * np.cos(e)))
+            asc = np.where(polar & ((asc - mc + 180.0) % 360.0 - 180.0 < 0.0), asc + 180.0, asc)
+        # d asc / d ARMC, по ARMC-скоростта на текущия интервал между възлите
+        k = np.clip(np.searchsorted(nodes, jds, side="right") - 1, 0, len(rate) - 1)
+        spd = (-x * np.sin(r) + y * np.cos(r) * np.cos(e)) / (x * x + y * y) * rate[k]
+        return (asc - _ayanamsha_many(jds, ayan_off)) % 360.0, spd
+    return ev
+
+def lagna_segments(jd_from: float, jd_to: float, lat: float, lon: float, ayan_off: float) -> list:
+    """[(начало_jd, край_jd, знак 0..11)] на лагната, покриващи [jd_from, jd_to]."""
+    if np is None:
+        raise RuntimeError("търсенето по лагна изисква numpy")
+    _swe_ready()
+    ev = _lagna_positions(jd_from, jd_to, lat, lon, ayan_off)
+    polar = abs(lat) >= LAGNA_POLAR_LAT
+    step = LAGNA_POLAR_STEP_DAYS if polar else LAGNA_STEP_DAYS
+    n = max(1, int(np.ceil((jd_to - jd_from) / step)))
+    ts = np.linspace(jd_from, jd_to, n + 1)
+    asc, spd = ev(ts)
+    if polar:
+        return _segments_by_label(lambda t: (ev(t)[0] // 30.0).astype(np.int64), ts, jd_from, jd_to)
+    ul = np.rad2deg(np.unwrap(np.deg2rad(asc)))
+    k0 = np.floor(ul[:-1] / 30.0).astype(np.int64)
+    k1 = np.floor(ul[1:] / 30.0).astype(np.int64)
+    cnt = np.abs(k1 - k0)
+    bounds = np.empty(0)
+    if cnt.any():
+        # както в _body_events: всяка пресечена граница (k0+1, k0+2 … или k0, k0-1 …)
+        seg = np.repeat(np.arange(len(cnt)), cnt)
+        off = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        direction = np.where(k1 > k0, 1.0, -1.0)[seg]
+        k = np.where(direction > 0, k0[seg] + 1 + off, k0[seg] - off)
+        target = k * 30.0
+        guess = _hermite_guess(ts[seg], ts[seg + 1], ul[seg], ul[seg + 1], spd[seg], spd[seg + 1], target)
+        bounds = np.sort(_refine_crossings(ev, ts[seg], ts[seg + 1], target % 360.0, direction, guess))
+    edges = np.concatenate([[jd_from], bounds, [jd_to]])
+    # знакът – в средата на всяко парче (устойчиво и при скоковете на лагната над полярния кръг)
+    mid = ev(0.5 * (edges[:-1] + edges[1:]))[0]
+    return [(float(a), float(b), int(m // 30.0)) for a, b, m in zip(edges[:-1], edges[1:], mid) if b > a]
+
+def _segments_by_label(label, ts, jd_from: float, jd_to: float, tol: float = EVENT_TOL_DAYS) -> list:
+    """
+    Интервалите с постоянен етикет label(jds) → int: смените между пробите ts
+    се уточняват с векторна бисекция (за прекъснати функции като полярната лагна).
+    """
+    lab = label(ts)
+    i = np.flatnonzero(lab[:-1] != lab[1:])
+    lo, hi, first = ts[i], ts[i + 1], lab[i]
+    while len(lo) and (hi - lo).max() > tol:
+        mid = 0.5 * (lo + hi)
+        same = label(mid) == first
+        lo, hi = np.where(same, mid, lo), np.where(same, hi, mid)
+    edges = np.concatenate([[jd_from], hi, [jd_to]])
+    return [(float(a), float(b), int(k))
+            for a, b, k in zip(edges[:-1], edges[1:], np.concatenate([lab[:1], lab[i + 1]])) if b > a]
+
+def limb_segments(kind: str, jd_from: float, jd_to: float, ayan_off: float) -> list:
+    """[(начало_jd, край_jd, индекс)] на част от панчангата, покриващи [jd_from, jd_to]."""
+    _swe_ready()
+    span, n = MUHURTA_LIMBS[kind]
+    w = _LimbWalker(kind, span, n, jd_from, ayan_off)
+    while w.end <= jd_from:
+        w.advance()
+    out = []
+    while w.start < jd_to:
+        out.append((w.start, w.end, w.idx))
+        w.advance()
+    return out
+
+def retro_segments(name: str, jd_from: float, jd_to: float, ayan_off: float) -> list:
+    """[(начало_jd, край_jd, 1 ако е ретрограден)] за планета в [jd_from, jd_to]."""
+    _swe_ready()
+    retro = int(swe.calc_ut(jd_from, EVENT_BODIES[name][0], FLAGS_TROP)[0][3] < 0)
+    out, start = [], jd_from
+    for jd, ev in search_events(jd_from, jd_to, [name], ("station",), ayan_off=ayan_off):
+        out.append((start, jd, retro))
+        start, retro = jd, int(ev["station"] == "retrograde")
+    out.append((start, jd_to, retro))
+    return out
+
+def muhurta_names(limb: str) -> list:
+    """Имената по индекс за част от критериите ("Ascendant" = знаците)."""
+    if limb == "Ascendant":
+        return SIGNS
+    return [_limb_info(limb, i)["name"] for i in range(MUHURTA_LIMBS[limb][1])]
+
+def parse_muhurta_criteria(criteria: dict) -> tuple:
+    """
+    Критериите на /muhurta → ({част: множество позволени индекси}, [планети без ретро]).
+    criteria: {"Ascendant"|"tithi"|"nakshatra"|"yoga"|"karana": [имена],
+               "exclude": {част: [имена]}, "not_retrograde": [планети]}
+    (списък или низ със запетаи). Непознато име → ValueError.
+    """
+    def as_list(v):
+        return [x.strip() for x in v.split(",") if x.strip()] if isinstance(v, str) else list(v or [])
+
+    def indices(limb, names):
+        table = muhurta_names(limb)
+        lookup = {}
+        for i, nm in enumerate(table):
+            lookup.setdefault(nm.lower(), set()).add(i)    # караните се повтарят
+        out = set()
+        for nm in as_list(names):
+            idx = lookup.get(str(nm).lower())
+            if idx is None:
+                raise ValueError(f"непозната стойност за {limb}: {nm}")
+            out |= idx
+        return out
+
+    limbs = ("Ascendant",) + tuple(MUHURTA_LIMBS)
+    criteria = criteria or {}
+    for key in criteria:
+        if key not in limbs and key not in ("exclude", "not_retrograde"):
+            raise ValueError(f"непознат критерий: {key}")
+    exclude = criteria.get("exclude") or {}
+    allowed = {}
+    for limb in limbs:
+        if limb not in criteria and limb not in exclude:
+            continue
+        keep = indices(limb, criteria[limb]) if limb in criteria else set(range(len(muhurta_names(limb))))
+        if limb in exclude:
+            keep -= indices(limb, exclude[limb])
+        allowed[limb] = keep
+    for key in exclude:
+        if key not in limbs:
+            raise ValueError(f"непознат критерий: exclude.{key}")
+    planets = as_list(criteria.get("not_retrograde"))
+    for p in planets:
+        if p not in EVENT_BODIES or p in ("Раху", "Кету"):
+            raise ValueError(f"непознато тяло: {p}")
+    return allowed, [p for p in planets if p in MUHURTA_RETRO_BODIES]
+
+def muhurta_search(jd_from: float, jd_to: float, lat: float, lon: float, allowed: dict,
+                   not_retrograde=(), ayan_off: float = NK_AYAN_OFFSET_JH, min_days: float = 0.0) -> list:
+    """
+    Интервалите в [jd_from, jd_to], в които всички условия са изпълнени:
+    [(начало_jd, край_jd, {част: [стойностите в интервала]})], подредени по време.
+    allowed – {част: позволени индекси} (parse_muhurta_criteria).
+    """
+    if np is None:
+        raise RuntimeError("търсенето на мухурта изисква numpy")
+    parts = {}
+    for limb in allowed:
+        with stage(f"muhurta_{limb.lower()}"):
+            parts[limb] = (lagna_segments(jd_from, jd_to, lat, lon, ayan_off) if limb == "Ascendant"
+                           else limb_segments(limb, jd_from, jd_to, ayan_off))
+    for name in not_retrograde:
+        with stage("muhurta_retrograde"):
+            parts["retro:" + name] = retro_segments(name, jd_from, jd_to, ayan_off)
+
+    # общо разбиване: всички граници в прозореца; във всяко парче всяка част е постоянна
+    edges = np.unique(np.concatenate(
+        [[jd_from, jd_to]] + [[s for s, _e, _i in segs if jd_from < s < jd_to] for segs in parts.values()]))
+    mid = 0.5 * (edges[:-1] + edges[1:])
+    ok = np.ones(len(mid), dtype=bool)
+    labels = {}
+    for key, segs in parts.items():
+        starts = np.array([s for s, _e, _i in segs])
+        idx = np.array([i for _s, _e, i in segs])[np.clip(np.searchsorted(starts, mid, side="right") - 1, 0, None)]
+        if key.startswith("retro:"):
+            ok &= idx == 0
+        else:
+            ok &= np.isin(idx, list(allowed[key]))
+            labels[key] = idx
+
+    # слепваме съседните изпълнени парчета
+    out = []
+    run = np.flatnonzero(np.diff(np.concatenate([[0], ok.astype(np.int8), [0]])))
+    for a, b in zip(run[::2], run[1::2]):
+        start, end = float(edges[a]), float(edges[b])
+        if end - start < min_days:
+            continue
+        values = {}
+        for limb, idx in labels.items():
+            names = muhurta_names(limb)
+            values[limb] = list(dict.fromkeys(names[i] for i in idx[a:b]))
+        out.append((start, end, values))
+    return out
+
+# ---------- LAGNA TABLE ----------
+# Влизанията на лагната в знаците по дни (местно време) за едно място.
+# Границите идват от lagna_segments (същата лагна и сидерална конверсия като
+# /calculate); периодът се смята на парчета по LAGNA_CHUNK_DAYS и всеки ден се
+# пази в LAGNA_CACHE по (lat, lon, зона, дата, offset).
+LAGNA_CHUNK_DAYS = 31
+LAGNA_MARGIN_DAYS = 0.5                # след края на деня – за продължителността на последния знак
+LAGNA_CACHE = _LRUCache(int(os.getenv("NK_LAGNA_CACHE_SIZE", "4096")))
+
+def _lagna_day_row(d, j0: float, j1: float, segs: list, seg_from: float, seg_to: float) -> dict:
+    """Редът за деня d ([j0, j1) в JD) от сегментите на lagna_segments за [seg_from, seg_to]."""
+    return {
+        "date": d.isoformat(),
+        "lagna": next(SIGNS[k] for a, b, k in segs if a <= j0 < b),
+        # "at" остава JD до извеждането (кешът не зависи от формата на часа)
+        "ingresses": [
+            {"sign": SIGNS[k], "at": a, "minutes": round((b - a) * 1440.0, 2) if b < seg_to else None}
+            for a, b, k in segs if j0 <= a < j1 and a > seg_from
+        ],
+    }
+
+def lagna_table(lat: float, lon: float, tz_name: str, date_from, date_to,
+                ayan_off: float = NK_AYAN_OFFSET_JH):
+    """
+    Генератор: по един ред на ден (date_from..date_to включително) със знака на
+    лагната в местна полунощ и всички влизания до следващата полунощ
+    ({"sign", "at" (ISO), "minutes" – колко трае знакът}).
+    """
+    tz = _safe_zoneinfo(tz_name)
+
+    def midnight_jd(d):
+        return JD_UNIX_EPOCH + datetime(d.year, d.month, d.day, tzinfo=tz).timestamp() / 86400.0
+
+    def key(d):
+        return (lat, lon, tz_name, d.isoformat(), ayan_off)
+
+    d = date_from
+    while d <= date_to:
+        days = [d + timedelta(days=i) for i in range(min(LAGNA_CHUNK_DAYS, (date_to - d).days + 1))]
+        rows = [LAGNA_CACHE.get(key(x), None) for x in days]
+        if any(r is None for r in rows):
+            todo = [x for x, r in zip(days, rows) if r is None]
+            seg_from = midnight_jd(todo[0])
+            seg_to = midnight_jd(todo[-1] + timedelta(days=1)) + LAGNA_MARGIN_DAYS
+            with stage("lagna_table"):
+                segs = lagna_segments(seg_from, seg_to, lat, lon, ayan_off)
+            for i, x in enumerate(days):
+                if rows[i] is None:
+                    rows[i] = _lagna_day_row(x, midnight_jd(x), midnight_jd(x + timedelta(days=1)),
+                                             segs, seg_from, seg_to)
+                    LAGNA_CACHE.put(key(x), rows[i])
+        for row in rows:
+            yield dict(row, ingresses=[dict(ing, at=jd_to_datetime(ing["at"], tz).isoformat())
+                                       for ing in row["ingresses"]])
+        d = days[-1] + timedelta(days=1)
+
+# ---------- CHART ENGINE ----------
+class ChartEngine:
+    """
+    Двигател за карти със собствена конфигурация (айанамша, тип възел, offset-и).
+    Не разчита на глобалния sid_mode – сидералните позиции се смятат ръчно
+    (_sidereal_from_tropical), затова е безопасен за ползване от много нишки.
+    """
+
+    def __init__(self, ayanamsha: str = AYAN, node_type: str = NODE,
+                 offset_dg: float = NK_AYAN_OFFSET_DG, offset_jh: float = NK_AYAN_OFFSET_JH):
+        self.ayanamsha_name = ayanamsha
+        self.node_type = node_type
+        self.offset_dg = float(offset_dg)
+        self.offset_jh = float(offset_jh)
+
+    def ayan_offset(self, calc_type: str = "standard") -> float:
+        return self.offset_dg if calc_type == "devaguru" else self.offset_jh
+
+    def ayanamsha(self, jd: float, offset_deg: float = 0.0) -> float:
+        _swe_ready()
+        return _ayanamsha_deg_ut(jd, offset_deg)
+
+    def planets(self, jd: float, ayan: float, topo: bool = False, bodies=None):
+        _swe_ready()
+        return planet_longitudes(jd, use_sidereal=True, ayan_override=ayan, topo=topo,
+                                 node_type=self.node_type, bodies=bodies)
+
+    def houses(self, jd: float, lat: float, lon: float, hsys=b'P'):
+        _swe_ready()
+        return houses_safe(jd, lat, lon, flags=FLAGS_TROP, hsys=hsys)
+
+    def chart(self, data: dict, tz_cache: dict | None = None, ayan_cache: dict | None = None,
+              inputs: dict | None = None, strength: list | None = None) -> dict:
+        return compute_chart(data, tz_cache=tz_cache, ayan_cache=ayan_cache, engine=self, inputs=inputs,
+                             strength=strength)
+
+    def warm_up(self):
+        """Отваря ефемеридните файлове и зарежда Спика – първата заявка не плаща това."""
+        _swe_ready()
+        jd = swe.julday(2000, 1, 1, 12.0)
+        ayan = self.ayanamsha(jd, self.offset_jh)
+        self.planets(jd, ayan)
+        self.houses(jd, 43.0, 27.0)
+        swe.calc_ut(jd, swe.TRUE_NODE, FLAGS_TROP)
+
+ENGINE = ChartEngine()
+
+# ---------- PROCESS POOL ----------
+# NK_EXEC_MODE=process → /calculate и /calculate/batch се смятат в пул от процеси
+# (NK_POOL_WORKERS, по подразбиране = брой ядра), всеки със "затоплена" ефемерида.
+NK_EXEC_MODE = os.getenv("NK_EXEC_MODE", "inline").lower()
+NK_POOL_WORKERS = int(os.getenv("NK_POOL_WORKERS", "0")) or (os.cpu_count() or 1)
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _pool_worker_init():
+    ENGINE.warm_up()
+
+def _pool_chart(data: dict) -> dict:
+    return ENGINE.chart(data)
+
+def _pool_chart_batch(items: list, start: int) -> list:
+    """Парче от batch: връща редове {index, ok, result|error} както /calculate/batch."""
+    tz_cache = {}
+    ayan_cache = {}
+    strength = []
+    out = []
+    for i, item in enumerate(items, start):
+        try:
+            out.append({"index": i, "ok": True, "result": ENGINE.chart(item, tz_cache=tz_cache, ayan_cache=ayan_cache,
+                                                                         strength=strength)})
+            if METRICS_ON:
+                METRICS.inc("nk_charts_total", (("calc_type", _calc_type_label(item)), ("source", "batch")))
+        except Exception as e:
+            out.append({"index": i, "ok": False, "error": str(e)})
+            if METRICS_ON:
+                METRICS.inc("nk_chart_errors_total", (("calc_type", _calc_type_label(item)),))
+    # аштакаварга/шадбала на всички карти от парчето – векторно наведнъж
+    try:
+        fill_strength(strength)
+    except Exception as e:
+        failed = {id(res) for res, _row, _wanted in strength}
+        for row in out:
+            if row["ok"] and id(row["result"]) in failed:
+                del row["result"]
+                row.update(ok=False, error=str(e))
+    return out
+
+def get_pool():
+    """Лениво създаден ProcessPoolExecutor (spawn – безопасно спрямо нишките на сървъра)."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                _POOL = ProcessPoolExecutor(
+                    max_workers=NK_POOL_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_pool_worker_init,
+                )
+    return _POOL
+
+def reset_pool(pool):
+    """След BrokenProcessPool (умрял процес): следващото get_pool() прави нов пул."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+# ---------- WARM-UP / READINESS ----------
+# warm_up() зарежда тежкото състояние веднъж: часовите зони, ефемеридните файлове,
+# Спика и първа карта (→ ready), после таблицата на айанамшата за
+# NK_WARM_FROM_YEAR..NK_WARM_TO_YEAR (NK_WARM_AYAN_TABLE=0 – само при нужда) и
+# Чебишев таблиците (ако са включени). При gunicorn с preload_app това става в
+# master процеса преди fork → работниците делят страниците copy-on-write;
+# after_fork() само отваря наново файловете на ефемеридата в работника.
+# NK_WARM_BACKGROUND=1 – warm-up във фонова нишка (в работника), сървърът приема
+# заявки веднага; те си зареждат липсващото синхронно. /health е ready след края.
+WARM_FROM = swe.julday(int(os.getenv("NK_WARM_FROM_YEAR", "1900")), 1, 1, 0.0)
+WARM_TO = swe.julday(int(os.getenv("NK_WARM_TO_YEAR", "2100")), 1, 1, 0.0)
+WARM_AYAN_TABLE = os.getenv("NK_WARM_AYAN_TABLE", "1") == "1"
+WARM_BACKGROUND = os.getenv("NK_WARM_BACKGROUND", "0") == "1"
+WARM_SAMPLE = {"date": "2000-01-01", "time": "12:00", "lat": 42.6977, "lon": 23.3219,
+               "timezone": "Europe/Sofia"}
+
+_READY = threading.Event()
+
+def _stage(name: str, fn):
+    t0 = time.perf_counter()
+    fn()
+    STARTUP[name] = round(time.perf_counter() - t0, 4)
+
+def warm_up(background: bool = False):
+    """Зарежда всичко и вдига ready. background=True → във фонова нишка (връща я)."""
+    if background:
+        th = threading.Thread(target=warm_up, name="nk-warm-up", daemon=True)
+        th.start()
+        return th
+    t0 = time.perf_counter()
+    get_tzf()
+    _stage("ephemeris_s", ENGINE.warm_up)
+    _stage("first_calc_s", lambda: compute_chart(WARM_SAMPLE))
+    STARTUP["ready_s"] = round(time.perf_counter() - _T_START, 4)
+    STARTUP["pid"] = os.getpid()
+    _READY.set()
+    # таблиците се строят и при нужда – ready не ги чака
+    if AYANAMSHA_TABLE is not None and WARM_AYAN_TABLE:
+        _stage("ayan_table_s", lambda: AYANAMSHA_TABLE.precompute(WARM_FROM, WARM_TO))
+    if SUN_PRECOMPUTE:
+        year = datetime.now(timezone.utc).year
+        _stage("sun_s", lambda: [precompute_sun_year(la, lo, resolve_timezone(la, lo), year)
+                                 for la, lo in SUN_PRECOMPUTE])
+    cheb = get_cheb()
+    if cheb is not None:
+        _stage("cheb_s", cheb.prepare)
+    STARTUP["warm_up_s"] = round(time.perf_counter() - t0, 4)
+    print(f"startup: {json.dumps(STARTUP, sort_keys=True)}", file=sys.stderr, flush=True)
+
+def after_fork():
+    """
+    В нов работен процес: собствени файлови дескриптори за Swiss Ephemeris
+    (не споделени с master). Ако master не е загрял – пълен warm-up тук.
+    """
+    if not _READY.is_set():
+        warm_up(background=WARM_BACKGROUND)
+    else:
+        _READY.clear()
+        swe.close()
+        _SWE_TLS.ready = False
+        _swe_ready()
+        ENGINE.warm_up()
+        STARTUP["pid"] = os.getpid()
+        _READY.set()
+    start_jobs()
+
+def is_ready() -> bool:
+    return _READY.is_set()
+
+@app.before_request
+def _swe_thread_init():
+    _swe_ready()
+    if METRICS_ON:
+        g.nk_t0 = time.perf_counter()
+
+@app.after_request
+def _count_request(resp):
+    t0 = g.get("nk_t0") if METRICS_ON else None
+    if t0 is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        METRICS.inc("nk_requests_total", (("endpoint", endpoint), ("status", str(resp.status_code))))
+
+        def observe():
+            METRICS.observe("nk_request_duration_seconds", (("endpoint", endpoint),),
+                            time.perf_counter() - t0, REQUEST_BUCKETS)
+        # поточните отговори (NDJSON) се произвеждат след after_request → мерим до затварянето им
+        if resp.is_streamed:
+            resp.call_on_close(observe)
+        else:
+            observe()
+    return resp
 
 @app.after_request
 def add_cors(resp):
@@ -694,7 +2991,10 @@ def add_cors(resp):
 # ---------- HEALTH ----------
 @app.route('/health', methods=['GET'])
 def health():
-    return jsonify(ok=True), 200
+    # ready=false (503), докато warm_up() не е приключил
+    if not is_ready():
+        return jsonify(ok=False, ready=False, startup=STARTUP), 503
+    return jsonify(ok=True, ready=True, startup=STARTUP), 200
 
 # ---------- DEBUG ----------
 @app.route('/debug', methods=['GET'], endpoint='nk_debug')
@@ -713,11 +3013,11 @@ def debug():
         ut_hour  = dt_utc.hour + dt_utc.minute/60.0 + dt_utc.second/3600.0
         jd       = swe.julday(dt_utc.year, dt_utc.month, dt_utc.day, ut_hour)
 
-        def compute_variant(label, ayanamsha_const, node_is_true):
-            swe.set_sid_mode(ayanamsha_const)
-            houses, ascmc = houses_safe(jd, lat, lon, flags=FLAGS_TROP, hsys=b'P')
+        def compute_variant(label, ayanamsha_name, node_is_true):
+            eng = ChartEngine(ayanamsha=ayanamsha_name, node_type=("TRUE" if node_is_true else "MEAN"))
+            houses, ascmc = eng.houses(jd, lat, lon, hsys=b'P')
             asc_trop = ascmc[0] % 360.0
-            ay = _ayanamsha_deg_ut(jd, NK_AYAN_OFFSET_JH)
+            ay = eng.ayanamsha(jd, NK_AYAN_OFFSET_JH)
             asc = _sidereal_from_tropical(asc_trop, ay)
 
             res = {
@@ -736,7 +3036,7 @@ def debug():
             ]:
                 pos, _ = swe.calc_ut(jd, pid, FLAGS_TROP)
                 trop = pos[0] % 360.0
-                ay = _ayanamsha_deg_ut(jd)
+                ay = eng.ayanamsha(jd)
                 L = _sidereal_from_tropical(trop, ay)
                 n, p = nak_pada(L)
                 res["Planets"].append({
@@ -750,7 +3050,7 @@ def debug():
             node_id = swe.TRUE_NODE if node_is_true else swe.MEAN_NODE
             node_pos, _ = swe.calc_ut(jd, node_id, FLAGS_TROP)
             trop_rah = node_pos[0] % 360.0
-            ay = _ayanamsha_deg_ut(jd)
+            ay = eng.ayanamsha(jd)
             rahu_L = _sidereal_from_tropical(trop_rah, ay)
             ketu_L = (rahu_L + 180.0) % 360.0
             r_n, r_p = nak_pada(rahu_L)
@@ -774,120 +3074,339 @@ def debug():
             return res
 
         variants = [
-            compute_variant("LAHIRI_MEAN+OFF", swe.SIDM_LAHIRI, False),
+            compute_variant("LAHIRI_MEAN+OFF", "LAHIRI", False),
         ]
 
-        swe.set_sid_mode(AYAN_MAP.get(AYAN, swe.SIDM_LAHIRI))
-
         return jsonify({
             "ok": True,
             "ayan_offset_dg": NK_AYAN_OFFSET_DG,
             "ayan_offset_jh": NK_AYAN_OFFSET_JH,
+            "ayan_table": AYANAMSHA_TABLE is not None,
+            "tz_grid": (_TZ_GRID.path if _TZ_GRID is not None else None),
+            "tz_cache": _TZ_CACHE.stats(),
+            "lagna_cache": LAGNA_CACHE.stats(),
+            "sun_cache": SUN_CACHE.stats(),
             "sidereal_variants": variants
         }), 200
 
     except Exception as e:
         return jsonify({"ok": False, "error": str(e), "trace": traceback.format_exc()}), 500
 
-# ---------- CALCULATE ----------
-@app.route('/calculate', methods=['POST', 'OPTIONS'])
-def calculate():
-    if request.method == 'OPTIONS':
-        return ('', 204)
-    try:
-        data = request.get_json(force=True)
-        calc_type = data.get("calc_type", "standard")   # ---------- ПРЕВКЛЮЧВАТЕЛ ----------
-        HSYS = b'P'
-        date_str = data.get('date')
-        time_str = data.get('time')
-        tz_sent = data.get('timezone')
-        tz_str   = tz_sent
-        lat = float(data.get('lat'))
-        lon = float(data.get('lon'))
+# ---------- METRICS ----------
+# Времена по етапи на /calculate и броячи на заявките, в Prometheus текстов формат
+# (/metrics). Наблюдението е O(1) (bisect + събиране под lock); текстът се сглобява
+# само при scrape. NK_METRICS=0 изключва всичко. Броячите са на процес: при
+# gunicorn всеки работник има свои (Prometheus вижда този, който отговаря), а в
+# NK_EXEC_MODE=process етапите на самата карта се мерят в пула и не се виждат тук.
+METRICS_ON = os.getenv("NK_METRICS", "1") == "1"
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CALC_TYPES = ("standard", "devaguru")
+
+class Metrics:
+    """Хистограми и броячи с етикети (label-ите са наредени двойки)."""
+
+    HELP = {
+        "nk_stage_duration_seconds": ("histogram", "Време на етап от изчисляването на карта."),
+        "nk_request_duration_seconds": ("histogram", "Време за обработка на HTTP заявка."),
+        "nk_requests_total": ("counter", "HTTP заявки по endpoint и статус."),
+        "nk_charts_total": ("counter", "Изчислени карти по calc_type и източник (computed/memory/disk/coalesced/batch)."),
+        "nk_chart_errors_total": ("counter", "Неуспешни карти по calc_type."),
+    }
 
-        # Автоматично време-зона по координати (иначе Лондон може да остане 'Europe/Sofia')
-        tz_str = resolve_timezone(lat, lon, tz_sent)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hist = {}       # (име, етикети) → [буфер по кофи + 1, сума, брой]
+        self._count = {}      # (име, етикети) → брой
+        self._buckets = {}
+
+    def observe(self, name: str, labels: tuple, value: float, buckets=STAGE_BUCKETS):
+        i = bisect.bisect_left(buckets, value)
+        with self._lock:
+            h = self._hist.get((name, labels))
+            if h is None:
+                h = self._hist[(name, labels)] = [[0] * (len(buckets) + 1), 0.0, 0]
+                self._buckets[name] = buckets
+            h[0][i] += 1
+            h[1] += value
+            h[2] += 1
+
+    def inc(self, name: str, labels: tuple, n: int = 1):
+        with self._lock:
+            self._count[(name, labels)] = self._count.get((name, labels), 0) + n
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        with self._lock:
+            hist = {k: (list(v[0]), v[1], v[2]) for k, v in self._hist.items()}
+            count = dict(self._count)
+        lines = []
+        for name, (kind, text) in self.HELP.items():
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                buckets = self._buckets.get(name, ())
+                for (n, labels), (counts, total, cnt) in sorted(hist.items()):
+                    if n != name:
+                        continue
+                    acc = 0
+                    for le, c in zip(buckets, counts):
+                        acc += c
+                        lines.append(f"{name}_bucket{self._labels(labels, 'le=' + json.dumps(format(le, 'g')))} {acc}")
+                    lines.append(f"{name}_bucket{self._labels(labels, 'le=' + json.dumps('+Inf'))} {cnt}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total:.9g}")
+                    lines.append(f"{name}_count{self._labels(labels)} {cnt}")
+            else:
+                for (n, labels), v in sorted(count.items()):
+                    if n == name:
+                        lines.append(f"{name}{self._labels(labels)} {v}")
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+class _StageTimer:
+    __slots__ = ("labels", "t0")
+
+    def __init__(self, stage: str):
+        self.labels = (("stage", stage),)
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        METRICS.observe("nk_stage_duration_seconds", self.labels, time.perf_counter() - self.t0)
+        return False
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+def stage(name: str):
+    """with stage("houses"): ... – мери етапа в nk_stage_duration_seconds."""
+    return _StageTimer(name) if METRICS_ON else _NO_TIMER
+
+def _calc_type_label(data) -> str:
+    ct = data.get("calc_type", "standard") if isinstance(data, dict) else "standard"
+    return ct if ct in CALC_TYPES else "other"
 
+# ---------- CALCULATE ----------
+# ---------- SECTIONS ----------
+# Секциите на /calculate и изчисленията, от които зависят:
+#   houses  – куспиди/лагна (swe.houses)
+#   planets – всички тела с възлите (включва sun и moon)
+#   sun/moon – само Слънцето/Луната
+# include=/exclude= избират секции; смята се само нужното за тях.
+CHART_SECTIONS = {
+    "config":      (),
+    "Ascendant":   ("houses",),
+    "Planets":     ("planets",),
+    "Moon":        ("moon",),
+    "D9":          ("planets", "houses"),
+    "ArudhaLagna": ("planets", "houses"),
+    "Vargas":      ("planets", "houses"),
+    "Panchanga":   ("sun", "moon"),
+    "Vimshottari": ("moon",),
+    "Ashtakavarga": ("planets", "houses"),
+    "Shadbala":    ("planets", "houses"),
+}
+DEFAULT_SECTIONS = ("config", "Ascendant", "Planets", "D9", "ArudhaLagna", "Panchanga", "Vimshottari")
+_SECTION_NAMES = {name.lower(): name for name in CHART_SECTIONS}
+
+def chart_stages(sections) -> set:
+    """Изчисленията, нужни за дадените секции."""
+    stages = {st for sec in sections for st in CHART_SECTIONS[sec]}
+    if "planets" in stages:
+        stages |= {"sun", "moon"}
+    return stages
+
+def _section_list(value) -> list:
+    if isinstance(value, str):
+        value = value.split(",")
+    out = []
+    for v in value:
+        name = _SECTION_NAMES.get(str(v).strip().lower())
+        if name is None:
+            raise ValueError(f"непозната секция: {v}")
+        out.append(name)
+    return out
 
-        use_lmt = bool(data.get('use_lmt', False))
-        jd, dt_utc = dt_to_jd(date_str, time_str, tz_str, lon=lon, use_lmt=use_lmt)
-        dt_local = dt_utc.astimezone(_safe_zoneinfo(tz_str))
+def parse_sections(include=None, exclude=None, vargas: tuple = ()) -> tuple:
+    """
+    Секциите за include=/exclude= (имена като ключовете на отговора, без значение
+    от регистъра; низ със запетаи или списък). Без include – DEFAULT_SECTIONS
+    (+ "Vargas", ако е подаден vargas=).
+    """
+    chosen = set(_section_list(include)) if include else set(DEFAULT_SECTIONS) | ({"Vargas"} if vargas else set())
+    if exclude:
+        chosen -= set(_section_list(exclude))
+    return tuple(name for name in CHART_SECTIONS if name in chosen)
 
-        # инфо
-        swe.set_sid_mode(AYAN_MAP.get(AYAN, swe.SIDM_LAHIRI))
+def chart_inputs(data: dict, tz_cache: dict | None = None) -> dict:
+    """
+    Нормализирани входни данни на /calculate: часова зона, UTC момент (jd, dt_utc),
+    координати, calc_type, use_lmt. Оттук нататък картата зависи само от тях.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("очаква се JSON обект")
+
+    calc_type = data.get("calc_type", "standard")   # ---------- ПРЕВКЛЮЧВАТЕЛ ----------
+    date_str = data.get('date')
+    time_str = data.get('time')
+    tz_sent = data.get('timezone')
+    tz_str   = tz_sent
+    lat = float(data.get('lat'))
+    lon = float(data.get('lon'))
+
+    # Автоматично време-зона по координати (иначе Лондон може да остане 'Europe/Sofia')
+    with stage("resolve_timezone"):
+        if tz_cache is not None:
+            tz_key = (lat, lon, tz_sent)
+            tz_str = tz_cache.get(tz_key)
+            if tz_str is None:
+                tz_str = tz_cache[tz_key] = resolve_timezone(lat, lon, tz_sent)
+        else:
+            tz_str = resolve_timezone(lat, lon, tz_sent)
 
-        # Asc: тропически → сидерален с нашата айанамша+offset
 
-        # --- Лагна (Ascendant) ---
-        # --- DG / JH координати ---
-        lat_use = lat
-        lon_use = lon
+    use_lmt = bool(data.get('use_lmt', False))
+    with stage("dt_to_jd"):
+        jd, dt_utc = dt_to_jd(date_str, time_str, tz_str, lon=lon, use_lmt=use_lmt)
 
-        # --- Лагна (Ascendant) ---
-        ayan_off = NK_AYAN_OFFSET_DG if calc_type == "devaguru" else NK_AYAN_OFFSET_JH
-        ayan = _ayanamsha_deg_ut(jd, ayan_off)
-        ayan_base = ayan - float(ayan_off)
+    # варги и секции: "Vargas" в include без vargas= → всички
+    vargas = parse_vargas(data.get("vargas"))
+    if not vargas and data.get("include") and "Vargas" in _section_list(data["include"]):
+        vargas = VARGA_DIVISIONS
 
-        houses, ascmc = houses_safe(
-            jd,
-            lat_use,
-            lon_use,
-            flags=FLAGS_TROP,
-            hsys=HSYS
-        )
+    return {
+        "calc_type": calc_type,
+        "tz_sent": tz_sent,
+        "tz_used": tz_str,
+        "lat": lat,
+        "lon": lon,
+        "use_lmt": use_lmt,
+        "jd": jd,
+        "dt_utc": dt_utc,
+        "vargas": vargas,
+        "sections": parse_sections(data.get("include"), data.get("exclude"), vargas),
+    }
+
+def compute_chart(data: dict, tz_cache: dict | None = None, ayan_cache: dict | None = None,
+                  engine: "ChartEngine | None" = None, inputs: dict | None = None,
+                  strength: list | None = None) -> dict:
+    """
+    Изчислява една карта по входните данни на /calculate и връща отговора като dict.
+    При невалидни данни хвърля изключение (извикващият решава как да го отчете).
+
+    tz_cache / ayan_cache – по желание общи речници за batch режим, за да не
+    повтаряме търсенето на часова зона и айанамша за еднакви координати / JD.
+    engine – конфигурацията (айанамша/възел/offset-и); по подразбиране ENGINE.
+    inputs – вече нормализирани входни данни (chart_inputs), ако ги има.
+    strength – в batch: списък, в който се отлагат "Ashtakavarga"/"Shadbala"
+    (res, ред, секции) за общ векторен проход (fill_strength); иначе се смятат веднага.
+    """
+    eng = engine or ENGINE
+    inp = inputs if inputs is not None else chart_inputs(data, tz_cache)
+
+    calc_type = inp["calc_type"]
+    HSYS = b'P'
+    tz_sent = inp["tz_sent"]
+    tz_str = inp["tz_used"]
+    lat = inp["lat"]
+    lon = inp["lon"]
+    jd = inp["jd"]
+    dt_utc = inp["dt_utc"]
+    dt_local = dt_utc.astimezone(_safe_zoneinfo(tz_str))
+
+    # Asc: тропически → сидерален с нашата айанамша+offset
+
+    # --- Лагна (Ascendant) ---
+    # --- DG / JH координати ---
+    lat_use = lat
+    lon_use = lon
+
+    # --- Лагна (Ascendant) ---
+    ayan_off = eng.ayan_offset(calc_type)
+    with stage("ayanamsha"):
+        if ayan_cache is not None:
+            ayan_base = ayan_cache.get(jd)
+            if ayan_base is None:
+                ayan_base = ayan_cache[jd] = eng.ayanamsha(jd)
+            ayan = ayan_base + float(ayan_off)
+        else:
+            ayan = eng.ayanamsha(jd, ayan_off)
+    ayan_base = ayan - float(ayan_off)
+
+    sections = inp.get("sections") or DEFAULT_SECTIONS
+    stages = chart_stages(sections)
+
+    asc = None
+    if "houses" in stages:
+        with stage("houses"):
+            houses, ascmc = eng.houses(
+                jd,
+                lat_use,
+                lon_use,
+                hsys=HSYS
+            )
 
         asc_trop = ascmc[0] % 360.0
         asc = _sidereal_from_tropical(asc_trop, ayan)
-        # Asc: тропически → сидерален с нашата айанамша+offset
-        # ayan = _ayanamsha_deg_ut(jd)
-        # houses, ascmc = houses_safe(jd, lat, lon, flags=FLAGS_TROP, hsys=HSYS)
-        # asc_trop = ascmc[0] % 360.0
-        # asc = _sidereal_from_tropical(asc_trop, ayan)
-
-        # Планети (сидерално)
-        # --- Планети (DG / JH) ---
-        # Планети винаги геоцентрично (иначе Луната в DG избяга с минути)
-        planets = planet_longitudes(jd, use_sidereal=True, ayan_override=ayan, topo=False)
+    # Asc: тропически → сидерален с нашата айанамша+offset
+    # ayan = _ayanamsha_deg_ut(jd)
+    # houses, ascmc = houses_safe(jd, lat, lon, flags=FLAGS_TROP, hsys=HSYS)
+    # asc_trop = ascmc[0] % 360.0
+    # asc = _sidereal_from_tropical(asc_trop, ayan)
+
+    # Планети (сидерално)
+    # --- Планети (DG / JH) ---
+    # Планети винаги геоцентрично (иначе Луната в DG избяга с минути)
+    # Без "planets" се смятат само Слънцето/Луната, ако някоя секция ги иска.
+    with stage("planets"):
+        if "planets" in stages:
+            planets = eng.planets(jd, ayan, topo=False)
+        else:
+            bodies = [name for name, st in (("Слънце", "sun"), ("Луна", "moon")) if st in stages]
+            planets = eng.planets(jd, ayan, topo=False, bodies=bodies) if bodies else []
 
 
-        # Слънце/Луна за Панчанга (ползваме вече сидералните)
-        sun_lon = next((p["longitude"] for p in planets if p["planet"] == "Слънце"), None)
-        moon_lon = next((p["longitude"] for p in planets if p["planet"] == "Луна"), None)
+    # Слънце/Луна за Панчанга (ползваме вече сидералните)
+    sun_lon = next((p["longitude"] for p in planets if p["planet"] == "Слънце"), None)
+    moon_lon = next((p["longitude"] for p in planets if p["planet"] == "Луна"), None)
 
-        panchanga = None
-        if sun_lon is not None and moon_lon is not None:
-            panchanga = compute_panchanga(jd, dt_local, sun_lon, moon_lon)
+    panchanga = None
+    if "Panchanga" in sections and sun_lon is not None and moon_lon is not None:
+        with stage("panchanga"):
+            panchanga = compute_panchanga(jd, dt_local, sun_lon, moon_lon, ayan_off=ayan_off,
+                                          lat=lat_use, lon=lon_use)
 
+    with stage("d9_arudha_karakas"):
         # 8 Chara Karaka с Раху (без Кету)
-        ck_map = compute_chara_karakas(planets)
-        for p in planets:
-            name = p.get("planet")
-            if name in ck_map:
-                p["chara_karaka"] = ck_map[name]
-                
-        # --- D9 Навамша ---
-        d9_planets = []
-        for p in planets:
-            d9_sign = d9_sign_name_from_lon(p["longitude"])
-            d9_planets.append({
-                "planet": p["planet"],
-                "sign": d9_sign,
-                "retrograde": bool(p.get("retrograde"))
-            })
-        d9_asc_sign = d9_sign_name_from_lon(asc)
-
-        # AL за D9 (по същото правило като при D1)
-        try:
-            asc_idx_d9 = SIGNS.index(d9_asc_sign)
-            al_d9_sign = compute_arudha_lagna(asc_idx_d9, d9_planets)
-        except Exception:
-            al_d9_sign = None
-
-        # Базов отговор
-        res = {
-            "config": {
-                "ayanamsha": AYAN,
-                "node_type": NODE,
+        if "Planets" in sections:
+            ck_map = compute_chara_karakas(planets)
+            for p in planets:
+                name = p.get("planet")
+                if name in ck_map:
+                    p["chara_karaka"] = ck_map[name]
+
+        res = {}
+        if "config" in sections:
+            res["config"] = {
+                "ayanamsha": eng.ayanamsha_name,
+                "node_type": eng.node_type,
                 "ephe_path": EPHE_PATH,
                 "build": BUILD_STAMP,
                 "ayan_base": float(ayan_base),
@@ -895,55 +3414,1804 @@ def calculate():
                 "ayan_offset": float(ayan_off),
                 "tz_sent": tz_sent,
                 "tz_used": tz_str
-            },
-            "Ascendant": {
+            }
+        if "Ascendant" in sections:
+            res["Ascendant"] = {
                 "degree": round(asc, 6),
                 "sign": sign_of(asc)
-            },
-            "Planets": planets,
-            "D9": {
+            }
+        if "Planets" in sections:
+            res["Planets"] = planets
+        if "Moon" in sections:
+            res["Moon"] = next((dict(p) for p in planets if p["planet"] == "Луна"), None)
+
+        # --- D9 Навамша ---
+        if "D9" in sections:
+            d9_planets = []
+            for p in planets:
+                d9_sign = d9_sign_name_from_lon(p["longitude"])
+                d9_planets.append({
+                    "planet": p["planet"],
+                    "sign": d9_sign,
+                    "retrograde": bool(p.get("retrograde"))
+                })
+            d9_asc_sign = d9_sign_name_from_lon(asc)
+
+            # AL за D9 (по същото правило като при D1)
+            try:
+                asc_idx_d9 = SIGN_INDEX[d9_asc_sign]
+                al_d9_sign = compute_arudha_lagna(asc_idx_d9, d9_planets)
+            except Exception:
+                al_d9_sign = None
+
+            res["D9"] = {
                 "Ascendant": {"sign": d9_asc_sign},
                 "ArudhaLagna": ({"sign": al_d9_sign} if al_d9_sign else None),
                 "Planets": d9_planets
             }
-        }
 
         # Арудха Лагна (Arudha Lagna), съвместима с фронта
-        try:
-            asc_index = SIGNS.index(sign_of(asc))
-            al_sign = compute_arudha_lagna(asc_index, planets)
-            if al_sign:
-                # фронтът очаква или {degree}, или {sign}
-                res["ArudhaLagna"] = {"sign": al_sign}
-        except Exception:
-            # не чупим нищо, ако нещо се обърка
-            pass
-
-        # Панчанга
-        if panchanga:
-            res["Panchanga"] = panchanga
-        # --- Вимшоттари-даша (на база сидералната Луна) ---
+        if "ArudhaLagna" in sections:
+            try:
+                asc_index = SIGN_INDEX[sign_of(asc)]
+                al_sign = compute_arudha_lagna(asc_index, planets)
+                if al_sign:
+                    # фронтът очаква или {degree}, или {sign}
+                    res["ArudhaLagna"] = {"sign": al_sign}
+            except Exception:
+                # не чупим нищо, ако нещо се обърка
+                pass
+
+    # Варги (по заявка: vargas=...)
+    if "Vargas" in sections and inp.get("vargas"):
+        with stage("vargas"):
+            res["Vargas"] = compute_vargas(planets, asc, inp["vargas"])
+
+    # Панчанга
+    if panchanga:
+        res["Panchanga"] = panchanga
+    # --- Вимшоттари-даша (на база сидералната Луна) ---
+    if "Vimshottari" in sections:
         try:
             if moon_lon is not None:
-                vim = vimsottari_generate(dt_utc, float(moon_lon), horizon_years=120.0)
+                with stage("vimshottari"):
+                    vim = vimsottari_generate(dt_utc, float(moon_lon), horizon_years=120.0)
                 if vim:
                     res["Vimshottari"] = vim
         except Exception:
             pass
 
-        return jsonify(res), 200
+    # Аштакаварга / шадбала (по заявка)
+    wanted = [sec for sec in ("Ashtakavarga", "Shadbala") if sec in sections]
+    if wanted:
+        with stage("strength"):
+            row = strength_row(jd, lat_use, lon_use, dt_local, planets, asc, ascmc, ayan)
+            if strength is not None:
+                strength.append((res, row, wanted))
+            else:
+                res.update(strength_sections([row], wanted)[0])
+
+    return res
+
+def fill_strength(pending: list):
+    """Попълва отложените от compute_chart(strength=...) секции – по един проход за група секции."""
+    groups = {}
+    for res, row, wanted in pending:
+        groups.setdefault(tuple(wanted), []).append((res, row))
+    for wanted, items in groups.items():
+        with stage("strength"):
+            parts = strength_sections([row for _res, row in items], wanted)
+        for (res, _row), part in zip(items, parts):
+            res.update(part)
+
+# ---------- RESULT CACHE ----------
+# Кеш на готови карти по нормализираните входни данни (UTC момент, координати,
+# calc_type, use_lmt, часова зона, конфигурация на двигателя, BUILD_STAMP) и
+# настройките от средата, които менят отговора (result_cache_env()).
+#   NK_RESULT_CACHE_SIZE / NK_RESULT_CACHE_MB – граници на LRU в паметта (0 = изключен)
+#   NK_RESULT_CACHE_DB                         – SQLite файл за второ ниво (оцелява рестарт)
+#   NK_RESULT_CACHE_DB_MAX                     – макс. записи в SQLite (най-старите се трият)
+RESULT_CACHE_VERSION = 2
+
+def result_cache_env() -> list:
+    """NK_* настройките, от които зависи тялото на /calculate (извън ChartEngine и jd)."""
+    return [VARA_FROM_SUNRISE, repr(SUN_CELL_DEG), AYAN_TABLE_ON]
+
+def chart_cache_key(inp: dict, eng: "ChartEngine", extra: dict | None = None) -> str:
+    norm = [
+        RESULT_CACHE_VERSION, BUILD_STAMP, result_cache_env(),
+        repr(inp["jd"]), repr(inp["lat"]), repr(inp["lon"]),
+        inp["calc_type"], inp["use_lmt"], inp["tz_used"], inp["tz_sent"],
+        eng.ayanamsha_name, eng.node_type, repr(eng.offset_dg), repr(eng.offset_jh),
+        extra or {},
+    ]
+    raw = json.dumps(norm, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    Двустепенен кеш за резултати, пазени като готово JSON тяло (както го дава jsonify):
+    LRU в паметта (граница по брой и байтове) + по желание SQLite на диска.
+    Еднакви едновременни заявки се обединяват – смята само първата, останалите чакат.
+    """
+
+    def __init__(self, max_items: int, max_bytes: int, db_path: str | None = None, db_max: int = 100000):
+        self.max_items = max(0, int(max_items))
+        self.max_bytes = max(0, int(max_bytes))
+        self._mem = OrderedDict()      # key → bytes
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._inflight = {}            # key → [Event, result, error]
+        self.hits_mem = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.db_path = db_path
+        self.db_max = int(db_max)
+        self._db = None
+        self._db_writes = 0
+        if db_path:
+            import sqlite3
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache ("
+                " key TEXT PRIMARY KEY, value BLOB NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS result_cache_created ON result_cache(created)")
+            self._db_lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return (self.max_items > 0 and self.max_bytes > 0) or self._db is not None
+
+    # ---- паметта ----
+    def _mem_get(self, key):
+        blob = self._mem.get(key)
+        if blob is not None:
+            self._mem.move_to_end(key)
+        return blob
+
+    def _mem_put(self, key, blob: bytes):
+        if self.max_items <= 0 or len(blob) > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._mem[key] = blob
+        self._bytes += len(blob)
+        while len(self._mem) > self.max_items or self._bytes > self.max_bytes:
+            _, ev = self._mem.popitem(last=False)
+            self._bytes -= len(ev)
+            self.evictions += 1
+
+    # ---- диска ----
+    def _db_get(self, key):
+        if self._db is None:
+            return None
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM result_cache WHERE key = ?", (key,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def _db_put(self, key, blob: bytes):
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO result_cache(key, value, created) VALUES (?, ?, ?)",
+                (key, blob, time.time()),
+            )
+            self._db_writes += 1
+            if self._db_writes % 1000 == 0:
+                self._db.execute(
+                    "DELETE FROM result_cache WHERE key IN ("
+                    " SELECT key FROM result_cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.db_max,),
+                )
+
+    # ---- публично ----
+    def get_or_compute(self, key: str, compute, encode=None):
+        """
+        compute() → dict. Връща (тялото от encode – по подразбиране JSON bytes, откъде),
+        откъде е 'memory' | 'disk' | 'coalesced' | 'computed'.
+        """
+        encode = encode or _json_body
+        with self._lock:
+            blob = self._mem_get(key)
+            if blob is not None:
+                self.hits_mem += 1
+                return blob, "memory"
+            waiter = self._inflight.get(key)
+            if waiter is None:
+                waiter = self._inflight[key] = [threading.Event(), None, None]
+                owner = True
+            else:
+                self.coalesced += 1
+                owner = False
+
+        if not owner:
+            waiter[0].wait()
+            if waiter[2] is not None:
+                raise waiter[2]
+            return waiter[1], "coalesced"
+
+        try:
+            source = "disk"
+            blob = self._db_get(key)
+            if blob is None:
+                source = "computed"
+                blob = encode(compute())
+                self._db_put(key, blob)
+            with self._lock:
+                if source == "disk":
+                    self.hits_disk += 1
+                else:
+                    self.misses += 1
+                self._mem_put(key, blob)
+            waiter[1] = blob
+            return blob, source
+        except Exception as e:
+            waiter[2] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            waiter[0].set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.hits_mem + self.hits_disk + self.coalesced
+            total = hits + self.misses
+            out = {
+                "entries": len(self._mem),
+                "max_entries": self.max_items,
+                "memory_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits_memory": self.hits_mem,
+                "hits_disk": self.hits_disk,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (hits / total) if total else 0.0,
+                "inflight": len(self._inflight),
+            }
+        if self._db is not None:
+            with self._db_lock:
+                out["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM result_cache").fetchone()[0]
+            out["disk_path"] = self.db_path
+        return out
+
+RESULT_CACHE = ResultCache(
+    int(os.getenv("NK_RESULT_CACHE_SIZE", "1024")),
+    int(float(os.getenv("NK_RESULT_CACHE_MB", "64")) * 1024 * 1024),
+    db_path=os.getenv("NK_RESULT_CACHE_DB") or None,
+    db_max=int(os.getenv("NK_RESULT_CACHE_DB_MAX", "100000")),
+)
+
+def chart_options(inp: dict) -> dict | None:
+    """Опциите извън подразбиращите се (за ключа на кеша); None при отговор по подразбиране."""
+    extra = {}
+    if inp.get("vargas"):
+        extra["vargas"] = inp["vargas"]
+    if inp.get("sections") and inp["sections"] != DEFAULT_SECTIONS:
+        extra["sections"] = inp["sections"]
+    return extra or None
+
+# ---------- RESPONSE FORMATS ----------
+# /calculate и /calculate/batch: ?format=json (по подразбиране – байт по байт
+# като jsonify) | fastjson (orjson, UTF-8 без \u-escape) | msgpack, или Accept:
+# application/msgpack. ?schema=compact заменя имената (знак, накшатра, граха,
+# титхи, йога, карана, вара, чара карака) с индекси в таблиците от /schema.
+# orjson и msgpack са по желание: без orjson fastjson е stdlib json с UTF-8.
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+try:
+    import msgpack
+except Exception:
+    msgpack = None
+
+SCHEMA_VERSION = 1
+COMPACT_TABLES = {
+    "sign": SIGNS,
+    "nakshatra": NAK,
+    "graha": DASHA_SEQ,
+    "tithi": TITHI_NAMES,
+    "yoga": YOGA_NAMES,
+    "karana": KARANA_MOVABLE + KARANA_FIXED,
+    "vara": VARA_NAMES,
+    "chara_karaka": [code for code, _full in CHARA_KARAKA_LABELS],
+}
+# ключ със стойност-низ → таблица; "name" се определя от родителския ключ (Panchanga.tithi.name …)
+COMPACT_FIELDS = {"sign": "sign", "nakshatra": "nakshatra", "planet": "graha", "lord": "graha",
+                  "chara_karaka": "chara_karaka"}
+COMPACT_NAMES = {"tithi": "tithi", "nakshatra": "nakshatra", "yoga": "yoga", "karana": "karana", "vara": "vara"}
+_COMPACT_INDEX = {table: {name: i for i, name in enumerate(names)} for table, names in COMPACT_TABLES.items()}
+
+MSGPACK_MIMETYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+RESPONSE_FORMATS = ("json", "fastjson", "msgpack")
+
+def chart_schema() -> dict:
+    """Таблиците за ?schema=compact (отдава се от /schema)."""
+    return {
+        "version": SCHEMA_VERSION,
+        "tables": COMPACT_TABLES,
+        "fields": COMPACT_FIELDS,
+        "name_fields": COMPACT_NAMES,
+    }
+
+def compact_chart(obj, parent: str | None = None):
+    """Копие на отговора с индекси вместо имена; непознат низ остава както е."""
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            if isinstance(v, str):
+                table = COMPACT_FIELDS.get(k) or (COMPACT_NAMES.get(parent) if k == "name" else None)
+                if table is not None:
+                    v = _COMPACT_INDEX[table].get(v, v)
+            elif isinstance(v, (dict, list)):
+                v = compact_chart(v, k)
+            out[k] = v
+        return out
+    if isinstance(obj, list):
+        return [compact_chart(v, parent) for v in obj]
+    return obj
+
+def negotiate_format(args=None, accept=None) -> tuple:
+    """(format, compact) от ?format=/?schema= или Accept. ValueError при непознат формат/схема."""
+    args = request.args if args is None else args
+    fmt = (args.get("format") or "").strip().lower()
+    if not fmt:
+        accept = request.accept_mimetypes if accept is None else accept
+        best = accept.best_match(("application/json",) + MSGPACK_MIMETYPES, default="application/json")
+        fmt = "msgpack" if best in MSGPACK_MIMETYPES else "json"
+    if fmt not in RESPONSE_FORMATS:
+        raise ValueError(f"непознат формат: {fmt} (очаква се {', '.join(RESPONSE_FORMATS)})")
+    schema = (args.get("schema") or "").strip().lower()
+    if schema not in ("", "full", "compact"):
+        raise ValueError(f"непозната схема: {schema} (full или compact)")
+    return fmt, schema == "compact"
+
+def _fastjson_body(obj) -> bytes:
+    with stage("fastjson_serialize"):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _msgpack_body(obj) -> bytes:
+    with stage("msgpack_serialize"):
+        return msgpack.packb(obj, use_bin_type=True)
+
+def body_encoder(fmt: str = "json", compact: bool = False):
+    """obj → bytes за формата; при compact имената минават през compact_chart."""
+    enc = {"json": _json_body, "fastjson": _fastjson_body, "msgpack": _msgpack_body}[fmt]
+    if not compact:
+        return enc
+    return lambda obj: enc(compact_chart(obj))
+
+def body_response(blob: bytes, fmt: str = "json", compact: bool = False, status: int = 200):
+    """Отговор от готово тяло; json и fastjson завършват с нов ред като jsonify."""
+    if fmt == "msgpack":
+        resp = app.response_class(blob, status=status, mimetype=MSGPACK_MIMETYPES[0])
+    else:
+        resp = _json_body_response(blob, status)
+    if compact:
+        resp.headers["X-NK-Schema"] = str(SCHEMA_VERSION)
+    resp.vary.add("Accept")
+    return resp
+
+def cached_chart(data: dict, fmt: str = "json", compact: bool = False) -> bytes:
+    """
+    compute_chart през RESULT_CACHE (ако е включен) и пула от процеси (ако е избран).
+    Връща тялото във формата fmt; за json – байт по байт същото като от jsonify.
+    """
+    inp = chart_inputs(data)
+    encode = body_encoder(fmt, compact)
+
+    def compute():
+        if NK_EXEC_MODE == "process":
+            res = get_pool().submit(_pool_chart, data).result()
+        else:
+            res = ENGINE.chart(data, inputs=inp)
+        if CHART_STORE_AUTO and CHART_STORE_PATH:
+            store_chart(data, inp, res)
+        return res
+
+    if not RESULT_CACHE.enabled:
+        blob, source = encode(compute()), "computed"
+    else:
+        extra = chart_options(inp)
+        if fmt != "json" or compact:
+            extra = dict(extra or {}, format=fmt, compact=compact)
+        key = chart_cache_key(inp, ENGINE, extra=extra)
+        blob, source = RESULT_CACHE.get_or_compute(key, compute, encode)
+    if METRICS_ON:
+        METRICS.inc("nk_charts_total", (("calc_type", _calc_type_label(data)), ("source", source)))
+    return blob
+
+def _json_body(obj) -> bytes:
+    """JSON тяло с настройките, които ползва jsonify (без крайния нов ред)."""
+    prov = app.json
+    with stage("json_serialize"):
+        if (prov.compact is None and app.debug) or prov.compact is False:
+            return prov.dumps(obj, indent=2).encode("utf-8")
+        return prov.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def _json_body_response(blob: bytes, status: int = 200):
+    """Отговор от готово JSON тяло – същото като jsonify(obj)."""
+    return app.response_class(blob + b"\n", status=status, mimetype=app.json.mimetype)
+
+@app.route('/calculate', methods=['POST', 'OPTIONS'])
+def calculate():
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        fmt, compact = negotiate_format()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    if fmt == "msgpack" and msgpack is None:
+        return jsonify({"ok": False, "error": "msgpack не е наличен на сървъра"}), 406
+    data = None
+    try:
+        with stage("json_parse"):
+            data = request.get_json(force=True)
+
+        return body_response(cached_chart(data, fmt, compact), fmt, compact)
 
     except Exception as e:
+        if METRICS_ON:
+            METRICS.inc("nk_chart_errors_total", (("calc_type", _calc_type_label(data)),))
         return jsonify({
             "ok": False,
             "error": str(e),
             "trace": traceback.format_exc()
         }), 500
 
+@app.route('/schema', methods=['GET'])
+def schema():
+    """Таблиците за ?schema=compact – кешируеми (ETag + Cache-Control)."""
+    resp = jsonify(chart_schema())
+    resp.set_etag(hashlib.sha256(resp.get_data()).hexdigest()[:16])
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 86400
+    return resp.make_conditional(request)
+
+# ---------- BATCH ----------
+# Максимален брой записи в една заявка към /calculate/batch
+BATCH_MAX_ITEMS = int(os.getenv("NK_BATCH_MAX_ITEMS", "1000"))
+
+@app.route('/calculate/batch', methods=['POST', 'OPTIONS'])
+def calculate_batch():
+    """
+    Много карти с една заявка.
+    Вход: {"items": [ {..като /calculate..}, ... ]} или направо списък.
+    Изход: {"ok": true, "count": N, "errors": E, "results": [{"index", "ok", "result" | "error"}]}
+    Грешен запис не спира останалите – получава собствен "error".
+    Пропускателна способност (python bench.py batch): в един процес batch-ът пести
+    само режийните на заявката (~2.2–2.5× спрямо цикъл от /calculate – самите карти
+    не се делят); целта ≥ 10× се достига само с NK_EXEC_MODE=process, където
+    парчетата се смятат паралелно в NK_POOL_WORKERS процеса (~2.5× на ядро).
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        fmt, compact = negotiate_format()
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    if fmt == "msgpack" and msgpack is None:
+        return jsonify({"ok": False, "error": "msgpack не е наличен на сървъра"}), 406
+    try:
+        data = request.get_json(force=True)
+        items = data.get("items") if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            return jsonify({"ok": False, "error": "очаква се списък 'items'"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({
+                "ok": False,
+                "error": f"твърде много записи ({len(items)} > {BATCH_MAX_ITEMS})"
+            }), 400
+
+        # общо за целия batch / парче: кеш за часови зони и айанамша
+        if NK_EXEC_MODE == "process" and len(items) > 1:
+            pool = get_pool()
+            step = -(-len(items) // NK_POOL_WORKERS)
+            futures = [pool.submit(_pool_chart_batch, items[i:i + step], i)
+                       for i in range(0, len(items), step)]
+            results = [row for f in futures for row in f.result()]
+        else:
+            results = _pool_chart_batch(items, 0)
+        n_err = sum(1 for r in results if not r["ok"])
+
+        out = {
+            "ok": True,
+            "count": len(items),
+            "errors": n_err,
+            "results": results
+        }
+        if fmt == "json" and not compact:
+            return jsonify(out), 200
+        return body_response(body_encoder(fmt, compact)(out), fmt, compact)
+
+    except Exception as e:
+        return jsonify({
+            "ok": False,
+            "error": str(e),
+            "trace": traceback.format_exc()
+        }), 500
+
+# ---------- JOBS ----------
+# Асинхронни задачи за големи износи (напр. 1M карти): POST /jobs качва CSV или
+# NDJSON с рождени данни (+ include/exclude/vargas за всички записи) и връща id;
+# GET /jobs/<id> – напредък; GET /jobs/<id>/results – NDJSON редове като в
+# /calculate/batch ({"index", "ok", "result" | "error"}, + "id" ако го има в записа).
+# Състоянието е в SQLite (NK_JOBS_DIR/jobs.sqlite): записите се пазят на парчета по
+# NK_JOB_CHUNK (zlib), резултатът на всяко парче – в NK_JOBS_DIR/<id>/<парче>.ndjson.gz.
+# JobRunner взима парчета с "лизинг" и ги смята в пула от процеси (get_pool, същите
+# _pool_chart_batch); парче на спрял процес се поема отново след NK_JOB_LEASE_S, т.е.
+# след рестарт задачата продължава оттам. Нишката има във всеки процес на сървъра, но
+# смята само един на машина – този, който държи fcntl заключването на
+# NK_JOBS_DIR/runner.lock (останалите чакат да се освободи) → един пул от
+# NK_POOL_WORKERS процеса, не по един на всеки gunicorn работник.
+JOBS_ON = os.getenv("NK_JOBS", "1") == "1"
+JOBS_DIR = os.getenv("NK_JOBS_DIR") or os.path.join(BASE_DIR, "jobs")
+JOB_CHUNK = int(os.getenv("NK_JOB_CHUNK", "500"))
+JOB_MAX_RECORDS = int(os.getenv("NK_JOB_MAX_RECORDS", "2000000"))
+JOB_LEASE_S = float(os.getenv("NK_JOB_LEASE_S", "60"))
+JOB_RETRIES = int(os.getenv("NK_JOB_RETRIES", "3"))
+JOB_POLL_S = 1.0
+JOB_OPTIONS = ("include", "exclude", "vargas", "calc_type", "use_lmt")
+JOB_CSV_FLOATS = ("lat", "lon")
+JOB_CSV_BOOLS = ("use_lmt",)
+
+def _job_chunk(blob: bytes, start: int, options: dict, out_path: str) -> tuple:
+    """В процес от пула: едно парче → gzip NDJSON файл (атомарно). Връща (ok, грешки)."""
+    import gzip
+    import zlib
+    items = [json.loads(line) for line in zlib.decompress(blob).splitlines()]
+    items = [{**options, **item} if isinstance(item, dict) else item for item in items]
+    rows = _pool_chart_batch(items, start)
+    tmp = out_path + ".tmp"
+    errors = 0
+    with gzip.open(tmp, "wb", compresslevel=6) as fh:
+        for row, item in zip(rows, items):
+            if isinstance(item, dict) and "id" in item:
+                row["id"] = item["id"]
+            errors += not row["ok"]
+            fh.write(_json_body(row) + b"\n")
+    os.replace(tmp, out_path)
+    return len(rows) - errors, errors
+
+def _job_csv_record(row: dict) -> dict:
+    """CSV ред → запис като за /calculate (празните клетки се пропускат)."""
+    out = {}
+    for k, v in row.items():
+        if k is None or v is None or v.strip() == "":
+            continue
+        k, v = k.strip(), v.strip()
+        if k in JOB_CSV_FLOATS:
+            v = float(v)
+        elif k in JOB_CSV_BOOLS:
+            v = v.lower() in ("1", "true", "yes", "да")
+        out[k] = v
+    return out
+
+def job_records(stream, kind: str):
+    """Записите от качен файл (kind = "csv" | "ndjson") като речници."""
+    import io
+    if kind == "csv":
+        import csv
+        for row in csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")):
+            yield _job_csv_record(row)
+        return
+    for n, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            raise ValueError(f"ред {n}: невалиден JSON")
+        if not isinstance(rec, dict):
+            raise ValueError(f"ред {n}: очаква се обект")
+        yield rec
+
+class JobStore:
+    """Задачи и парчета в SQLite + резултатите като файлове (по един на парче)."""
+
+    def __init__(self, root: str):
+        import sqlite3
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(root, "jobs.sqlite"), timeout=30,
+                                   check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, options TEXT NOT NULL,"
+            " total INTEGER NOT NULL DEFAULT 0, chunks INTEGER NOT NULL DEFAULT 0,"
+            " done INTEGER NOT NULL DEFAULT 0, errors INTEGER NOT NULL DEFAULT 0,"
+            " created REAL NOT NULL, started REAL, finished REAL, error TEXT);"
+            "CREATE TABLE IF NOT EXISTS job_chunks ("
+            " job_id TEXT NOT NULL, idx INTEGER NOT NULL, start INTEGER NOT NULL, size INTEGER NOT NULL,"
+            " input BLOB NOT NULL, status TEXT NOT NULL DEFAULT 'pending', owner TEXT, claimed REAL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (job_id, idx));"
+            "CREATE INDEX IF NOT EXISTS job_chunks_status ON job_chunks(status, job_id, idx);"
+        )
+
+    def chunk_path(self, job_id: str, idx: int) -> str:
+        return os.path.join(self.root, job_id, f"{idx:06d}.ndjson.gz")
+
+    def _write(self, fn):
+        """fn(db) в една транзакция (BEGIN IMMEDIATE – и спрямо другите процеси)."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                out = fn(self._db)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return out
+
+    def create(self, records, options: dict, chunk: int = JOB_CHUNK, max_records: int = JOB_MAX_RECORDS) -> str:
+        """Записва всички записи на парчета; задачата става "queued" едва накрая."""
+        import secrets
+        import zlib
+        job_id = secrets.token_hex(8)
+        os.makedirs(os.path.join(self.root, job_id), exist_ok=True)
+        opts = json.dumps(options, ensure_ascii=False)
+        self._write(lambda db: db.execute(
+            "INSERT INTO jobs (id, status, options, created) VALUES (?, 'loading', ?, ?)", (job_id, opts, time.time())))
+        total = idx = 0
+        try:
+            for batch in _batched(records, chunk):
+                total += len(batch)
+                if total > max_records:
+                    raise ValueError(f"твърде много записи (> {max_records})")
+                blob = zlib.compress(b"\n".join(json.dumps(r, ensure_ascii=False).encode("utf-8") for r in batch))
+                self._write(lambda db: db.execute(
+                    "INSERT INTO job_chunks (job_id, idx, start, size, input) VALUES (?, ?, ?, ?, ?)",
+                    (job_id, idx, total - len(batch), len(batch), blob)))
+                idx += 1
+            if not total:
+                raise ValueError("няма записи")
+        except BaseException:
+            self.delete(job_id)
+            raise
+        self._write(lambda db: db.execute(
+            "UPDATE jobs SET status = 'queued', total = ?, chunks = ? WHERE id = ?", (total, idx, job_id)))
+        return job_id
+
+    def claim(self, owner: str):
+        """Следващото свободно парче (или с изтекъл лизинг) → (job_id, idx, start, input, options) | None."""
+        now = time.time()
+
+        def fn(db):
+            row = db.execute(
+                "SELECT c.job_id, c.idx, c.start, c.input, j.options FROM job_chunks c JOIN jobs j ON j.id = c.job_id"
+                " WHERE j.status IN ('queued', 'running')"
+                " AND (c.status = 'pending' OR (c.status = 'running' AND c.claimed < ?))"
+                " ORDER BY j.created, c.idx LIMIT 1", (now - JOB_LEASE_S,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE job_chunks SET status = 'running', owner = ?, claimed = ?, attempts = attempts + 1"
+                       " WHERE job_id = ? AND idx = ?", (owner, now, row[0], row[1]))
+            db.execute("UPDATE jobs SET status = 'running', started = COALESCE(started, ?) WHERE id = ?", (now, row[0]))
+            return row[0], row[1], row[2], row[3], json.loads(row[4])
+
+        return self._write(fn)
+
+    def heartbeat(self, owner: str):
+        self._write(lambda db: db.execute(
+            "UPDATE job_chunks SET claimed = ? WHERE owner = ? AND status = 'running'", (time.time(), owner)))
+
+    def finish_chunk(self, job_id: str, idx: int, ok: int, errors: int):
+        def fn(db):
+            cur = db.execute("UPDATE job_chunks SET status = 'done', input = x'' WHERE job_id = ? AND idx = ?"
+                             " AND status = 'running'", (job_id, idx))
+            if cur.rowcount == 0:
+                return      # вече отказана/изтрита или поета от друг след изтекъл лизинг
+            db.execute("UPDATE jobs SET done = done + ?, errors = errors + ? WHERE id = ?", (ok + errors, errors, job_id))
+            left = db.execute("SELECT COUNT(*) FROM job_chunks WHERE job_id = ? AND status != 'done'",
+                              (job_id,)).fetchone()[0]
+            if left == 0:
+                db.execute("UPDATE jobs SET status = 'done', finished = ? WHERE id = ? AND status = 'running'",
+                           (time.time(), job_id))
+
+        self._write(fn)
+
+    def fail_chunk(self, job_id: str, idx: int, error: str):
+        """Парчето се връща в опашката; след JOB_RETRIES опита задачата е "failed"."""
+        def fn(db):
+            row = db.execute("SELECT attempts FROM job_chunks WHERE job_id = ? AND idx = ?", (job_id, idx)).fetchone()
+            if row is None:
+                return
+            db.execute("UPDATE job_chunks SET status = 'pending', owner = NULL WHERE job_id = ? AND idx = ?",
+                       (job_id, idx))
+            if row[0] >= JOB_RETRIES:
+                db.execute("UPDATE jobs SET status = 'failed', finished = ?, error = ? WHERE id = ?",
+                           (time.time(), f"парче {idx}: {error}", job_id))
+
+        self._write(fn)
+
+    def cancel(self, job_id: str) -> bool:
+        return self._write(lambda db: db.execute(
+            "UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status IN ('queued', 'running')",
+            (time.time(), job_id)).rowcount > 0)
+
+    def delete(self, job_id: str):
+        import shutil
+
+        def fn(db):
+            db.execute("DELETE FROM job_chunks WHERE job_id = ?", (job_id,))
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+        self._write(fn)
+        shutil.rmtree(os.path.join(self.root, job_id), ignore_errors=True)
+
+    _COLUMNS = ("id", "status", "options", "total", "chunks", "done", "errors", "created", "started", "finished", "error")
+
+    def status(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            chunks_done = self._db.execute("SELECT COUNT(*) FROM job_chunks WHERE job_id = ? AND status = 'done'",
+                                           (job_id,)).fetchone()[0]
+        out = dict(zip(self._COLUMNS, row))
+        out["options"] = json.loads(out["options"])
+        out["chunks_done"] = chunks_done
+        out["progress"] = round(out["done"] / out["total"], 4) if out["total"] else 0.0
+        return out
+
+    def list(self, limit: int = 100) -> list:
+        with self._lock:
+            ids = [r[0] for r in self._db.execute("SELECT id FROM jobs ORDER BY created DESC LIMIT ?", (limit,))]
+        return [st for st in map(self.status, ids) if st is not None]
+
+def _batched(iterable, n: int):
+    it = iter(iterable)
+    while batch := tuple(itertools.islice(it, n)):
+        yield batch
+
+class JobRunner:
+    """Нишка: взима парчета от JobStore и ги смята в пула (до 2 на процес наведнъж)."""
+
+    LOCK_RETRY_S = 5.0
+
+    def __init__(self, store: JobStore):
+        import socket
+        self.store = store
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+        self.wake = threading.Event()
+        self.active = False
+        self._lock_fd = None
+        self._thread = threading.Thread(target=self._run, name="nk-jobs", daemon=True)
+        self._thread.start()
+
+    def _acquire(self):
+        """Чака заключването на машината (runner.lock); държи го до края на процеса."""
+        if fcntl is None:
+            return
+        fd = os.open(os.path.join(self.store.root, "runner.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                time.sleep(self.LOCK_RETRY_S)
+                continue
+            self._lock_fd = fd
+            return
+
+    def _run(self):
+        from concurrent.futures import wait, FIRST_COMPLETED
+        from concurrent.futures.process import BrokenProcessPool
+        self._acquire()
+        self.active = True
+        inflight = {}
+        last_beat = 0.0
+        while True:
+            try:
+                if inflight and time.time() - last_beat > JOB_LEASE_S / 4:
+                    self.store.heartbeat(self.owner)
+                    last_beat = time.time()
+                while len(inflight) < 2 * NK_POOL_WORKERS:
+                    claim = self.store.claim(self.owner)
+                    if claim is None:
+                        break
+                    job_id, idx, start, blob, options = claim
+                    pool = get_pool()
+                    fut = pool.submit(_job_chunk, blob, start, options, self.store.chunk_path(job_id, idx))
+                    inflight[fut] = (job_id, idx, pool)
+                if not inflight:
+                    self.wake.wait(JOB_POLL_S)
+                    self.wake.clear()
+                    continue
+                done, _ = wait(inflight, timeout=JOB_POLL_S, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    job_id, idx, pool = inflight.pop(fut)
+                    try:
+                        ok, errors = fut.result()
+                    except BrokenProcessPool as e:
+                        reset_pool(pool)
+                        self.store.fail_chunk(job_id, idx, str(e) or "пулът от процеси спря")
+                    except Exception as e:
+                        self.store.fail_chunk(job_id, idx, str(e))
+                    else:
+                        self.store.finish_chunk(job_id, idx, ok, errors)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(JOB_POLL_S)
+
+_JOBS = None
+_JOB_RUNNER = None
+_JOBS_LOCK = threading.Lock()
+
+def get_jobs() -> JobStore:
+    """JobStore + JobRunner на този процес (лениво; start_jobs() ги пуска при старт)."""
+    global _JOBS, _JOB_RUNNER
+    if _JOBS is None:
+        with _JOBS_LOCK:
+            if _JOBS is None:
+                store = JobStore(JOBS_DIR)
+                _JOB_RUNNER = JobRunner(store)
+                _JOBS = store
+    return _JOBS
+
+def start_jobs():
+    """При старт на работен процес: продължава незавършените задачи (ако има)."""
+    if JOBS_ON and (_JOBS is not None or os.path.exists(os.path.join(JOBS_DIR, "jobs.sqlite"))):
+        get_jobs()
+
+def _job_upload():
+    """(записи, опции) от заявката: multipart поле "file" или сурово тяло; опциите – от формата/query."""
+    params = request.form if request.files else request.args
+    options = {k: params[k] for k in JOB_OPTIONS if params.get(k) not in (None, "")}
+    if "use_lmt" in options:
+        options["use_lmt"] = options["use_lmt"].lower() in ("1", "true", "yes", "да")
+    # ранна проверка на секциите (иначе всеки запис ще върне същата грешка)
+    parse_sections(options.get("include"), options.get("exclude"), parse_vargas(options.get("vargas")))
+
+    upload = request.files.get("file")
+    if upload is not None:
+        name = (upload.filename or "").lower()
+        ctype = upload.mimetype or ""
+        stream = upload.stream
+    else:
+        name, ctype, stream = "", request.mimetype or "", request.stream
+    kind = (params.get("input") or "").lower() or ("csv" if name.endswith(".csv") or "csv" in ctype else "ndjson")
+    if kind not in ("csv", "ndjson"):
+        raise ValueError(f"непознат вход: {kind} (csv или ndjson)")
+    return job_records(stream, kind), options
+
+def _job_view(st: dict) -> dict:
+    st = dict(st, results=f"/jobs/{st['id']}/results" if st["status"] == "done" else None)
+    return st
+
+@app.route('/jobs', methods=['GET', 'POST', 'OPTIONS'])
+def jobs_route():
+    """
+    POST – нова задача. Тяло: CSV (колони като полетата на /calculate) или NDJSON
+    (по един обект на ред), сурово или като multipart поле "file"; ?input=csv|ndjson
+    при неясен тип. include/exclude/vargas/calc_type/use_lmt – за всички записи
+    (стойност в самия запис има предимство). → 202 {"ok", "job": {...}}.
+    GET – последните задачи.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    if not JOBS_ON:
+        return jsonify({"ok": False, "error": "задачите са изключени (NK_JOBS=0)"}), 404
+    try:
+        store = get_jobs()
+        if request.method == 'GET':
+            return jsonify({"ok": True, "jobs": [_job_view(st) for st in store.list()]}), 200
+        try:
+            records, options = _job_upload()
+            job_id = store.create(records, options)
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        _JOB_RUNNER.wake.set()          # без ефект, ако смята друг процес (той проверява всяка секунда)
+        resp = jsonify({"ok": True, "job": _job_view(store.status(job_id))})
+        resp.status_code = 202
+        resp.headers["Location"] = f"/jobs/{job_id}"
+        return resp
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e), "trace": traceback.format_exc()}), 500
+
+@app.route('/jobs/<job_id>', methods=['GET', 'DELETE', 'OPTIONS'])
+def job_route(job_id):
+    """GET – състояние и напредък; DELETE – отказ и изтриване (вкл. резултатите)."""
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    if not JOBS_ON:
+        return jsonify({"ok": False, "error": "задачите са изключени (NK_JOBS=0)"}), 404
+    store = get_jobs()
+    st = store.status(job_id)
+    if st is None:
+        return jsonify({"ok": False, "error": "няма такава задача"}), 404
+    if request.method == 'DELETE':
+        store.cancel(job_id)
+        store.delete(job_id)
+        return jsonify({"ok": True, "deleted": job_id}), 200
+    return jsonify({"ok": True, "job": _job_view(st)}), 200
+
+@app.route('/jobs/<job_id>/results', methods=['GET'])
+def job_results(job_id):
+    """
+    Резултатите на завършена задача като NDJSON (в реда на входа); ?gzip=1 →
+    направо gzip файловете на парчетата (валиден многочленен gzip).
+    """
+    if not JOBS_ON:
+        return jsonify({"ok": False, "error": "задачите са изключени (NK_JOBS=0)"}), 404
+    store = get_jobs()
+    st = store.status(job_id)
+    if st is None:
+        return jsonify({"ok": False, "error": "няма такава задача"}), 404
+    if st["status"] != "done":
+        return jsonify({"ok": False, "error": f"задачата е {st['status']}", "job": _job_view(st)}), 409
+    raw = request.args.get("gzip") in ("1", "true")
+    paths = [store.chunk_path(job_id, i) for i in range(st["chunks"])]
+
+    def gen():
+        import gzip
+        for path in paths:
+            with (open(path, "rb") if raw else gzip.open(path, "rb")) as fh:
+                while block := fh.read(1 << 16):
+                    yield block
+
+    resp = app.response_class(gen(), mimetype="application/gzip" if raw else "application/x-ndjson")
+    resp.headers["Content-Disposition"] = f'attachment; filename="{job_id}.ndjson{".gz" if raw else ""}"'
+    return resp
+
+# ---------- DASHA ----------
+DASHA_MAX_PERIODS = int(os.getenv("NK_DASHA_MAX_PERIODS", "20000"))
+
+def _parse_moment_us(value) -> int | None:
+    """"YYYY-MM-DD" или ISO момент (без зона = UTC) → µs от Unix епохата."""
+    if not value:
+        return None
+    dt = datetime.fromisoformat(str(value))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return _dt_to_us(dt)
+
+def chart_birth_moon(data: dict, eng: "ChartEngine | None" = None, tz_cache: dict | None = None):
+    """(UTC момент, сидерална Луна) за входните данни на /calculate – същата Луна като в картата."""
+    eng = eng or ENGINE
+    inp = chart_inputs(data, tz_cache)
+    ayan = eng.ayanamsha(inp["jd"], eng.ayan_offset(inp["calc_type"]))
+    moon = next(p["longitude"] for p in eng.planets(inp["jd"], ayan) if p["planet"] == "Луна")
+    return inp["dt_utc"], float(moon)
+
+def chart_dasha(data: dict, eng: "ChartEngine | None" = None) -> VimshottariDasha:
+    """VimshottariDasha за входните данни на /calculate."""
+    return VimshottariDasha(*chart_birth_moon(data, eng))
+
+@app.route('/dasha', methods=['POST', 'OPTIONS'])
+def dasha_route():
+    """
+    Вимшоттари в прозорец.
+    Вход: полетата на /calculate + "from", "to" (дата или ISO момент, по
+    подразбиране раждането и +120 г.) и "depth" (1–5: маха … прана, по подразбиране 2).
+    Изход: {"ok", "start_lord", "balance_years", "depth", "periods": [{..., "sub": [...]}]}.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        data = request.get_json(force=True)
+        depth = int(data.get("depth", 2))
+        if not 1 <= depth <= len(VimshottariDasha.LEVELS):
+            raise ValueError(f"depth трябва да е 1..{len(VimshottariDasha.LEVELS)}")
+        from_us = _parse_moment_us(data.get("from"))
+        to_us = _parse_moment_us(data.get("to"))
+        vd = chart_dasha(data)
+        periods = vd.tree(from_us, to_us, depth, max_periods=DASHA_MAX_PERIODS)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({
+            "ok": False,
+            "error": str(e),
+            "trace": traceback.format_exc()
+        }), 500
+
+    return jsonify({
+        "ok": True,
+        "start_lord": vd.start_lord,
+        "balance_years": vd.balance_years,
+        "depth": depth,
+        "periods": periods,
+    }), 200
+
+DASHA_CURRENT_MAX_ITEMS = int(os.getenv("NK_DASHA_CURRENT_MAX_ITEMS", "200000"))
+DASHA_CURRENT_MAX_CELLS = int(os.getenv("NK_DASHA_CURRENT_MAX_CELLS", "1000000"))
+
+@app.route('/dasha/current', methods=['POST', 'OPTIONS'])
+def dasha_current_route():
+    """
+    Текущите периоди за много хора и моменти наведнъж.
+    Вход: {"items": [ {..като /calculate..} | {"birth": ISO UTC момент, "moon": сидерален лонгитуд} ],
+           "at": момент или списък от моменти (по подразбиране – сега), "depth": 1..5 (3)}
+    Изход: {"ok", "at": [...], "results": [{"index", "ok", "current": [[{"level", "lord", "start", "end"}, ...] на момент]}]}
+    Момент преди раждането дава null.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        data = request.get_json(force=True)
+        items = data.get("items")
+        if not isinstance(items, list):
+            raise ValueError("очаква се списък 'items'")
+        if len(items) > DASHA_CURRENT_MAX_ITEMS:
+            raise ValueError(f"твърде много записи ({len(items)} > {DASHA_CURRENT_MAX_ITEMS})")
+        depth = int(data.get("depth", 3))
+        if not 1 <= depth <= len(VimshottariDasha.LEVELS):
+            raise ValueError(f"depth трябва да е 1..{len(VimshottariDasha.LEVELS)}")
+        at = data.get("at")
+        at = at if isinstance(at, list) else [at]
+        at_us = [_parse_moment_us(a) if a else _dt_to_us(datetime.now(timezone.utc)) for a in at]
+        if len(items) * len(at_us) > DASHA_CURRENT_MAX_CELLS:
+            raise ValueError(f"твърде много комбинации запис × момент (> {DASHA_CURRENT_MAX_CELLS})")
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    try:
+        # раждане + Луна за всеки запис; грешен запис не спира останалите
+        tz_cache = {}
+        birth, moon, errors = [], [], {}
+        for idx, item in enumerate(items):
+            try:
+                if "moon" in item and "birth" in item:
+                    b_us, m = _parse_moment_us(item["birth"]), float(item["moon"])
+                else:
+                    dt_utc, m = chart_birth_moon(item, tz_cache=tz_cache)
+                    b_us = _dt_to_us(dt_utc)
+            except Exception as e:
+                errors[idx] = str(e)
+                b_us, m = 0, 0.0
+            birth.append(b_us)
+            moon.append(m)
+
+        lords, starts, ends = dasha_current(birth, moon, at_us, depth)
+        levels = VimshottariDasha.LEVELS
+        results = []
+        for idx in range(len(items)):
+            if idx in errors:
+                results.append({"index": idx, "ok": False, "error": errors[idx]})
+                continue
+            current = []
+            for k, t in enumerate(at_us):
+                if t < birth[idx]:
+                    current.append(None)
+                    continue
+                current.append([
+                    {
+                        "level": levels[lvl],
+                        "lord": DASHA_SEQ[lords[idx, k, lvl]],
+                        "start": _us_to_dt(int(starts[idx, k, lvl])).isoformat(timespec="seconds"),
+                        "end": _us_to_dt(int(ends[idx, k, lvl])).isoformat(timespec="seconds"),
+                    }
+                    for lvl in range(depth)
+                ])
+            results.append({"index": idx, "ok": True, "current": current})
+
+        return jsonify({
+            "ok": True,
+            "at": [_us_to_dt(t).isoformat(timespec="seconds") for t in at_us],
+            "errors": len(errors),
+            "results": results,
+        }), 200
+
+    except Exception as e:
+        return jsonify({
+            "ok": False,
+            "error": str(e),
+            "trace": traceback.format_exc()
+        }), 500
+
+# ---------- MATCH ----------
+MATCH_MAX_ITEMS = int(os.getenv("NK_MATCH_MAX_ITEMS", "200000"))
+MATCH_MAX_TOP = int(os.getenv("NK_MATCH_MAX_TOP", "1000"))
+
+def match_pada(item: dict, tz_cache: dict | None = None) -> int:
+    """
+    Падата на Луната за профил/кандидат: "moon" (сидерална дължина), или
+    "nakshatra" (име или 1–27) + "pada" (1–4), или рождените данни на /calculate.
+    """
+    if item.get("moon") is not None:
+        return pada_index(float(item["moon"]))
+    nak = item.get("nakshatra")
+    if nak is not None:
+        n = int(nak) - 1 if str(nak).isdigit() else NAK.index(str(nak))
+        pada = int(item.get("pada", 1))
+        if not (0 <= n < 27 and 1 <= pada <= 4):
+            raise ValueError("nakshatra 1–27, pada 1–4")
+        return n * 4 + pada - 1
+    return pada_index(chart_birth_moon(item, tz_cache=tz_cache)[1])
+
+def _pada_view(p: int) -> dict:
+    return {"nakshatra": NAK[p // 4], "pada": p % 4 + 1, "sign": SIGNS[p // 9]}
+
+@app.route('/match/candidates', methods=['GET', 'POST', 'DELETE', 'OPTIONS'])
+def match_candidates():
+    """
+    Кандидатите в пул ("pool", по подразбиране "default").
+    POST {"pool", "items": [{"id", "gender": "m"|"f", + Луна като в /match}]} – добавя/заменя;
+    DELETE {"pool", "ids": [...]}; GET ?pool= – брой по пол.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        store = get_match()
+        if request.method == 'GET':
+            name = request.args.get("pool", "default")
+            return jsonify({"ok": True, "pool": name, "counts": store.pool(name).counts()}), 200
+        data = request.get_json(force=True) or {}
+        name = str(data.get("pool") or "default")
+        if request.method == 'DELETE':
+            ids = [str(i) for i in data.get("ids") or ()]
+            return jsonify({"ok": True, "pool": name, "removed": store.remove_many(name, ids)}), 200
+
+        items = data.get("items")
+        if not isinstance(items, list):
+            return jsonify({"ok": False, "error": "очаква се списък 'items'"}), 400
+        if len(items) > MATCH_MAX_ITEMS:
+            return jsonify({"ok": False, "error": f"твърде много записи ({len(items)} > {MATCH_MAX_ITEMS})"}), 400
+        rows, errors = [], []
+        tz_cache = {}
+        for i, item in enumerate(items):
+            try:
+                if item.get("id") is None:
+                    raise ValueError("липсва id")
+                rows.append((str(item["id"]), parse_gender(item.get("gender")), match_pada(item, tz_cache)))
+            except Exception as e:
+                errors.append({"index": i, "error": str(e)})
+        store.put_many(name, rows)
+        return jsonify({"ok": True, "pool": name, "added": len(rows), "errors": errors,
+                        "counts": store.pool(name).counts()}), 200
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e), "trace": traceback.format_exc()}), 500
+
+@app.route('/match', methods=['POST', 'OPTIONS'])
+def match_route():
+    """
+    Ащакута (36 гуни) на профил срещу всички кандидати от другия пол в пула.
+    Вход: {"profile": {"gender", + "moon" | "nakshatra"/"pada" | рождени данни},
+           "pool", "top" (10), "min_score" (0)}.
+    Изход: най-добрите по точки (при равни – по реда на добавяне) с разбивка по кути.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        data = request.get_json(force=True) or {}
+        profile = data.get("profile")
+        if not isinstance(profile, dict):
+            return jsonify({"ok": False, "error": "очаква се обект 'profile'"}), 400
+        try:
+            gender = parse_gender(profile.get("gender"))
+            pada = match_pada(profile)
+            top = int(data.get("top", 10))
+            min_score = float(data.get("min_score", 0))
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        if not 1 <= top <= MATCH_MAX_TOP:
+            return jsonify({"ok": False, "error": f"top: 1–{MATCH_MAX_TOP}"}), 400
+
+        name = str(data.get("pool") or "default")
+        t0 = time.perf_counter()
+        best, scored = get_match().pool(name).top(gender, pada, top, min_score)
+        elapsed = time.perf_counter() - t0
+        matches = []
+        for cid, p, score in best:
+            boy, girl = (pada, p) if gender == 0 else (p, pada)
+            matches.append({"id": cid, "score": score, **_pada_view(p), "kootas": koota_breakdown(boy, girl)})
+        return jsonify({
+            "ok": True,
+            "pool": name,
+            "profile": _pada_view(pada),
+            "scored": scored,
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "matches": matches,
+        }), 200
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e), "trace": traceback.format_exc()}), 500
+
+# ---------- CHART STORE ----------
+# Изчислените карти като компактни атрибути (индекси в таблиците на /schema) в SQLite
+# (NK_CHART_STORE=път; празно – изключено): за всяка граха знак, накшатра, пада, D9,
+# чара карака и ретроградност, плюс Лагна, Арудха Лагна и техните D9 знаци, и коя
+# граха е АК, АмК, … ДК. Вторичният индекс е колонен, в паметта на процеса (вж.
+# ChartStore) – B-дърво на атрибут в SQLite при 12–27 стойности е и бавно за запис,
+# и бавно за комбинирани условия.
+# /calculate добавя всяка наново сметната пълна карта (NK_CHART_STORE_AUTO=1) през
+# фонова нишка, на партиди; POST /charts смята и записва, query_charts.py – CLI.
+CHART_STORE_PATH = os.getenv("NK_CHART_STORE") or None
+CHART_STORE_AUTO = os.getenv("NK_CHART_STORE_AUTO", "1") == "1"
+CHART_STORE_BATCH = 500
+CHART_STORE_MAX_LIMIT = int(os.getenv("NK_CHART_STORE_MAX_LIMIT", "10000"))
+CHART_STORE_SECTIONS = ("Ascendant", "Planets", "D9", "ArudhaLagna")
+KARAKA_COLUMNS = {"АК": "ak", "АмК": "amk", "БК": "bk", "МК": "mk", "ПиК": "pik", "ПК": "pk", "ГК": "gk", "ДК": "dk"}
+CHART_STORE_META = ("ext_id", "date", "time", "lat", "lon", "tz", "calc_type")
+
+def _chart_store_attributes() -> dict:
+    """Атрибут за заявки → (колона, таблица за имената | None за числа)."""
+    attrs = {
+        "Ascendant.sign": ("asc_sign", "sign"),
+        "ArudhaLagna.sign": ("al_sign", "sign"),
+        "D9.Ascendant.sign": ("d9_asc", "sign"),
+        "D9.ArudhaLagna.sign": ("d9_al", "sign"),
+    }
+    for i, graha in enumerate(DASHA_SEQ):
+        attrs[f"{graha}.sign"] = (f"p{i}_sign", "sign")
+        attrs[f"{graha}.nakshatra"] = (f"p{i}_nak", "nakshatra")
+        attrs[f"{graha}.pada"] = (f"p{i}_pada", None)
+        attrs[f"{graha}.d9"] = (f"p{i}_d9", "sign")
+        attrs[f"{graha}.chara_karaka"] = (f"p{i}_ck", "chara_karaka")
+        attrs[f"{graha}.retrograde"] = (f"p{i}_retro", None)
+    for code, col in KARAKA_COLUMNS.items():
+        attrs[f"karaka.{code}"] = (col, "graha")
+    return attrs
+
+CHART_STORE_ATTRS = _chart_store_attributes()
+
+def chart_attributes(res: dict) -> dict:
+    """Отговор на /calculate → {колона: индекс} (липсващите секции остават NULL)."""
+    row = {}
+    if res.get("Ascendant"):
+        row["asc_sign"] = SIGN_INDEX[res["Ascendant"]["sign"]]
+    if res.get("ArudhaLagna"):
+        row["al_sign"] = SIGN_INDEX[res["ArudhaLagna"]["sign"]]
+    d9 = res.get("D9") or {}
+    if d9.get("Ascendant"):
+        row["d9_asc"] = SIGN_INDEX[d9["Ascendant"]["sign"]]
+    if d9.get("ArudhaLagna"):
+        row["d9_al"] = SIGN_INDEX[d9["ArudhaLagna"]["sign"]]
+    d9_signs = {p["planet"]: p["sign"] for p in d9.get("Planets") or ()}
+    graha = _COMPACT_INDEX["graha"]
+    for p in res.get("Planets") or ():
+        i = graha[p["planet"]]
+        row[f"p{i}_sign"] = SIGN_INDEX[p["sign"]]
+        row[f"p{i}_nak"] = _COMPACT_INDEX["nakshatra"][p["nakshatra"]]
+        row[f"p{i}_pada"] = int(p["pada"])
+        row[f"p{i}_retro"] = int(bool(p.get("retrograde")))
+        if p["planet"] in d9_signs:
+            row[f"p{i}_d9"] = SIGN_INDEX[d9_signs[p["planet"]]]
+        ck = p.get("chara_karaka")
+        if ck:
+            row[f"p{i}_ck"] = _COMPACT_INDEX["chara_karaka"][ck]
+            row[KARAKA_COLUMNS[ck]] = i
+    return row
+
+def parse_chart_filter(where: dict) -> list:
+    """{"атрибут": стойност | [стойности]} → [(колона, [кодове])]. ValueError при непознато."""
+    if not isinstance(where, dict):
+        raise ValueError("where: очаква се обект {атрибут: стойност}")
+    conds = []
+    for attr, value in where.items():
+        spec = CHART_STORE_ATTRS.get(attr)
+        if spec is None:
+            raise ValueError(f"непознат атрибут: {attr}")
+        col, table = spec
+        codes = []
+        for v in value if isinstance(value, list) else [value]:
+            if isinstance(v, str) and table is not None and v in _COMPACT_INDEX[table]:
+                code = _COMPACT_INDEX[table][v]
+            elif isinstance(v, (bool, int)) or (isinstance(v, str) and v.isdigit()):
+                code = int(v)
+            else:
+                raise ValueError(f"{attr}: непозната стойност {v}")
+            if not 0 <= code < ChartStore.NULL:
+                raise ValueError(f"{attr}: непозната стойност {v}")
+            codes.append(code)
+        if not codes:
+            raise ValueError(f"{attr}: празен списък")
+        conds.append((col, codes))
+    return conds
+
+class ChartStore:
+    """
+    SQLite таблица charts (ред на карта, ключ = chart_cache_key; атрибутите – един
+    BLOB по байт на колона, 255 = NULL) + колонен индекс в паметта: по един uint8
+    масив на атрибут, догонван по seq при всяка заявка (и от записи на други процеси).
+    Филтърът е И от векторни сравнения → милисекунди и за милиони карти (~66 B/карта RAM).
+    """
+
+    NULL = 255
+
+    def __init__(self, path: str):
+        import queue
+        import sqlite3
+        self.path = path
+        self.columns = tuple(sorted({spec[0] for spec in CHART_STORE_ATTRS.values()}))
+        self._col_index = {c: i for i, c in enumerate(self.columns)}
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS charts ("
+            " id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, seq INTEGER NOT NULL, created REAL NOT NULL,"
+            " ext_id TEXT, date TEXT, time TEXT, lat REAL, lon REAL, tz TEXT, calc_type TEXT, attrs BLOB NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS charts_seq ON charts(seq);"
+            "CREATE TABLE IF NOT EXISTS chart_store_meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);"
+        )
+        layout = json.dumps(self.columns)
+        self._db.execute("INSERT OR IGNORE INTO chart_store_meta VALUES ('columns', ?)", (layout,))
+        stored = self._db.execute("SELECT value FROM chart_store_meta WHERE name = 'columns'").fetchone()[0]
+        if stored != layout:
+            raise ValueError(f"{path}: хранилището е с други колони – създай го наново")
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+        # колонният индекс: ids (нарастващи), cols[колона, ред], до кой seq е догонен
+        self._n = 0
+        self._ids = None
+        self._cols = None
+        self._seq = 0
+
+    def _pack(self, attrs: dict) -> bytes:
+        return bytes(self.NULL if attrs.get(c) is None else attrs[c] for c in self.columns)
+
+    def put_many(self, rows: list):
+        """rows: [(ключ, мета, атрибути)] – синхронно, в една транзакция (UPSERT пази id-то)."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM charts").fetchone()[0]
+                self._db.executemany(
+                    "INSERT INTO charts (key, seq, created, ext_id, date, time, lat, lon, tz, calc_type, attrs)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(key) DO UPDATE SET seq = excluded.seq, ext_id = excluded.ext_id,"
+                    " date = excluded.date, time = excluded.time, lat = excluded.lat, lon = excluded.lon,"
+                    " tz = excluded.tz, calc_type = excluded.calc_type, attrs = excluded.attrs",
+                    [(key, seq + i + 1, now) + tuple(meta.get(c) for c in CHART_STORE_META) + (self._pack(attrs),)
+                     for i, (key, meta, attrs) in enumerate(rows)])
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def add(self, key: str, meta: dict, res: dict):
+        """Асинхронно: наредено за фоновия писач (не бави заявката)."""
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="nk-chart-store", daemon=True)
+                    self._writer.start()
+        self._queue.put((key, meta, chart_attributes(res)))
+
+    def _write_loop(self):
+        import queue
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + 0.5
+            while len(rows) < CHART_STORE_BATCH:
+                try:
+                    rows.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.put_many(rows)
+            except Exception:
+                traceback.print_exc()
+            for _ in rows:
+                self._queue.task_done()
+
+    def flush(self):
+        """Изчаква фоновия писач (CLI, тестове)."""
+        self._queue.join()
+
+    def _refresh(self):
+        """Догонва колонния индекс с редовете, записани след последния seq (под self._lock)."""
+        width = len(self.columns)
+        # ORDER BY seq, за да мине по индекса charts_seq (ORDER BY id сканира цялата таблица).
+        # Обновен ключ пази id-то си, но получава нов seq – затова първо събираме всички
+        # редове и чак тогава делим на обновени и нови (иначе партидите се разминават по id).
+        cur = self._db.execute("SELECT id, seq, attrs FROM charts WHERE seq > ? ORDER BY seq", (self._seq,))
+        ids, blobs = [], []
+        while batch := cur.fetchmany(65536):
+            ids.extend(r[0] for r in batch)
+            blobs.extend(r[2] for r in batch)
+            self._seq = max(self._seq, batch[-1][1])
+        if not ids:
+            return
+        blob = b"".join(blobs)
+        if np is None:
+            pos = {cid: i for i, cid in enumerate(self._ids or [])}
+            self._ids, self._cols = self._ids or [], self._cols or []
+            for i, cid in enumerate(ids):
+                row = blob[i * width:(i + 1) * width]
+                if cid in pos:
+                    self._cols[pos[cid]] = row
+                else:
+                    pos[cid] = len(self._ids)
+                    self._ids.append(cid)
+                    self._cols.append(row)
+            if any(a > b for a, b in zip(self._ids, self._ids[1:])):
+                order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+                self._ids = [self._ids[i] for i in order]
+                self._cols = [self._cols[i] for i in order]
+            self._n = len(self._ids)
+            return
+        ids = np.array(ids, dtype=np.int64)
+        order = np.argsort(ids, kind="stable")
+        ids = ids[order]
+        attrs = np.frombuffer(blob, dtype=np.uint8).reshape(len(ids), width)[order].T
+        if self._ids is None:
+            self._ids = np.empty(0, dtype=np.int64)
+            self._cols = np.empty((width, 0), dtype=np.uint8)
+        # обновени (id вече в индекса) и нови
+        n = self._n
+        pos = np.searchsorted(self._ids[:n], ids)
+        old = pos < n
+        old[old] = self._ids[pos[old]] == ids[old]
+        if old.any():
+            self._cols[:, pos[old]] = attrs[:, old]
+        new_ids, new_attrs = ids[~old], attrs[:, ~old]
+        need = n + len(new_ids)
+        if need > len(self._ids):                      # капацитет ×2
+            cap = max(need, 2 * len(self._ids), 1024)
+            ids_buf = np.empty(cap, dtype=np.int64)
+            cols_buf = np.full((width, cap), self.NULL, dtype=np.uint8)
+            ids_buf[:n] = self._ids[:n]
+            cols_buf[:, :n] = self._cols[:, :n]
+            self._ids, self._cols = ids_buf, cols_buf
+        self._ids[n:need] = new_ids
+        self._cols[:, n:need] = new_attrs
+        if len(new_ids) and n and new_ids[0] < self._ids[n - 1]:   # id под досегашните – пренареждане
+            order = np.argsort(self._ids[:need], kind="stable")
+            self._ids[:need] = self._ids[:need][order]
+            self._cols[:, :need] = self._cols[:, :need][:, order]
+        self._n = need
+
+    def _match(self, conds: list, after: int):
+        """Позициите (и броят) на редовете, които минават всички условия [(колона, кодове)]."""
+        n = self._n
+        if np is None:
+            cols = [(self._col_index[c], set(codes)) for c, codes in conds]
+            hits = [i for i in range(n) if all(self._cols[i][ci] in codes for ci, codes in cols)]
+            return [i for i in hits if self._ids[i] > after], len(hits)
+        mask = np.ones(n, dtype=bool)
+        for col, codes in conds:
+            values = self._cols[self._col_index[col], :n]
+            mask &= (values == codes[0]) if len(codes) == 1 else np.isin(values, codes)
+        start = int(np.searchsorted(self._ids[:n], after, side="right"))
+        return np.flatnonzero(mask[start:]) + start, int(np.count_nonzero(mask))
+
+    def query(self, where: dict, limit: int = 100, after: int = 0, count: bool = False) -> dict:
+        conds = parse_chart_filter(where)
+        with self._lock:
+            self._refresh()
+            pos, total = self._match(conds, after)
+            ids = [int(self._ids[i]) for i in pos[:limit]]
+            rows = {}
+            for i in range(0, len(ids), 500):
+                part = ids[i:i + 500]
+                for r in self._db.execute(
+                        f"SELECT id, key, {', '.join(CHART_STORE_META)} FROM charts"
+                        f" WHERE id IN ({', '.join('?' * len(part))})", part):
+                    rows[r[0]] = r
+        out = {"charts": [dict(zip(("id", "key") + CHART_STORE_META, rows[i])) for i in ids if i in rows]}
+        out["next"] = ids[-1] if len(pos) > limit else None
+        if count:
+            out["count"] = total
+        return out
+
+    def size(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM charts").fetchone()[0]
+
+_CHART_STORE = None
+_CHART_STORE_LOCK = threading.Lock()
+
+def get_chart_store(path: str | None = None) -> ChartStore | None:
+    """ChartStore за NK_CHART_STORE (или дадения път); None ако е изключен."""
+    global _CHART_STORE
+    path = path or CHART_STORE_PATH
+    if not path:
+        return None
+    if _CHART_STORE is None or _CHART_STORE.path != path:
+        with _CHART_STORE_LOCK:
+            if _CHART_STORE is None or _CHART_STORE.path != path:
+                _CHART_STORE = ChartStore(path)
+    return _CHART_STORE
+
+def chart_store_meta(data: dict, inp: dict) -> dict:
+    return {
+        "ext_id": None if data.get("id") is None else str(data["id"]),
+        "date": data.get("date"), "time": data.get("time"), "lat": inp["lat"], "lon": inp["lon"],
+        "tz": inp["tz_used"], "calc_type": inp["calc_type"],
+    }
+
+def store_chart(data: dict, inp: dict, res: dict, store: ChartStore | None = None):
+    """Пълна карта (с CHART_STORE_SECTIONS) → хранилището; иначе нищо."""
+    store = store or get_chart_store()
+    if store is None or not all(res.get(sec) for sec in CHART_STORE_SECTIONS):
+        return
+    store.add(chart_cache_key(inp, ENGINE), chart_store_meta(data, inp), res)
+
+@app.route('/charts', methods=['POST', 'OPTIONS'])
+def charts_ingest():
+    """
+    Смята и записва карти в хранилището: {"items": [{..като /calculate.., "id"?}]}.
+    Изход: {"ok", "stored", "errors": [{"index", "error"}]}.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    store = get_chart_store()
+    if store is None:
+        return jsonify({"ok": False, "error": "хранилището е изключено (NK_CHART_STORE)"}), 404
+    try:
+        data = request.get_json(force=True)
+        items = data.get("items") if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            return jsonify({"ok": False, "error": "очаква се списък 'items'"}), 400
+        if len(items) > BATCH_MAX_ITEMS:
+            return jsonify({"ok": False, "error": f"твърде много записи ({len(items)} > {BATCH_MAX_ITEMS})"}), 400
+        rows, errors = [], []
+        tz_cache, ayan_cache = {}, {}
+        for i, item in enumerate(items):
+            try:
+                inp = chart_inputs(dict(item, include=None, exclude=None, vargas=None), tz_cache)
+                res = ENGINE.chart(item, ayan_cache=ayan_cache, inputs=inp)
+                rows.append((chart_cache_key(inp, ENGINE), chart_store_meta(item, inp), chart_attributes(res)))
+            except Exception as e:
+                errors.append({"index": i, "error": str(e)})
+        store.put_many(rows)
+        return jsonify({"ok": True, "stored": len(rows), "errors": errors}), 200
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e), "trace": traceback.format_exc()}), 500
+
+@app.route('/charts/query', methods=['GET', 'POST', 'OPTIONS'])
+def charts_query():
+    """
+    Търсене по атрибути (И между атрибутите, списък = някоя от стойностите):
+    {"where": {"karaka.АК": "Сатурн", "Луна.nakshatra": "Рохини", "D9.Ascendant.sign": "Лъв"},
+     "limit": 100, "after": <id от "next">, "count": false}
+    GET: ?attributes=1 – списъкът с атрибути; иначе where=<JSON>&limit=&after=&count=.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    store = get_chart_store()
+    if store is None:
+        return jsonify({"ok": False, "error": "хранилището е изключено (NK_CHART_STORE)"}), 404
+    try:
+        if request.method == 'GET':
+            if request.args.get("attributes"):
+                return jsonify({"ok": True, "attributes": {
+                    name: {"values": COMPACT_TABLES[table] if table else "число"}
+                    for name, (_col, table) in CHART_STORE_ATTRS.items()
+                }}), 200
+            data = {k: request.args[k] for k in ("limit", "after", "count") if k in request.args}
+            data["where"] = json.loads(request.args.get("where") or "{}")
+        else:
+            data = request.get_json(force=True) or {}
+        try:
+            limit = int(data.get("limit", 100))
+            after = int(data.get("after") or 0)
+            if not 1 <= limit <= CHART_STORE_MAX_LIMIT:
+                raise ValueError(f"limit: 1–{CHART_STORE_MAX_LIMIT}")
+            count = str(data.get("count", "")).lower() in ("1", "true")
+            t0 = time.perf_counter()
+            out = store.query(data.get("where") or {}, limit=limit, after=after, count=count)
+        except ValueError as e:
+            return jsonify({"ok": False, "error": str(e)}), 400
+        return jsonify({"ok": True, "elapsed_ms": round((time.perf_counter() - t0) * 1000, 3), **out}), 200
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e), "trace": traceback.format_exc()}), 500
+
+# ---------- PANCHANGA CALENDAR ----------
+CALENDAR_MAX_DAYS = int(os.getenv("NK_CALENDAR_MAX_DAYS", "36600"))
+
+@app.route('/panchanga/calendar', methods=['GET', 'POST', 'OPTIONS'])
+def panchanga_calendar_route():
+    """
+    NDJSON поток – по един ред на ден.
+    Параметри (query или JSON): lat, lon, from, to (YYYY-MM-DD, включително),
+    timezone (по желание), calc_type (standard | devaguru).
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        params = request.get_json(silent=True) if request.method == 'POST' else None
+        params = params or request.args
+        lat = float(params.get('lat'))
+        lon = float(params.get('lon'))
+        date_from = datetime.strptime(params.get('from'), "%Y-%m-%d").date()
+        date_to = datetime.strptime(params.get('to'), "%Y-%m-%d").date()
+        if date_to < date_from:
+            raise ValueError("'to' е преди 'from'")
+        if (date_to - date_from).days + 1 > CALENDAR_MAX_DAYS:
+            raise ValueError(f"твърде дълъг период (> {CALENDAR_MAX_DAYS} дни)")
+        tz_str = resolve_timezone(lat, lon, params.get('timezone'))
+        ayan_off = ENGINE.ayan_offset(params.get('calc_type', 'standard'))
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    def rows():
+        for row in panchanga_calendar(lat, lon, tz_str, date_from, date_to, ayan_off):
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+
+    return app.response_class(stream_with_context(rows()), mimetype="application/x-ndjson")
+
+# ---------- EVENTS ----------
+EVENTS_MAX_YEARS = float(os.getenv("NK_EVENTS_MAX_YEARS", "200"))
+
+@app.route('/events', methods=['GET', 'POST', 'OPTIONS'])
+def events_route():
+    """
+    NDJSON поток от събития, подредени по време.
+    Параметри (query или JSON): from, to (YYYY-MM-DD, UT), planets (имена, по
+    подразбиране всички девет), events (sign, nakshatra, pada, station),
+    timezone (за "at", по подразбиране UTC), calc_type, node_type.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        params = request.get_json(silent=True) if request.method == 'POST' else None
+        params = params or request.args
+
+        def as_list(key, default):
+            v = params.get(key)
+            if not v:
+                return list(default)
+            return [x.strip() for x in v.split(",") if x.strip()] if isinstance(v, str) else list(v)
+
+        d0 = datetime.strptime(params.get('from'), "%Y-%m-%d")
+        d1 = datetime.strptime(params.get('to'), "%Y-%m-%d")
+        jd_from = swe.julday(d0.year, d0.month, d0.day, 0.0)
+        jd_to = swe.julday(d1.year, d1.month, d1.day, 0.0) + 1.0
+        if jd_to <= jd_from:
+            raise ValueError("'to' е преди 'from'")
+        if jd_to - jd_from > EVENTS_MAX_YEARS * 365.25:
+            raise ValueError(f"твърде дълъг период (> {EVENTS_MAX_YEARS:g} години)")
+        planets = as_list('planets', EVENT_BODIES)
+        kinds = as_list('events', EVENT_KINDS)
+        for p in planets:
+            if p not in EVENT_BODIES:
+                raise ValueError(f"непознато тяло: {p}")
+        for k in kinds:
+            if k not in EVENT_KINDS:
+                raise ValueError(f"непознато събитие: {k}")
+        tz = _safe_zoneinfo(params.get('timezone') or "UTC")
+        ayan_off = ENGINE.ayan_offset(params.get('calc_type', 'standard'))
+        node_type = (params.get('node_type') or ENGINE.node_type).upper()
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    def rows():
+        for jd, ev in search_events(jd_from, jd_to, planets, kinds, node_type, ayan_off):
+            yield json.dumps(dict(ev, at=jd_to_datetime(jd, tz).isoformat(), jd=round(jd, 6)),
+                             ensure_ascii=False) + "\n"
+
+    return app.response_class(stream_with_context(rows()), mimetype="application/x-ndjson")
+
+# ---------- MUHURTA ----------
+MUHURTA_MAX_DAYS = float(os.getenv("NK_MUHURTA_MAX_DAYS", "92"))
+
+def _local_moment_jd(value, tz) -> float:
+    """"YYYY-MM-DD" или ISO момент (без зона = местно време в tz) → JD (UT)."""
+    dt = datetime.fromisoformat(str(value))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=tz)
+    return JD_UNIX_EPOCH + dt.timestamp() / 86400.0
+
+@app.route('/muhurta', methods=['POST', 'OPTIONS'])
+def muhurta_route():
+    """
+    Прозорците в [from, to), в които всички критерии са изпълнени.
+    Вход: {"lat", "lon", "timezone" (по желание), "from", "to" (дата или ISO момент,
+    без зона = местно време), "calc_type", "min_minutes",
+    "criteria": {"Ascendant": ["Телец", "Лъв"], "nakshatra": [...], "tithi": [...],
+                 "yoga": [...], "karana": [...], "exclude": {"karana": ["Вишти"]},
+                 "not_retrograde": ["Меркурий"]}}
+    Изход: {"ok", "timezone", "intervals": [{"start", "end", "minutes", <част>: [стойности]}]}.
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        data = request.get_json(force=True)
+        lat = float(data.get('lat'))
+        lon = float(data.get('lon'))
+        tz_str = resolve_timezone(lat, lon, data.get('timezone'))
+        tz = _safe_zoneinfo(tz_str)
+        jd_from = _local_moment_jd(data.get('from'), tz)
+        jd_to = _local_moment_jd(data.get('to'), tz)
+        if jd_to <= jd_from:
+            raise ValueError("'to' е преди 'from'")
+        if jd_to - jd_from > MUHURTA_MAX_DAYS:
+            raise ValueError(f"твърде дълъг период (> {MUHURTA_MAX_DAYS:g} дни)")
+        allowed, not_retro = parse_muhurta_criteria(data.get('criteria'))
+        ayan_off = ENGINE.ayan_offset(data.get('calc_type', 'standard'))
+        min_days = float(data.get('min_minutes', 0)) / 1440.0
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    try:
+        found = muhurta_search(jd_from, jd_to, lat, lon, allowed, not_retro, ayan_off, min_days)
+    except Exception as e:
+        return jsonify({
+            "ok": False,
+            "error": str(e),
+            "trace": traceback.format_exc()
+        }), 500
+
+    return jsonify({
+        "ok": True,
+        "timezone": tz_str,
+        "intervals": [
+            dict(values, start=jd_to_datetime(a, tz).isoformat(), end=jd_to_datetime(b, tz).isoformat(),
+                 minutes=round((b - a) * 1440.0, 2))
+            for a, b, values in found
+        ],
+    }), 200
+
+# ---------- LAGNA TABLE ----------
+LAGNA_MAX_DAYS = int(os.getenv("NK_LAGNA_MAX_DAYS", "3660"))
+
+@app.route('/lagna/table', methods=['GET', 'POST', 'OPTIONS'])
+def lagna_table_route():
+    """
+    NDJSON поток – по един ред на ден: {"date", "lagna" (в местна полунощ),
+    "ingresses": [{"sign", "at", "minutes"}]}.
+    Параметри (query или JSON): lat, lon, from, to (YYYY-MM-DD, включително; без
+    to – само from), timezone (по желание), calc_type (standard | devaguru).
+    """
+    if request.method == 'OPTIONS':
+        return ('', 204)
+    try:
+        params = request.get_json(silent=True) if request.method == 'POST' else None
+        params = params or request.args
+        lat = float(params.get('lat'))
+        lon = float(params.get('lon'))
+        date_from = datetime.strptime(params.get('from'), "%Y-%m-%d").date()
+        date_to = datetime.strptime(params.get('to') or params.get('from'), "%Y-%m-%d").date()
+        if date_to < date_from:
+            raise ValueError("'to' е преди 'from'")
+        if (date_to - date_from).days + 1 > LAGNA_MAX_DAYS:
+            raise ValueError(f"твърде дълъг период (> {LAGNA_MAX_DAYS} дни)")
+        tz_str = resolve_timezone(lat, lon, params.get('timezone'))
+        ayan_off = ENGINE.ayan_offset(params.get('calc_type', 'standard'))
+    except Exception as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    def rows():
+        for row in lagna_table(lat, lon, tz_str, date_from, date_to, ayan_off):
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+
+    return app.response_class(stream_with_context(rows()), mimetype="application/x-ndjson")
+
+# ---------- METRICS ----------
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return app.response_class(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+# ---------- CACHE STATS ----------
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "ok": True,
+        "result_cache": RESULT_CACHE.stats(),
+        "tz_cache": _TZ_CACHE.stats(),
+        "lagna_cache": LAGNA_CACHE.stats(),
+        "sun_cache": SUN_CACHE.stats(),
+        "ayan_exact_cache": _spica_ayanamsha_exact.cache_info()._asdict(),
+    }), 200
+
 # ---------- ROOT ----------
 @app.route('/')
 def home():
     return f"Astro Calculator API is running (AYAN={AYAN}, NODE={NODE}, OFF_DG={NK_AYAN_OFFSET_DG}, OFF_JH={NK_AYAN_OFFSET_JH})"
 
+STARTUP["import_s"] = round(time.perf_counter() - _T_START, 4)
+
 if __name__ == '__main__':
+    # само за разработка; в production: gunicorn -c gunicorn.conf.py app:app
+    warm_up(background=WARM_BACKGROUND)
+    start_jobs()
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 10000)))
@@ -0,0 +1,676 @@
+# bench.py
+"""
+Бенчмаркове за изчислителния конвейер.
+
+    python bench.py                 # всички
+    python bench.py panchanga       # само избрани
+    python bench.py formats         # json / fastjson / msgpack, с и без schema=compact
+    python bench.py match           # ащакута: профил срещу 200k кандидати
+    python bench.py startup         # бюджет за студен старт (изход 1 при превишение)
+    python bench.py corpus          # функциите и /calculate върху CORPUS + сверка с еталона
+    python bench.py batch           # /calculate/batch срещу цикъл от /calculate (в процеса и през HTTP)
+    python bench.py cheb            # ChebyshevEphemeris срещу swe.calc_ut (изход 1 над прага)
+    python bench.py store           # ChartStore: UPSERT + студено зареждане над една партида (изход 1 при разлика)
+    python bench.py --update-golden # презаписва bench_golden.json (само след умишлена промяна)
+    python bench.py --update-reference [rev]  # bench_reference.json от базовото дърво (първия commit)
+
+Два еталона: bench_reference.json – лонгитуди, знаци, накшатри, панчанга и маха даши,
+сметнати от базовото дърво (не от кода под тест) и непроменяни от --update-golden;
+bench_golden.json – всичко останало, сметнато от самия код (самореферентно: пази от
+неволни промени, но не доказва верност). Умишлените разлики спрямо базата са изброени
+в REFERENCE_CHANGES.
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import statistics
+import time
+from datetime import datetime
+
+import swisseph as swe
+
+import app
+
+BIRTH = {"date": "1988-05-24", "time": "12:00", "lat": 43.2141, "lon": 27.9147, "timezone": "Europe/Sofia"}
+
+
+def bench_panchanga(n: int = 2000):
+    """Добавената латентност от началото/края на титхи/накшатра/йога/карана."""
+    inp = app.chart_inputs(BIRTH)
+    dt_local = inp["dt_utc"].astimezone(app._safe_zoneinfo(inp["tz_used"]))
+    off = app.NK_AYAN_OFFSET_JH
+
+    # различни моменти (всеки със своите Слънце/Луна), за да не мерим кеша на SE
+    cases = []
+    for i in range(n):
+        jd = inp["jd"] + i * 0.37
+        planets = app.planet_longitudes(jd, ayan_override=app._ayanamsha_deg_ut(jd, off))
+        cases.append((jd, planets[0]["longitude"], planets[1]["longitude"]))
+
+    def run(ayan_off):
+        t0 = time.perf_counter()
+        for jd, sun, moon in cases:
+            app.compute_panchanga(jd, dt_local, sun, moon, ayan_off=ayan_off)
+        return (time.perf_counter() - t0) / len(cases) * 1e6
+
+    run(None)
+    base = run(None)
+    full = run(off)
+
+    calls = [0]
+    orig = swe.calc_ut
+
+    def counting(*a, **k):
+        calls[0] += 1
+        return orig(*a, **k)
+
+    swe.calc_ut = counting
+    try:
+        for jd, sun, moon in cases[:200]:
+            app.panchanga_transitions(jd, sun, moon, off)
+    finally:
+        swe.calc_ut = orig
+
+    print(f"panchanga: без преходи {base:8.1f} µs | с преходи {full:8.1f} µs "
+          f"| добавено {full - base:8.1f} µs/карта | {calls[0] / 200:.1f} calc_ut/карта")
+
+
+def bench_events(years: float = 100.0):
+    """Всички събития за деветте граха за `years` години."""
+    jd0 = swe.julday(1950, 1, 1, 0.0)
+    backend = "chebyshev" if app.get_cheb() is not None else "swe"
+    t0 = time.perf_counter()
+    n = sum(1 for _ in app.search_events(jd0, jd0 + years * 365.25))
+    dt = time.perf_counter() - t0
+    print(f"events: {years:g} г., {n} събития за {dt:6.2f} s ({backend})")
+
+
+def bench_formats(n: int = 500):
+    """Сериализация на една карта във всеки формат (µs и байтове)."""
+    obj = app.ENGINE.chart(BIRTH)
+    for fmt in app.RESPONSE_FORMATS:
+        if fmt == "msgpack" and app.msgpack is None:
+            print("formats: msgpack – пакетът не е инсталиран")
+            continue
+        for compact in (False, True):
+            enc = app.body_encoder(fmt, compact)
+            t0 = time.perf_counter()
+            for _ in range(n):
+                body = enc(obj)
+            us = (time.perf_counter() - t0) / n * 1e6
+            label = fmt + ("+compact" if compact else "")
+            print(f"formats: {label:18s} {us:8.1f} µs | {len(body):6d} B")
+
+
+def bench_match(n: int = 200_000, queries: int = 200, top: int = 20):
+    """Ащакута: профил срещу n кандидати (половината от другия пол), top-k."""
+    import random
+    rnd = random.Random(0)
+    pool = app.MatchPool()
+    for i in range(n):
+        pool.put(str(i), i % 2, rnd.randrange(108))
+    t0 = time.perf_counter()
+    app.koota_matrix(), app.koota_matrix_t()
+    pool.top(0, 0, top)
+    setup = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for q in range(queries):
+        pool.top(q % 2, rnd.randrange(108), top)
+    ms = (time.perf_counter() - t0) / queries * 1e3
+    print(f"match: {n} кандидати, top {top}: {ms:6.3f} ms/профил (първо търсене с матрицата {setup * 1e3:.1f} ms)")
+
+
+def bench_muhurta(days: float = 7.0, runs: int = 5):
+    """Мухурта за `days` дни (лагна + панчанга + ретро) срещу /calculate през минута."""
+    tz = app._safe_zoneinfo("Europe/Sofia")
+    jd0 = app._local_moment_jd("2025-03-10", tz)
+    allowed, not_retro = app.parse_muhurta_criteria({
+        "Ascendant": ["Телец", "Лъв", "Везни"],
+        "nakshatra": ["Рохини", "Мригашира", "Хаста", "Читра", "Свати", "Ревати", "Ашвини", "Пушя"],
+        "exclude": {"karana": ["Вишти"]},
+        "not_retrograde": ["Меркурий"],
+    })
+    off = app.ENGINE.ayan_offset("standard")
+    app.muhurta_search(jd0, jd0 + days, BIRTH["lat"], BIRTH["lon"], allowed, not_retro, off)
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        found = app.muhurta_search(jd0, jd0 + days, BIRTH["lat"], BIRTH["lon"], allowed, not_retro, off)
+    ms = (time.perf_counter() - t0) / runs * 1e3
+    # за сравнение: една карта с лагна и панчанга × минутите в прозореца
+    data = dict(BIRTH, include="Ascendant,Planets,Panchanga")
+    t0 = time.perf_counter()
+    for _ in range(50):
+        app.ENGINE.chart(data)
+    brute = (time.perf_counter() - t0) / 50 * days * 1440
+    print(f"muhurta: {days:g} дни, {len(found)} прозореца за {ms:7.1f} ms "
+          f"(проби през минута с /calculate ≈ {brute:.1f} s)")
+
+
+# максимална грешка спрямо swe.calc_ut: лонгитуд (") и скорост (°/ден) – вж. "Измерена точност" в app.py
+CHEB_LIMITS = {
+    swe.SUN: (0.01, 1e-4), swe.MOON: (0.01, 1e-4), swe.MEAN_NODE: (0.01, 1e-4), swe.TRUE_NODE: (0.3, 0.1),
+    **{b: (app.CHEB_TOL_ARCSEC, 2e-3) for b in (swe.MERCURY, swe.VENUS, swe.MARS, swe.JUPITER, swe.SATURN)},
+}
+
+
+def bench_cheb(n: int = 100_000):
+    """ChebyshevEphemeris (целият диапазон, кешът в NK_CHEB_DIR) срещу swe.calc_ut в n случайни момента."""
+    eph = app.ChebyshevEphemeris()
+    bad = 0
+    for body, (tol_lon, tol_spd) in CHEB_LIMITS.items():
+        t0 = time.perf_counter()
+        eph.prepare([body])
+        build = time.perf_counter() - t0
+        err_lon, err_spd = eph.check_accuracy(body, n=n)
+        ok = err_lon <= tol_lon and err_spd <= tol_spd
+        bad += not ok
+        print(f"cheb: {swe.get_planet_name(body):10s} {err_lon:7.4f}\" (≤ {tol_lon:g}) "
+              f"{err_spd:.1e} °/ден (≤ {tol_spd:g}) | таблица {build:5.1f} s {'OK' if ok else 'НАД ПРАГА'}")
+    if bad:
+        raise SystemExit(1)
+
+
+def bench_store(n: int = 70_000):
+    """
+    ChartStore: n реда, после UPSERT на стар ключ (нов seq, старо id) и студено
+    зареждане от нов процесен индекс – колонният индекс трябва да съвпада с SQLite.
+    """
+    import random
+    import tempfile
+    rnd = random.Random(0)
+    sign = app.CHART_STORE_ATTRS["Ascendant.sign"][0]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "charts.sqlite")
+        store = app.ChartStore(path)
+        signs = {f"k{i}": rnd.randrange(12) for i in range(n)}
+        t0 = time.perf_counter()
+        store.put_many([(k, {"ext_id": k[1:]}, {sign: v}) for k, v in signs.items()])
+        put = time.perf_counter() - t0
+        store.query({}, limit=1)                                  # топъл индекс → после обновления
+        for k in ("k4", f"k{n // 2}"):
+            signs[k] = (signs[k] + 5) % 12
+            store.put_many([(k, {"ext_id": k[1:]}, {sign: signs[k]})])
+        bad = 0
+        for label, st in (("топъл", store), ("студен", app.ChartStore(path))):
+            t0 = time.perf_counter()
+            st.query({}, limit=1)
+            ms = (time.perf_counter() - t0) * 1e3
+            if st._n != n:
+                print(f"store: {label}: {st._n} реда в индекса, очаквани {n}")
+                bad += 1
+            for s in range(12):
+                got = st.query({"Ascendant.sign": s}, limit=n, count=True)
+                want = sorted(int(k[1:]) for k, v in signs.items() if v == s)
+                ext = sorted(int(c["ext_id"]) for c in got["charts"])
+                if got["count"] != len(want) or ext != want:
+                    print(f"store: {label}: Ascendant.sign={app.SIGNS[s]}: {got['count']} ≠ {len(want)}")
+                    bad += 1
+            print(f"store: {label} индекс за {ms:7.1f} ms")
+    print(f"store: {n} карти записани за {put:.2f} s, {'OK' if not bad else f'{bad} разлики'}")
+    if bad:
+        raise SystemExit(1)
+
+
+BATCH_TARGET = 10.0     # цел: ≥ 10× карти/s спрямо цикъл от единични заявки
+
+
+def _batch_records(n: int, seed: int = 0) -> list:
+    """n различни рождени данни (без попадения в кеша на резултатите)."""
+    import random
+    rnd = random.Random(seed)
+    return [{"date": f"{rnd.randint(1930, 2020)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+             "time": f"{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}",
+             "lat": round(rnd.uniform(-50.0, 60.0), 4), "lon": round(rnd.uniform(-120.0, 150.0), 4)}
+            for _ in range(n)]
+
+
+def _batch_http(mode: str, items: list) -> tuple:
+    """(единични карти/s, batch карти/s) срещу gunicorn (gunicorn.conf.py) с NK_EXEC_MODE=mode."""
+    import http.client
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PORT=str(port), NK_EXEC_MODE=mode, NK_RESULT_CACHE_SIZE="0", NK_CHART_STORE="",
+               NK_JOBS="0")
+    env.pop("NK_RESULT_CACHE_DB", None)
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"], cwd=here,
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        conn = None
+        for _ in range(600):
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+                conn.request("GET", "/health")
+                if conn.getresponse().read() and conn.sock is not None:
+                    break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise SystemExit(f"batch: gunicorn ({mode}) не тръгна")
+
+        def post(path, obj):
+            conn.request("POST", path, body=json.dumps(obj), headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status != 200:
+                raise SystemExit(f"batch: {path} → {resp.status} {body[:200]!r}")
+
+        post("/calculate/batch", {"items": _batch_records(50, seed=1)})     # загрява пула/процесите
+        t0 = time.perf_counter()
+        for item in items:                                  # keep-alive – в полза на единичните
+            post("/calculate", item)
+        single = len(items) / (time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        for i in range(0, len(items), app.BATCH_MAX_ITEMS):
+            post("/calculate/batch", {"items": items[i:i + app.BATCH_MAX_ITEMS]})
+        batch = len(items) / (time.perf_counter() - t0)
+        return single, batch
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def bench_batch(n: int = 500):
+    """
+    /calculate/batch срещу цикъл от n единични /calculate (без кеша на резултатите):
+    в процеса (test client) и през HTTP към gunicorn с NK_EXEC_MODE=inline и process.
+    """
+    items = _batch_records(n)
+    client = app.app.test_client()
+    cache = app.RESULT_CACHE
+    saved = cache.max_items, cache._db
+    cache.max_items, cache._db = 0, None
+    try:
+        client.post("/calculate/batch", json={"items": _batch_records(50, seed=1)})
+        t0 = time.perf_counter()
+        for item in items:
+            client.post("/calculate", json=item)
+        single = n / (time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        client.post("/calculate/batch", json={"items": items})
+        batch = n / (time.perf_counter() - t0)
+    finally:
+        cache.max_items, cache._db = saved
+    rows = [("test client", single, batch)]
+    for mode in ("inline", "process"):
+        rows.append((f"HTTP {mode}", *_batch_http(mode, items)))
+    cores = os.cpu_count() or 1
+    for label, single, batch in rows:
+        print(f"batch: {label:12s} единични {single:7.1f} карти/s | batch {batch:7.1f} карти/s | "
+              f"×{batch / single:.2f} (цел ×{BATCH_TARGET:g}, {cores} ядра)")
+
+
+STARTUP_BUDGET_S = float(os.getenv("NK_STARTUP_BUDGET_S", "1.0"))
+
+
+def bench_startup(runs: int = 3):
+    """
+    Студен старт в нов процес: import + warm_up() до ready (медиана от `runs`,
+    по ready_s от отчета STARTUP). Над NK_STARTUP_BUDGET_S → изход 1.
+    """
+    code = "import app; app.warm_up()"
+    here = os.path.dirname(os.path.abspath(__file__))
+    readies, report = [], {}
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True, check=True)
+        line = next(l for l in proc.stderr.splitlines() if l.startswith("startup: "))
+        report = json.loads(line[len("startup: "):])
+        readies.append(report["ready_s"])
+    ready = sorted(readies)[len(readies) // 2]
+    stages = " | ".join(f"{k} {v:.3f}" for k, v in sorted(report.items()) if k.endswith("_s"))
+    print(f"startup: ready {ready:6.3f} s (бюджет {STARTUP_BUDGET_S:g} s) | {stages}")
+    if ready > STARTUP_BUDGET_S:
+        raise SystemExit(f"startup: {ready:.3f} s > бюджета {STARTUP_BUDGET_S:g} s")
+
+# ---------- корпус и еталон ----------
+# Фиксирани рождени данни с трудните случаи: полярни ширини (Плацидус там не
+# работи → /calculate дава грешка; пазим я в еталона, за да се види, ако се
+# промени), DST дупка и двойно време, LMT, южно полукълбо, зони с :30/:45,
+# пропуснатият ден на Самоа, стари и бъдещи дати, DevaGuru, варги.
+CORPUS = [
+    ("varna_1988", BIRTH),
+    ("london_1966", {"date": "1966-07-30", "time": "15:00", "lat": 51.5074, "lon": -0.1278, "timezone": "Europe/London"}),
+    ("new_york_dst_gap", {"date": "2021-03-14", "time": "02:30", "lat": 40.7128, "lon": -74.006, "timezone": "America/New_York"}),
+    ("new_york_dst_fold", {"date": "2021-11-07", "time": "01:30", "lat": 40.7128, "lon": -74.006, "timezone": "America/New_York"}),
+    ("sofia_dst_gap", {"date": "2022-03-27", "time": "03:30", "lat": 42.6977, "lon": 23.3219, "timezone": "Europe/Sofia"}),
+    ("sofia_lmt_1890", {"date": "1890-02-14", "time": "06:15", "lat": 42.6977, "lon": 23.3219, "use_lmt": True}),
+    ("kolkata_lmt_1921", {"date": "1921-11-03", "time": "04:40:30", "lat": 22.5726, "lon": 88.3639, "use_lmt": True}),
+    ("kathmandu_0545", {"date": "2001-07-01", "time": "23:59:30", "lat": 27.7172, "lon": 85.324, "timezone": "Asia/Kathmandu"}),
+    ("mumbai_0530", {"date": "1947-08-15", "time": "00:00", "lat": 19.076, "lon": 72.8777, "timezone": "Asia/Kolkata"}),
+    ("sydney_south", {"date": "1975-12-31", "time": "23:30", "lat": -33.8688, "lon": 151.2093, "timezone": "Australia/Sydney"}),
+    ("apia_skipped_day", {"date": "2011-12-30", "time": "12:00", "lat": -13.8333, "lon": -171.75, "timezone": "Pacific/Apia"}),
+    ("quito_1850", {"date": "1850-03-21", "time": "06:00", "lat": -0.1807, "lon": -78.4678, "timezone": "America/Guayaquil"}),
+    ("reykjavik_64n", {"date": "1990-01-10", "time": "12:00", "lat": 64.1466, "lon": -21.9426}),
+    ("tromso_polar", {"date": "1990-01-10", "time": "12:00", "lat": 69.6492, "lon": 18.9553}),
+    ("mcmurdo_polar", {"date": "2000-12-21", "time": "00:00", "lat": -77.85, "lon": 166.67}),
+    ("longyearbyen_no_houses", {"date": "2000-06-21", "time": "12:00", "lat": 78.2232, "lon": 15.6267,
+                                "exclude": "Ascendant,D9,ArudhaLagna"}),
+    ("varna_2150", {"date": "2150-09-09", "time": "09:09", "lat": 43.2141, "lon": 27.9147, "timezone": "Europe/Sofia"}),
+    ("varna_devaguru", dict(BIRTH, calc_type="devaguru")),
+    ("varna_vargas", dict(BIRTH, vargas="all")),
+]
+
+GOLDEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_golden.json")
+GOLDEN_TOL_DEG = float(os.getenv("NK_GOLDEN_TOL_DEG", "1e-5"))     # ~0.04"
+GOLDEN_TOL_PCT = float(os.getenv("NK_GOLDEN_TOL_PCT", "1e-3"))     # left_percent
+GOLDEN_TOL_S = float(os.getenv("NK_GOLDEN_TOL_S", "2"))            # времена на преходи
+GOLDEN_SKIP = {"config.build", "config.ephe_path"}
+
+REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_reference.json")
+# път (без индексите) → защо се различава от базата умишлено
+REFERENCE_CHANGES = {
+    "Panchanga.vara.name": "варата започва от изгрева (NK_VARA_SUNRISE=1), в базата – от полунощ",
+}
+
+
+def _function_digest(data: dict) -> dict:
+    """Междинните стойности от публичните функции (без Flask)."""
+    lat, lon = float(data["lat"]), float(data["lon"])
+    tz = app.resolve_timezone(lat, lon, data.get("timezone"))
+    jd, _ = app.dt_to_jd(data["date"], data["time"], tz, lon=lon, use_lmt=bool(data.get("use_lmt")))
+    out = {"tz": tz, "jd": jd, "ayanamsha": app._ayanamsha_deg_ut(jd)}
+    try:
+        cusps, ascmc = app.houses_safe(jd, lat, lon, flags=app.FLAGS_TROP, hsys=b"P")
+        out["cusps"] = [c % 360.0 for c in cusps[:12]]
+        out["asc_trop"] = ascmc[0] % 360.0
+    except Exception as e:
+        out["houses_error"] = str(e)
+    return out
+
+
+def _calculate_digest(client, data: dict) -> dict:
+    """/calculate, сведен до сравними стойности (Вимшоттари – само маха периодите)."""
+    resp = client.post("/calculate", json=data)
+    body = resp.get_json()
+    if resp.status_code != 200:
+        return {"status": resp.status_code, "error": body.get("error")}
+    vim = body.get("Vimshottari")
+    if vim:
+        body["Vimshottari"] = [{k: p[k] for k in ("lord", "start", "end")} | {"antar": len(p.get("antar") or ())}
+                               for p in vim]
+    return {"status": 200, "body": body}
+
+
+def reference_digest(body: dict) -> dict:
+    """Частта от /calculate, която се сверява с базата: лонгитуди и знаци."""
+    out = {}
+    if body.get("Ascendant"):
+        out["Ascendant"] = {k: body["Ascendant"][k] for k in ("degree", "sign")}
+    if body.get("Planets"):
+        out["Planets"] = [{k: p.get(k) for k in ("planet", "longitude", "sign", "nakshatra", "pada", "retrograde")}
+                          for p in body["Planets"]]
+    d9 = body.get("D9")
+    if d9:
+        out["D9"] = {"Ascendant": d9["Ascendant"]["sign"], "ArudhaLagna": (d9.get("ArudhaLagna") or {}).get("sign"),
+                     "Planets": [p["sign"] for p in d9["Planets"]]}
+    if body.get("ArudhaLagna"):
+        out["ArudhaLagna"] = body["ArudhaLagna"].get("sign")
+    pan = body.get("Panchanga")
+    if pan:
+        out["Panchanga"] = {k: {"name": pan[k]["name"]} for k in ("tithi", "nakshatra", "yoga", "karana", "vara")
+                            if k in pan}
+    if body.get("Vimshottari"):
+        out["Vimshottari"] = [{k: p[k] for k in ("lord", "start", "end")} for p in body["Vimshottari"]]
+    return out
+
+
+def reference_diffs(ref: dict, calc: dict):
+    """(разлики, умишлени разлики) на /calculate спрямо записа от базата."""
+    if ref["status"] != 200:                                # базата не смята този случай
+        return [], []
+    if calc["status"] != 200:
+        return [("status", 200, calc["status"])], []
+    diffs = golden_diffs(ref["body"], reference_digest(calc["body"]))
+    intended = [d for d in diffs if re.sub(r"\[\d+\]", "", d[0]) in REFERENCE_CHANGES]
+    return [d for d in diffs if d not in intended], intended
+
+
+def _load_reference() -> dict:
+    if not os.path.exists(REFERENCE_PATH):
+        raise SystemExit(f"няма {REFERENCE_PATH} – python bench.py --update-reference")
+    with open(REFERENCE_PATH, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def update_reference(rev: str | None = None):
+    """bench_reference.json: /calculate на базовото дърво (git archive rev) върху CORPUS."""
+    import tempfile
+    here = os.path.dirname(os.path.abspath(__file__))
+    rev = rev or subprocess.run(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=here, check=True,
+                                capture_output=True, text=True).stdout.split()[0]
+    rev = subprocess.run(["git", "rev-parse", rev], cwd=here, check=True, capture_output=True, text=True).stdout.strip()
+    script = (
+        "import json, sys\n"
+        "import app\n"
+        "c = app.app.test_client()\n"
+        "out = {}\n"
+        "for name, data in json.load(sys.stdin):\n"
+        "    r = c.post('/calculate', json=data)\n"
+        "    out[name] = {'status': r.status_code, 'body': r.get_json()}\n"
+        "json.dump(out, sys.stdout, ensure_ascii=False)\n"
+    )
+    env = {k: v for k, v in os.environ.items() if not k.startswith("NK_") and k != "PYTHONPATH"}
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = subprocess.run(["git", "archive", rev], cwd=here, check=True, capture_output=True).stdout
+        subprocess.run(["tar", "-x", "-C", tmp], input=archive, check=True)
+        proc = subprocess.run([sys.executable, "-c", script], cwd=tmp, env=env, input=json.dumps(CORPUS),
+                              capture_output=True, text=True, check=True)
+    cases = {}
+    for name, r in json.loads(proc.stdout).items():
+        cases[name] = {"status": r["status"]}
+        if r["status"] == 200:
+            cases[name]["body"] = reference_digest(r["body"])
+    ref = {"rev": rev, "cases": cases}
+    with open(REFERENCE_PATH, "w", encoding="utf-8") as fh:
+        json.dump(ref, fh, ensure_ascii=False, indent=1, sort_keys=True)
+        fh.write("\n")
+    skipped = [n for n, c in cases.items() if c["status"] != 200]
+    print(f"{REFERENCE_PATH}: {len(cases)} случая от {rev[:10]} (без отговор в базата: {', '.join(skipped) or '–'})")
+
+
+def golden_record(client, data: dict) -> dict:
+    return {"functions": _function_digest(data), "calculate": _calculate_digest(client, data)}
+
+
+def _flatten(obj, prefix=""):
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            yield from _flatten(v, f"{prefix}.{k}" if prefix else str(k))
+    elif isinstance(obj, list):
+        for i, v in enumerate(obj):
+            yield from _flatten(v, f"{prefix}[{i}]")
+    else:
+        yield prefix, obj
+
+
+def _iso_delta(a: str, b: str):
+    try:
+        return abs((datetime.fromisoformat(a) - datetime.fromisoformat(b)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _same(path: str, want, got) -> bool:
+    key = path.rsplit(".", 1)[-1]
+    if isinstance(want, bool) or isinstance(got, bool) or isinstance(want, int) and isinstance(got, int):
+        return want == got
+    if isinstance(want, (int, float)) and isinstance(got, (int, float)):
+        if key == "jd":
+            return abs(want - got) <= 1e-9
+        if key == "left_percent":
+            return abs(want - got) <= GOLDEN_TOL_PCT
+        if key in ("age_start", "age_end"):
+            return abs(want - got) <= 1e-6
+        diff = abs(want - got) % 360.0                      # градуси (с прехода 360 → 0)
+        return min(diff, 360.0 - diff) <= GOLDEN_TOL_DEG
+    if isinstance(want, str) and isinstance(got, str) and want != got:
+        d = _iso_delta(want, got)
+        return d is not None and d <= GOLDEN_TOL_S
+    return want == got
+
+
+def golden_diffs(want: dict, got: dict) -> list:
+    """[(път, еталон, получено)] – липсващи/излишни ключове също са разлика."""
+    a = {k: v for k, v in _flatten(want) if not any(k.endswith(s) for s in GOLDEN_SKIP)}
+    b = {k: v for k, v in _flatten(got) if not any(k.endswith(s) for s in GOLDEN_SKIP)}
+    return [(k, a.get(k), b.get(k)) for k in sorted(a.keys() | b.keys())
+            if k not in a or k not in b or not _same(k, a[k], b[k])]
+
+
+def _timed(fn, args_list, repeat: int):
+    """µs/извикване: медиана от `repeat` прохода през args_list."""
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for args in args_list:
+            fn(*args)
+        runs.append((time.perf_counter() - t0) / len(args_list) * 1e6)
+    return statistics.median(runs)
+
+
+def bench_corpus(repeat: int = 20):
+    """
+    Времена на публичните функции и на /calculate (през test client, без кеша на
+    резултатите) върху CORPUS; после сверка с bench_golden.json (изход 1 при разлики).
+    """
+    client = app.app.test_client()
+    ok = [d for _, d in CORPUS if "exclude" not in d]
+    prepared = []
+    for data in ok:
+        f = _function_digest(data)
+        lat, lon = float(data["lat"]), float(data["lon"])
+        prepared.append((data, lat, lon, f))
+
+    off = app.NK_AYAN_OFFSET_JH
+    planets = [app.planet_longitudes(f["jd"], ayan_override=app._ayanamsha_deg_ut(f["jd"], off))
+               for _, _, _, f in prepared]
+    dt_locals = [app.dt_to_jd(d["date"], d["time"], f["tz"], lon=lon, use_lmt=bool(d.get("use_lmt")))[1]
+                 .astimezone(app._safe_zoneinfo(f["tz"])) for d, _, lon, f in prepared]
+    rows = [
+        ("resolve_timezone", app.resolve_timezone, [(lat, lon, d.get("timezone")) for d, lat, lon, _ in prepared]),
+        ("dt_to_jd", app.dt_to_jd, [(d["date"], d["time"], f["tz"], lon, bool(d.get("use_lmt")))
+                                    for d, _, lon, f in prepared]),
+        ("_ayanamsha_deg_ut", app._ayanamsha_deg_ut, [(f["jd"], off) for *_, f in prepared]),
+        ("planet_longitudes", lambda jd, ay: app.planet_longitudes(jd, ayan_override=ay),
+         [(f["jd"], app._ayanamsha_deg_ut(f["jd"], off)) for *_, f in prepared]),
+        ("houses_safe", lambda jd, lat, lon: app.houses_safe(jd, lat, lon, flags=app.FLAGS_TROP, hsys=b"P"),
+         [(f["jd"], lat, lon) for _, lat, lon, f in prepared if "cusps" in f]),
+        ("compute_panchanga", lambda jd, dt, p: app.compute_panchanga(jd, dt, p[0]["longitude"], p[1]["longitude"],
+                                                                      ayan_off=off),
+         [(f["jd"], dt, p) for (*_, f), dt, p in zip(prepared, dt_locals, planets)]),
+        ("vimsottari_generate", lambda dt, moon: app.vimsottari_generate(dt, moon),
+         [(dt, p[1]["longitude"]) for dt, p in zip(dt_locals, planets)]),
+        ("d9_sign_name_from_lon", app.d9_sign_name_from_lon,
+         [(b["longitude"],) for p in planets for b in p]),
+    ]
+    for name, fn, args in rows:
+        print(f"corpus: {name:22s} {_timed(fn, args, repeat):10.1f} µs/извикване ({len(args)} случая)")
+
+    cache = app.RESULT_CACHE
+    saved = cache.max_items, cache._db
+    cache.max_items, cache._db = 0, None
+    try:
+        calc = [d for _, d in CORPUS]
+        us = _timed(lambda d: client.post("/calculate", json=d), [(d,) for d in calc], max(1, repeat // 4))
+        print(f"corpus: {'/calculate':22s} {us:10.1f} µs/заявка ({len(calc)} случая, без кеша)")
+
+        if not os.path.exists(GOLDEN_PATH):
+            raise SystemExit(f"corpus: няма {GOLDEN_PATH} – python bench.py --update-golden")
+        with open(GOLDEN_PATH, encoding="utf-8") as fh:
+            golden = json.load(fh)
+        reference = _load_reference()
+        bad = bad_ref = checked = 0
+        intended = {}
+        for name, data in CORPUS:
+            record = golden_record(client, data)
+            ref = reference["cases"].get(name)
+            if ref is None:
+                print(f"corpus: {name}: няма запис от базата")
+                bad_ref += 1
+            elif ref["status"] == 200:
+                checked += 1
+                diffs, same_as_planned = reference_diffs(ref, record["calculate"])
+                for path, want, got in diffs[:10]:
+                    print(f"corpus: {name}: {path}: база {want!r} ≠ {got!r}")
+                bad_ref += bool(diffs)
+                for path, _, _ in same_as_planned:
+                    intended[re.sub(r"\[\d+\]", "", path)] = intended.get(re.sub(r"\[\d+\]", "", path), 0) + 1
+            if name not in golden:
+                print(f"corpus: {name}: няма еталон")
+                bad += 1
+                continue
+            diffs = golden_diffs(golden[name], record)
+            for path, want, got in diffs[:10]:
+                print(f"corpus: {name}: {path}: еталон {want!r} ≠ {got!r}")
+            bad += bool(diffs)
+    finally:
+        cache.max_items, cache._db = saved
+    print(f"corpus: база {reference['rev'][:10]} – {checked - bad_ref}/{checked} съвпадат (лонгитуди и знаци)")
+    for path, n in intended.items():
+        print(f"corpus: база – умишлено различни {path} ×{n}: {REFERENCE_CHANGES[path]}")
+    print(f"corpus: еталон – {len(CORPUS) - bad}/{len(CORPUS)} съвпадат")
+    if bad or bad_ref:
+        raise SystemExit(1)
+
+
+def update_golden():
+    client = app.app.test_client()
+    cache = app.RESULT_CACHE
+    saved = cache.max_items, cache._db
+    cache.max_items, cache._db = 0, None
+    try:
+        golden = {name: golden_record(client, data) for name, data in CORPUS}
+    finally:
+        cache.max_items, cache._db = saved
+    # самореферентният еталон не може да покрие отклонение от базата
+    reference = _load_reference()
+    bad = 0
+    for name, record in golden.items():
+        ref = reference["cases"].get(name)
+        diffs = reference_diffs(ref, record["calculate"])[0] if ref else []
+        for path, want, got in diffs[:10]:
+            print(f"{name}: {path}: база {want!r} ≠ {got!r}")
+        bad += bool(diffs)
+    if bad:
+        raise SystemExit(f"{GOLDEN_PATH}: не е презаписан – {bad} случая се различават от базата")
+    if os.path.exists(GOLDEN_PATH):
+        with open(GOLDEN_PATH, encoding="utf-8") as fh:
+            old = json.load(fh)
+        for name, record in golden.items():
+            diffs = golden_diffs(old.get(name, {}), record)
+            if diffs:
+                print(f"{name}: {len(diffs)} промени, напр. {', '.join(p for p, _, _ in diffs[:3])}")
+    with open(GOLDEN_PATH, "w", encoding="utf-8") as fh:
+        json.dump(golden, fh, ensure_ascii=False, indent=1, sort_keys=True)
+        fh.write("\n")
+    print(f"{GOLDEN_PATH}: {len(golden)} записа")
+
+
+BENCHES = {
+    "panchanga": bench_panchanga,
+    "events": bench_events,
+    "formats": bench_formats,
+    "match": bench_match,
+    "muhurta": bench_muhurta,
+    "startup": bench_startup,
+    "corpus": bench_corpus,
+    "batch": bench_batch,
+    "cheb": bench_cheb,
+    "store": bench_store,
+}
+
+if __name__ == "__main__":
+    if "--update-golden" in sys.argv:
+        update_golden()
+        raise SystemExit(0)
+    if "--update-reference" in sys.argv:
+        rest = sys.argv[sys.argv.index("--update-reference") + 1:]
+        update_reference(rest[0] if rest else None)
+        raise SystemExit(0)
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        BENCHES[name]()
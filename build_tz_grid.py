@@ -0,0 +1,114 @@
+# build_tz_grid.py
+"""
+Офлайн строене на решетката за resolve_timezone (вж. TzGridIndex в app.py).
+
+Всяка клетка, през която минава граница на полигон от timezonefinder, се маркира
+като BORDER (→ точен тест по време на заявка). Останалите клетки лежат изцяло в
+една зона, затова стойността в центъра им е вярна за всяка точка в клетката.
+
+    python build_tz_grid.py                 # tz_grid.bin до app.py, стъпка 0.25°
+    python build_tz_grid.py --res 0.5 --out /tmp/tz_grid.bin --verify 100000
+"""
+import argparse
+import math
+import os
+import random
+import time
+
+import numpy as np
+from timezonefinder import TimezoneFinder
+
+from app import TzGridIndex
+
+
+def _mark_boundaries(tf, border: np.ndarray, res: float):
+    nrows, ncols = border.shape
+    for poly in range(tf.nr_of_polygons):
+        xy = tf.coords_of(poly).astype(np.float64) / 1e7   # [lng, lat] × n
+        x0 = xy[0]
+        y0 = xy[1]
+        x1 = np.roll(x0, -1)                               # затваряме полигона
+        y1 = np.roll(y0, -1)
+
+        c0 = np.clip(np.floor((x0 + 180.0) / res).astype(np.int64), 0, ncols - 1)
+        c1 = np.clip(np.floor((x1 + 180.0) / res).astype(np.int64), 0, ncols - 1)
+        r0 = np.clip(np.floor((y0 + 90.0) / res).astype(np.int64), 0, nrows - 1)
+        r1 = np.clip(np.floor((y1 + 90.0) / res).astype(np.int64), 0, nrows - 1)
+
+        # къси отсечки (≤ 1 клетка по всяка ос): bbox = четирите ъгъла
+        short = (np.abs(c1 - c0) <= 1) & (np.abs(r1 - r0) <= 1)
+        for rr, cc in ((r0, c0), (r0, c1), (r1, c0), (r1, c1)):
+            border[rr[short], cc[short]] = True
+
+        # дълги отсечки: делим на парчета ≤ res и маркираме bbox на всяко
+        for i in np.nonzero(~short)[0]:
+            n = int(math.ceil(max(abs(x1[i] - x0[i]), abs(y1[i] - y0[i])) / res)) + 1
+            xs = np.linspace(x0[i], x1[i], n + 1)
+            ys = np.linspace(y0[i], y1[i], n + 1)
+            cs = np.clip(np.floor((xs + 180.0) / res).astype(np.int64), 0, ncols - 1)
+            rs = np.clip(np.floor((ys + 90.0) / res).astype(np.int64), 0, nrows - 1)
+            for rr, cc in ((rs[:-1], cs[:-1]), (rs[:-1], cs[1:]), (rs[1:], cs[:-1]), (rs[1:], cs[1:])):
+                border[rr, cc] = True
+
+
+def build(out: str, res: float = 0.25):
+    tf = TimezoneFinder(in_memory=True)
+    ncols = int(round(360.0 / res))
+    nrows = int(round(180.0 / res))
+
+    t0 = time.time()
+    border = np.zeros((nrows, ncols), dtype=bool)
+    _mark_boundaries(tf, border, res)
+    t1 = time.time()
+
+    cells = np.full((nrows, ncols), TzGridIndex.BORDER, dtype="<u2")
+    names = []
+    name_idx = {}
+    for row, col in zip(*np.nonzero(~border)):
+        lat = -90.0 + (row + 0.5) * res
+        lon = -180.0 + (col + 0.5) * res
+        tz = tf.timezone_at(lat=lat, lng=lon)
+        if not tz:
+            continue
+        idx = name_idx.get(tz)
+        if idx is None:
+            idx = name_idx[tz] = len(names)
+            names.append(tz)
+        cells[row, col] = idx
+    t2 = time.time()
+
+    TzGridIndex.write(out, cells.tobytes(), ncols, nrows, res, names, str(tf.data_version))
+    inner = int((cells != TzGridIndex.BORDER).sum())
+    print(f"{out}: {ncols}x{nrows} @ {res}°, {inner / cells.size:.1%} клетки без граница, "
+          f"{len(names)} зони, граници {t1 - t0:.1f}s, клетки {t2 - t1:.1f}s")
+
+
+def verify(path: str, n: int):
+    """Сравнява решетката с точния тест на случайни точки (трябва 0 разлики)."""
+    tf = TimezoneFinder(in_memory=True)
+    grid = TzGridIndex(path)
+    rnd = random.Random(0)
+    hits = bad = 0
+    for _ in range(n):
+        lat = rnd.uniform(-90.0, 90.0)
+        lon = rnd.uniform(-180.0, 180.0)
+        tz = grid.lookup(lat, lon)
+        if tz is None:
+            continue
+        hits += 1
+        if tz != tf.timezone_at(lat=lat, lng=lon):
+            bad += 1
+    print(f"verify: {n} точки, {hits} от решетката, {bad} разлики")
+    return bad
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--res", type=float, default=0.25, help="стъпка на решетката в градуси")
+    ap.add_argument("--out", default=os.getenv("NK_TZ_GRID") or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "tz_grid.bin"))
+    ap.add_argument("--verify", type=int, default=0, help="брой случайни точки за проверка")
+    args = ap.parse_args()
+    build(args.out, args.res)
+    if args.verify:
+        raise SystemExit(1 if verify(args.out, args.verify) else 0)
@@ -0,0 +1,38 @@
+# gunicorn.conf.py
+"""
+Production режим:  gunicorn -c gunicorn.conf.py app:app
+
+    PORT                порт (по подразбиране 10000)
+    WEB_CONCURRENCY     брой работни процеси (по подразбиране = брой ядра)
+    NK_THREADS          нишки на процес (gthread, по подразбиране 4)
+    NK_TIMEOUT          таймаут на заявка в секунди (по подразбиране 120 – потоците /events и календарът)
+    NK_WARM_BACKGROUND  1 → без warm-up в master; всеки работник загрява във фонова нишка
+
+app.py се зарежда веднъж в master процеса (preload_app) и warm_up() се пуска там,
+преди fork – часовите зони, таблицата на айанамшата и т.н. се делят между
+работниците (copy-on-write). gc.freeze() пази тези обекти от gc, за да не
+се копират страниците им при първото събиране на боклука в работника.
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "0")) or (os.cpu_count() or 1)
+worker_class = "gthread"
+threads = int(os.getenv("NK_THREADS", "4"))
+timeout = int(os.getenv("NK_TIMEOUT", "120"))
+keepalive = 5
+preload_app = True
+
+
+def when_ready(server):
+    import app
+    if app.WARM_BACKGROUND:
+        return      # всеки работник загрява във фонова нишка (after_fork)
+    app.warm_up()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
@@ -0,0 +1,100 @@
+# query_charts.py
+"""
+Хранилището на карти (ChartStore в app.py) от командния ред.
+
+    python query_charts.py --db charts.sqlite attributes
+    python query_charts.py --db charts.sqlite query "karaka.АК=Сатурн" "Луна.nakshatra=Рохини" "D9.Ascendant.sign=Лъв"
+    python query_charts.py --db charts.sqlite query "Слънце.sign=Овен,Лъв" --count --limit 20
+    python query_charts.py --db charts.sqlite ingest results.ndjson   # /jobs/<id>/results или отговори на /calculate
+    python query_charts.py --db charts.sqlite ingest --namespace job-42 results.ndjson
+
+По подразбиране --db е NK_CHART_STORE. При ingest редовете нямат входните данни,
+затова ключът е съдържанието на резултата (еднаквите карти се сливат). С --namespace
+ключът е "id:<namespace>:<id>" – номерата 0..N на различни експорти не се презаписват.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+import app
+
+
+def _where(terms: list) -> dict:
+    where = {}
+    for term in terms:
+        attr, sep, value = term.partition("=")
+        if not sep:
+            raise SystemExit(f"очаква се атрибут=стойност: {term}")
+        values = [v.strip() for v in value.split(",") if v.strip()]
+        where[attr.strip()] = values if len(values) > 1 else values[0]
+    return where
+
+
+def ingest(store: "app.ChartStore", path: str, batch: int = 5000, namespace: str | None = None) -> int:
+    rows, n = [], 0
+    with (sys.stdin if path == "-" else open(path, encoding="utf-8")) as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            obj = json.loads(line)
+            if "result" in obj or obj.get("ok") is False:       # ред от /jobs или /calculate/batch
+                if not obj.get("ok"):
+                    continue
+                res, ext_id = obj["result"], obj.get("id")
+            else:
+                res, ext_id = obj, None
+            if not all(res.get(sec) for sec in app.CHART_STORE_SECTIONS):
+                continue
+            key = f"id:{namespace}:{ext_id}" if namespace and ext_id is not None else hashlib.sha256(
+                json.dumps(res, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+            config = res.get("config") or {}
+            meta = {"ext_id": None if ext_id is None else str(ext_id), "tz": config.get("tz_used")}
+            rows.append((key, meta, app.chart_attributes(res)))
+            if len(rows) >= batch:
+                store.put_many(rows)
+                n += len(rows)
+                rows = []
+    if rows:
+        store.put_many(rows)
+        n += len(rows)
+    return n
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", default=os.getenv("NK_CHART_STORE"), help="SQLite файлът на хранилището")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("attributes", help="атрибутите, по които може да се търси")
+    q = sub.add_parser("query", help="карти по атрибути (И между условията)")
+    q.add_argument("terms", nargs="*", help='атрибут=стойност[,стойност…], напр. "Луна.nakshatra=Рохини"')
+    q.add_argument("--limit", type=int, default=100)
+    q.add_argument("--after", type=int, default=0, help='продължение от "next"')
+    q.add_argument("--count", action="store_true", help="и общия брой")
+    i = sub.add_parser("ingest", help="добавя карти от NDJSON файл (- = stdin)")
+    i.add_argument("path")
+    i.add_argument("--namespace", help='ключ по "id" в това пространство (напр. id на задачата) вместо по съдържание')
+    args = ap.parse_args()
+
+    if args.cmd == "attributes":
+        for name, (_col, table) in app.CHART_STORE_ATTRS.items():
+            print(f"{name:28s} {table or 'число'}")
+        raise SystemExit(0)
+    if not args.db:
+        raise SystemExit("липсва --db (или NK_CHART_STORE)")
+    store = app.get_chart_store(args.db)
+    if args.cmd == "ingest":
+        t0 = time.perf_counter()
+        n = ingest(store, args.path, namespace=args.namespace)
+        print(f"{args.db}: +{n} карти за {time.perf_counter() - t0:.1f} s, общо {store.size()}", file=sys.stderr)
+    else:
+        t0 = time.perf_counter()
+        out = store.query(_where(args.terms), limit=args.limit, after=args.after, count=args.count)
+        ms = (time.perf_counter() - t0) * 1000
+        for row in out["charts"]:
+            print(json.dumps(row, ensure_ascii=False))
+        total = f", общо {out['count']}" if args.count else ""
+        nxt = f", next={out['next']}" if out["next"] else ""
+        print(f"{len(out['charts'])} карти за {ms:.2f} ms{total}{nxt}", file=sys.stderr)